@@ -0,0 +1,63 @@
+"""Responses of the API shared by all the clients asking for the same stop,
+cached in Redis until the realtime ingestion evicts them."""
+
+import json
+import time
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from feed import state as realtime_state
+from feed.locks import get_redis
+from redis.exceptions import WatchError
+from rest_framework import status
+from rest_framework.response import Response
+
+WAIT_INTERVAL = 0.05  # Seconds between the checks of a response being built
+
+
+def cached_response(name, entity_id, build, ttl, entity_type="trip_update"):
+    """Return the cached response ``name`` of an entity, or ``build()`` it.
+
+    Concurrent misses are coalesced: one request builds the response while
+    the others wait up to RESPONSE_CACHE_WAIT seconds for it. Only successful
+    responses are cached, and only if no ``entity_type`` snapshot was
+    published and no new feed was promoted while building them, so they
+    never outlive an eviction.
+    """
+    redis = get_redis()
+    key = realtime_state.response_key(name, entity_id)
+    cached = redis.get(key)
+    if cached is not None:
+        return Response(json.loads(cached))
+
+    building_key = f"{key}:building"
+    wait = settings.RESPONSE_CACHE_WAIT
+    building = redis.set(building_key, 1, nx=True, px=int(wait * 1000))
+    if not building:
+        deadline = time.monotonic() + wait
+        while time.monotonic() < deadline:
+            time.sleep(WAIT_INTERVAL)
+            cached = redis.get(key)
+            if cached is not None:
+                return Response(json.loads(cached))
+        # The builder is too slow or failed, build it here instead
+
+    current_key = realtime_state.CURRENT_KEY.format(entity_type=entity_type)
+    evictions_key = realtime_state.EVICTIONS_KEY.format(name=name)
+    try:
+        with redis.pipeline() as pipeline:
+            pipeline.watch(current_key, evictions_key)
+            response = build()
+            if response.status_code == status.HTTP_200_OK:
+                try:
+                    pipeline.multi()
+                    pipeline.set(
+                        key, json.dumps(response.data, cls=DjangoJSONEncoder), ex=ttl
+                    )
+                    pipeline.execute()
+                except WatchError:
+                    pass  # A new snapshot or feed arrived, the response may be stale
+    finally:
+        if building:
+            redis.delete(building_key)
+    return response
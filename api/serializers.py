@@ -1,6 +1,6 @@
-from feed.models import InfoService
 from gtfs.models import *
 from alerts.models import *
+from feed.models import AlertInformedEntity, InfoService, ServiceAlert
 from rest_framework import serializers
 from rest_framework_gis.serializers import GeoFeatureModelSerializer, GeometryField
 
@@ -39,6 +39,17 @@ class NextTripSerializer(serializers.Serializer):
     next_arrivals = NextArrivalSerializer(many=True)
 
 
+class DepartureStopSerializer(serializers.Serializer):
+    stop_id = serializers.CharField()
+    next_arrivals = NextArrivalSerializer(many=True)
+
+
+class DepartureSerializer(serializers.Serializer):
+    parent_station = serializers.CharField(allow_null=True)
+    timestamp = serializers.DateTimeField()
+    stops = DepartureStopSerializer(many=True)
+
+
 class NextStopSequenceSerializer(serializers.Serializer):
     stop_sequence = serializers.IntegerField()
     stop_id = serializers.CharField()
@@ -216,12 +227,20 @@ class FareRuleSerializer(serializers.HyperlinkedModelSerializer):
         fields = "__all__"
 
 
-class ServiceAlertSerializer(serializers.HyperlinkedModelSerializer):
+class AlertInformedEntitySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = AlertInformedEntity
+        exclude = ["id", "alert"]
 
-    feed = serializers.PrimaryKeyRelatedField(read_only=True)
+
+class ServiceAlertSerializer(serializers.ModelSerializer):
+
+    provider = serializers.PrimaryKeyRelatedField(read_only=True)
+    feed_message = serializers.PrimaryKeyRelatedField(read_only=True)
+    informed_entities = AlertInformedEntitySerializer(many=True, read_only=True)
 
     class Meta:
-        model = Alert
+        model = ServiceAlert
         fields = "__all__"
 
 
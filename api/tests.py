@@ -1,3 +1,756 @@
-from django.test import TestCase
+import json
+import statistics
+import time
+from datetime import date, datetime, time as clock, timedelta
+from fnmatch import fnmatch
+from unittest import mock
 
-# Create your tests here.
+import pandas as pd
+import pytz
+from decouple import config
+from django.conf import settings
+from django.contrib.gis.geos import LineString, Point
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings, tag
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from redis.exceptions import DataError, WatchError
+from rest_framework.response import Response
+
+from api.cache import cached_response
+from feed import state as realtime_state
+from feed.departures import build_departure_board
+from feed.models import DepartureBoard
+from gtfs.models import (
+    Calendar,
+    Feed,
+    GeoShape,
+    Route,
+    RouteStop,
+    Stop,
+    StopTime,
+    Trip,
+)
+
+# Size of the synthetic schedule
+BENCHMARK_STOPS = config("BENCHMARK_STOPS", default=300, cast=int)
+BENCHMARK_ROUTES = config("BENCHMARK_ROUTES", default=12, cast=int)
+BENCHMARK_TRIPS_PER_ROUTE = config("BENCHMARK_TRIPS_PER_ROUTE", default=40, cast=int)
+BENCHMARK_STOPS_PER_TRIP = config("BENCHMARK_STOPS_PER_TRIP", default=25, cast=int)
+BENCHMARK_TRIPS_IN_PROGRESS = config(
+    "BENCHMARK_TRIPS_IN_PROGRESS", default=10, cast=int
+)
+BENCHMARK_REQUESTS = config("BENCHMARK_REQUESTS", default=30, cast=int)
+
+# Thresholds per request of each endpoint, the benchmark fails above them
+LATENCY_THRESHOLDS = {  # p95 in milliseconds
+    "next-trips": config("BENCHMARK_NEXT_TRIPS_P95", default=200, cast=float),
+    "next-trips-cached": config(
+        "BENCHMARK_NEXT_TRIPS_CACHED_P95", default=50, cast=float
+    ),
+    "departures": config("BENCHMARK_DEPARTURES_P95", default=500, cast=float),
+    "next-stops": config("BENCHMARK_NEXT_STOPS_P95", default=500, cast=float),
+    "route-stops": config("BENCHMARK_ROUTE_STOPS_P95", default=500, cast=float),
+}
+QUERY_THRESHOLDS = {
+    # Stop with its feed, departure board, departures, trips and routes,
+    # whatever the number of trips at the stop
+    "next-trips": 5,
+    # From now on, served from the cache after the first request
+    "next-trips-cached": 0,
+    # The same for all the stops of a screen, looked up together
+    "departures": 5,
+    "next-stops": 2 + BENCHMARK_STOPS_PER_TRIP,
+    "route-stops": 2 + BENCHMARK_STOPS_PER_TRIP,
+}
+
+TIMEZONE = pytz.timezone(settings.TIME_ZONE)
+SERVICE_DATE = date.today()
+FIRST_DEPARTURE = timedelta(hours=5)
+HEADWAY = timedelta(minutes=20)
+SECONDS_BETWEEN_STOPS = 90
+HUB_STOP_ID = "stop-0"  # Served by every route
+
+
+def build(model, **values):
+    """Instance of a GTFS model with the values of the fields it has, so the
+    synthetic schedule follows the optional and private fields of the
+    models."""
+    fields = {field.name for field in model._meta.concrete_fields}
+    return model(**{name: value for name, value in values.items() if name in fields})
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def clock_time(delta):
+    return (datetime.min + delta).time()
+
+
+class SyntheticSchedule:
+    """Synthetic GTFS schedule in a new current feed, where every route goes
+    from the hub stop through its own sequence of stops, and realtime data
+    of the trips in progress."""
+
+    def __init__(
+        self,
+        stops=BENCHMARK_STOPS,
+        routes=BENCHMARK_ROUTES,
+        trips_per_route=BENCHMARK_TRIPS_PER_ROUTE,
+        stops_per_trip=BENCHMARK_STOPS_PER_TRIP,
+        trips_in_progress=BENCHMARK_TRIPS_IN_PROGRESS,
+    ):
+        self.feed = build(
+            Feed,
+            feed_id="benchmark-0",
+            is_current=True,
+            retrieved_at=datetime.now(TIMEZONE),
+        )
+        self.feed.save()
+        self.stops = [
+            build(
+                Stop,
+                feed=self.feed,
+                stop_id=f"stop-{index}",
+                stop_name=f"Parada {index}",
+                stop_desc="",
+                stop_lat=9.9 + index / 10000,
+                stop_lon=-84.1 + index / 10000,
+                stop_point=Point(-84.1 + index / 10000, 9.9 + index / 10000),
+                location_type=0,
+            )
+            for index in range(stops)
+        ]
+        Stop.objects.bulk_create(self.stops)
+
+        calendar = build(
+            Calendar,
+            feed=self.feed,
+            service_id="weekdays",
+            monday=True,
+            tuesday=True,
+            wednesday=True,
+            thursday=True,
+            friday=True,
+            saturday=True,
+            sunday=True,
+            start_date=SERVICE_DATE - timedelta(days=30),
+            end_date=SERVICE_DATE + timedelta(days=30),
+        )
+        calendar.save()
+
+        self.routes, shapes, route_stops, self.trips, stop_times = [], [], [], [], []
+        self.route_stop_ids = {}
+        for route_index in range(routes):
+            route = build(
+                Route,
+                feed=self.feed,
+                route_id=f"route-{route_index}",
+                route_short_name=f"{route_index}",
+                route_long_name=f"Ruta {route_index}",
+                route_type=3,
+            )
+            self.routes.append(route)
+            first_stop = route_index * (stops_per_trip - 1)
+            stop_ids = [HUB_STOP_ID] + [
+                f"stop-{1 + (first_stop + index) % (stops - 1)}"
+                for index in range(stops_per_trip - 1)
+            ]
+            self.route_stop_ids[route.route_id] = stop_ids
+            shape = build(
+                GeoShape,
+                feed=self.feed,
+                shape_id=f"shape-{route_index}",
+                geometry=LineString(
+                    [self.stop(stop_id).stop_point for stop_id in stop_ids]
+                ),
+            )
+            shapes.append(shape)
+            route_stops += [
+                build(
+                    RouteStop,
+                    feed=self.feed,
+                    route_id=route.route_id,
+                    shape_id=shape.shape_id,
+                    stop_id=stop_id,
+                    stop_sequence=sequence,
+                    timepoint=True,
+                    _route=route,
+                    _shape=shape,
+                    _stop=self.stop(stop_id),
+                )
+                for sequence, stop_id in enumerate(stop_ids, start=1)
+            ]
+            for trip_index in range(trips_per_route):
+                trip = build(
+                    Trip,
+                    feed=self.feed,
+                    route_id=route.route_id,
+                    service_id=calendar.service_id,
+                    trip_id=f"trip-{route_index}-{trip_index}",
+                    trip_headsign=f"Destino {route_index}",
+                    direction_id=0,
+                    shape_id=shape.shape_id,
+                    wheelchair_accessible=1,
+                    _route=route,
+                    _service=calendar,
+                )
+                trip.departure = FIRST_DEPARTURE + trip_index * HEADWAY
+                self.trips.append(trip)
+                for sequence, stop_id in enumerate(stop_ids, start=1):
+                    arrival = trip.departure + timedelta(
+                        seconds=(sequence - 1) * SECONDS_BETWEEN_STOPS
+                    )
+                    stop_times.append(
+                        build(
+                            StopTime,
+                            feed=self.feed,
+                            trip_id=trip.trip_id,
+                            stop_id=stop_id,
+                            stop_sequence=sequence,
+                            arrival_time=clock_time(arrival),
+                            departure_time=clock_time(arrival),
+                            timepoint=1,
+                            _trip=trip,
+                            _stop=self.stop(stop_id),
+                        )
+                    )
+        Route.objects.bulk_create(self.routes)
+        GeoShape.objects.bulk_create(shapes)
+        RouteStop.objects.bulk_create(route_stops)
+        Trip.objects.bulk_create(self.trips)
+        StopTime.objects.bulk_create(stop_times)
+
+        # As done when the feed becomes current
+        build_departure_board(self.feed, SERVICE_DATE)
+
+        # The last trips that departed before the requests are in progress
+        self.in_progress = [
+            trip for trip in self.trips if trip.departure < self.now_delta()
+        ][-trips_in_progress:]
+
+    def stop(self, stop_id):
+        return self.stops[int(stop_id.split("-")[1])]
+
+    def now_delta(self):
+        """Time of the requests, after the first departures of the day."""
+        return FIRST_DEPARTURE + 3 * HEADWAY
+
+    def now(self):
+        return TIMEZONE.localize(
+            datetime.combine(SERVICE_DATE, clock_time(self.now_delta()))
+        )
+
+    def stop_time_updates(self, trip):
+        """Realtime stop time updates of a trip in progress, as published
+        by the ingest in the realtime state."""
+        start_time = clock_time(trip.departure).strftime("%H:%M:%S")
+        updates = []
+        for sequence, stop_id in enumerate(self.route_stop_ids[trip.route_id], start=1):
+            arrival = TIMEZONE.localize(
+                datetime.combine(SERVICE_DATE, clock.min)
+                + trip.departure
+                + timedelta(seconds=(sequence - 1) * SECONDS_BETWEEN_STOPS + 60)
+            )
+            updates.append(
+                {
+                    "trip_id": trip.trip_id,
+                    "route_id": trip.route_id,
+                    "start_date": SERVICE_DATE.isoformat(),
+                    "start_time": start_time,
+                    "vehicle_id": f"vehicle-{trip.trip_id}",
+                    "stop_sequence": sequence,
+                    "stop_id": stop_id,
+                    "arrival_time": arrival.isoformat(),
+                    "departure_time": arrival.isoformat(),
+                }
+            )
+        return updates
+
+    def realtime_state(self):
+        """Patches of the realtime state reads with the data of the trips in
+        progress."""
+        updates = {
+            trip.trip_id: self.stop_time_updates(trip) for trip in self.in_progress
+        }
+
+        def get_stop_trip_updates(stop_id):
+            return [
+                update
+                for trip_updates in updates.values()
+                for update in trip_updates
+                if update["stop_id"] == stop_id
+            ]
+
+        def get_stops_trip_updates(stop_ids):
+            return {stop_id: get_stop_trip_updates(stop_id) for stop_id in stop_ids}
+
+        def get_trip_stop_time_updates(trip_id, start_date, start_time):
+            return updates.get(trip_id, [])
+
+        def get_vehicle_position(trip_id, start_date, start_time):
+            stop = self.stop(self.route_stop_ids[updates[trip_id][0]["route_id"]][1])
+            return {
+                "vehicle_id": f"vehicle-{trip_id}",
+                "latitude": stop.stop_lat,
+                "longitude": stop.stop_lon,
+                "timestamp": self.now().isoformat(),
+                "current_stop_sequence": 2,
+                "current_status": "IN_TRANSIT_TO",
+                "occupancy_status": "MANY_SEATS_AVAILABLE",
+                "position_in_shape": 1 / (BENCHMARK_STOPS_PER_TRIP - 1),
+            }
+
+        def get_vehicle_positions(trips):
+            return {
+                realtime_state.trip_descriptor(*trip): get_vehicle_position(*trip)
+                for trip in trips
+                if trip[0] in updates
+            }
+
+        return [
+            mock.patch.object(realtime_state, name, function)
+            for name, function in [
+                ("get_stops_trip_updates", get_stops_trip_updates),
+                ("get_trip_stop_time_updates", get_trip_stop_time_updates),
+                ("get_vehicle_positions", get_vehicle_positions),
+            ]
+        ]
+
+
+class EndpointQueryTest(TestCase):
+    """SQL queries per request of the next-trips, departures, next-stops and
+    route-stops endpoints on a synthetic schedule.
+
+    The size of the schedule is set with the BENCHMARK_* environment
+    variables, and a test fails when an endpoint goes over its query budget.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.schedule = SyntheticSchedule()
+
+    def setUp(self):
+        for patch in self.schedule.realtime_state():
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def measure(self, name, params, url_name=None):
+        """Request an endpoint and check its query budget."""
+        url = reverse(url_name or name)
+        self.client.get(url, params)  # Warm up
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertLessEqual(len(context.captured_queries), QUERY_THRESHOLDS[name])
+        return json.loads(response.content)
+
+    def test_next_trips(self):
+        data = self.measure(
+            "next-trips",
+            {
+                "stop_id": HUB_STOP_ID,
+                "timestamp": self.schedule.now().strftime("%Y-%m-%dT%H:%M:%S"),
+            },
+        )
+        in_progress = [
+            arrival for arrival in data["next_arrivals"] if arrival["in_progress"]
+        ]
+        self.assertEqual(len(in_progress), len(self.schedule.in_progress))
+        self.assertTrue(all(arrival["progression"] for arrival in in_progress))
+        self.assertGreater(len(data["next_arrivals"]), len(in_progress))
+
+    def test_next_trips_cached(self):
+        """Without a timestamp the next trips of a stop are cached."""
+        with mock.patch("api.cache.get_redis", return_value=FakeRedis()):
+            data = self.measure(
+                "next-trips-cached", {"stop_id": HUB_STOP_ID}, url_name="next-trips"
+            )
+        self.assertEqual(data["stop_id"], HUB_STOP_ID)
+
+    def test_next_trips_query_budget(self):
+        """The queries of next-trips do not grow with the trips at the stop."""
+        params = {
+            "stop_id": HUB_STOP_ID,
+            "timestamp": self.schedule.now().strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse("next-trips"), params)
+        self.assertEqual(response.status_code, 200, response.content)
+        next_arrivals = json.loads(response.content)["next_arrivals"]
+        self.assertGreater(len(next_arrivals), QUERY_THRESHOLDS["next-trips"])
+        self.assertLessEqual(
+            len(context.captured_queries), QUERY_THRESHOLDS["next-trips"]
+        )
+
+    def test_next_trips_outside_the_boards(self):
+        """Days without a departure board are queried and nothing is saved."""
+        later = self.schedule.now() + timedelta(
+            days=settings.DEPARTURE_BOARD_DAYS_AHEAD + 7
+        )
+        boards = DepartureBoard.objects.count()
+        response = self.client.get(
+            reverse("next-trips"),
+            {
+                "stop_id": HUB_STOP_ID,
+                "timestamp": later.strftime("%Y-%m-%dT%H:%M:%S"),
+            },
+        )
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(DepartureBoard.objects.count(), boards)
+        scheduled = [
+            arrival
+            for arrival in json.loads(response.content)["next_arrivals"]
+            if not arrival["in_progress"]
+        ]
+        self.assertTrue(scheduled)
+        self.assertTrue(
+            all(
+                arrival["arrival_time"].startswith(later.date().isoformat())
+                for arrival in scheduled
+            )
+        )
+
+    def test_departures(self):
+        route = self.schedule.routes[0]
+        stop_ids = self.schedule.route_stop_ids[route.route_id][:5]
+        data = self.measure(
+            "departures",
+            {
+                "stop_id": ",".join(stop_ids),
+                "timestamp": self.schedule.now().strftime("%Y-%m-%dT%H:%M:%S"),
+            },
+        )
+        self.assertEqual([stop["stop_id"] for stop in data["stops"]], stop_ids)
+        next_trips = self.client.get(
+            reverse("next-trips"),
+            {
+                "stop_id": stop_ids[0],
+                "timestamp": self.schedule.now().strftime("%Y-%m-%dT%H:%M:%S"),
+            },
+        )
+        self.assertEqual(
+            data["stops"][0]["next_arrivals"],
+            json.loads(next_trips.content)["next_arrivals"],
+        )
+
+    def test_departures_unknown_stop(self):
+        response = self.client.get(
+            reverse("departures"), {"stop_id": f"{HUB_STOP_ID},stop-unknown"}
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def test_next_stops(self):
+        trip = self.schedule.in_progress[0]
+        data = self.measure(
+            "next-stops",
+            {
+                "trip_id": trip.trip_id,
+                "start_date": SERVICE_DATE.isoformat(),
+                "start_time": clock_time(trip.departure).strftime("%H:%M:%S"),
+            },
+        )
+        self.assertEqual(len(data["next_stop_sequence"]), BENCHMARK_STOPS_PER_TRIP)
+
+    def test_route_stops(self):
+        route = self.schedule.routes[0]
+        data = self.measure(
+            "route-stops",
+            {"route_id": route.route_id, "shape_id": "shape-0"},
+        )
+        self.assertEqual(len(data["features"]), BENCHMARK_STOPS_PER_TRIP)
+
+
+@tag("benchmark")
+class EndpointBenchmark(EndpointQueryTest):
+    """Latency and SQL queries per request of the same endpoints, over
+    BENCHMARK_REQUESTS requests each.
+
+    Wall-clock thresholds depend on the machine, so these tests are left out
+    of the test suite unless asked for with ``manage.py test --tag benchmark``.
+    The measurements are printed, and a test fails when an endpoint goes over
+    its thresholds.
+    """
+
+    def measure(self, name, params, url_name=None):
+        """Request an endpoint repeatedly and check its thresholds."""
+        url = reverse(url_name or name)
+        self.client.get(url, params)  # Warm up
+        latencies, queries = [], []
+        for _ in range(BENCHMARK_REQUESTS):
+            with CaptureQueriesContext(connection) as context:
+                start = time.perf_counter()
+                response = self.client.get(url, params)
+                latencies.append((time.perf_counter() - start) * 1000)
+            queries.append(len(context.captured_queries))
+            self.assertEqual(response.status_code, 200, response.content)
+
+        p95 = percentile(latencies, 0.95)
+        print(
+            f"\n{name}: p50 {statistics.median(latencies):.1f} ms, "
+            f"p95 {p95:.1f} ms, p99 {percentile(latencies, 0.99):.1f} ms, "
+            f"max {max(latencies):.1f} ms, {max(queries)} queries"
+        )
+        self.assertLessEqual(p95, LATENCY_THRESHOLDS[name])
+        self.assertLessEqual(max(queries), QUERY_THRESHOLDS[name])
+        return json.loads(response.content)
+
+
+def encode(value):
+    return value if isinstance(value, bytes) else str(value).encode()
+
+
+class FakeRedis:
+    """The Redis commands used by the response cache and the realtime state,
+    in memory, with WATCH failing on keys changed after it."""
+
+    def __init__(self):
+        self.values = {}
+        self.changes = {}  # Times each key changed
+        self.expirations = {}  # Seconds each key was last set to expire in
+
+    def changed(self, key):
+        self.changes[key] = self.changes.get(key, 0) + 1
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, nx=False, ex=None, px=None):
+        # Like redis-py, which only takes whole seconds or milliseconds
+        for name, expiry in [("ex", ex), ("px", px)]:
+            if expiry is not None and not isinstance(expiry, (int, timedelta)):
+                raise DataError(f"{name} must be datetime.timedelta or int")
+        if nx and key in self.values:
+            return None
+        self.values[key] = encode(value)
+        self.changed(key)
+        return True
+
+    def delete(self, *keys):
+        for key in keys:
+            if self.values.pop(key, None) is not None:
+                self.changed(key)
+
+    def incr(self, key):
+        self.values[key] = encode(int(self.values.get(key, 0)) + 1)
+        self.changed(key)
+
+    def expire(self, key, seconds):
+        self.expirations[key] = seconds
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        mapping = {field: value} if mapping is None else mapping
+        self.values.setdefault(key, {}).update(
+            (encode(field), encode(value)) for field, value in mapping.items()
+        )
+        self.changed(key)
+
+    def hget(self, key, field):
+        return self.values.get(key, {}).get(encode(field))
+
+    def hgetall(self, key):
+        return dict(self.values.get(key, {}))
+
+    def scan_iter(self, match):
+        return [key for key in self.values if fnmatch(key, match)]
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    """Pipeline of FakeRedis, which runs its commands on execute."""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.watched = {}
+        self.commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.watched, self.commands = {}, []
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.commands.append((getattr(self.redis, name), args, kwargs))
+
+        return command
+
+    def watch(self, *keys):
+        self.watched = {key: self.redis.changes.get(key, 0) for key in keys}
+
+    def multi(self):
+        pass
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        watched, self.watched = self.watched, {}
+        if any(self.redis.changes.get(key, 0) != n for key, n in watched.items()):
+            raise WatchError("Watched variable changed.")
+        return [command(*args, **kwargs) for command, args, kwargs in commands]
+
+
+def trip_update_frames(*stop_time_updates):
+    """Frames of a trip update with (stop ID, Unix arrival time) stop time
+    updates, as given by the ingest to ``publish_trip_updates``."""
+    trip_updates_df = pd.DataFrame(
+        {
+            "trip_trip_id": ["trip-1"],
+            "trip_start_date": [pd.Timestamp(SERVICE_DATE)],
+            "trip_start_time": [FIRST_DEPARTURE],
+            "trip_route_id": ["route-1"],
+            "vehicle_id": ["bus-1"],
+        }
+    )
+    arrivals = [
+        pd.Timestamp(arrival, unit="s", tz="UTC") for _, arrival in stop_time_updates
+    ]
+    stop_time_updates_df = pd.DataFrame(
+        {
+            "stop_sequence": range(1, len(stop_time_updates) + 1),
+            "stop_id": [stop_id for stop_id, _ in stop_time_updates],
+            "arrival_time": arrivals,
+            "departure_time": arrivals,
+        }
+    )
+    return trip_updates_df, stop_time_updates_df, [0] * len(stop_time_updates)
+
+
+@override_settings(RESPONSE_CACHE_WAIT=0.5, REALTIME_STATE_TTL=60)
+class CachedResponseTest(SimpleTestCase):
+    """Responses cached per stop, coalesced while they are built and evicted
+    by the realtime ingestion and the promotion of a feed."""
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        for target in ["api.cache.get_redis", "feed.state.get_redis"]:
+            patch = mock.patch(target, return_value=self.redis)
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.provider = mock.Mock(code="test")
+        self.builds = []
+
+    def build(self, stop_id, during=None):
+        """Build function of the response of a stop, which counts its calls
+        and runs ``during`` while building."""
+
+        def build():
+            self.builds.append(stop_id)
+            if during:
+                during()
+            return Response({"stop_id": stop_id, "build": len(self.builds)})
+
+        return build
+
+    def get(self, stop_id, during=None):
+        return cached_response(
+            "next-trips", stop_id, self.build(stop_id, during), ttl=30
+        ).data
+
+    def test_hit(self):
+        self.assertEqual(self.get("A"), {"stop_id": "A", "build": 1})
+        self.assertEqual(self.get("A"), {"stop_id": "A", "build": 1})
+        self.assertEqual(self.builds, ["A"])
+
+    def test_miss_waits_for_the_same_build(self):
+        key = realtime_state.response_key("next-trips", "A")
+        self.redis.set(f"{key}:building", 1, nx=True)
+
+        def sleep(seconds):
+            # The other request stores the response meanwhile
+            self.redis.set(key, json.dumps({"stop_id": "A", "build": 0}))
+
+        with mock.patch("api.cache.time.sleep", side_effect=sleep) as slept:
+            self.assertEqual(self.get("A"), {"stop_id": "A", "build": 0})
+        slept.assert_called_once()
+        self.assertEqual(self.builds, [])
+
+    def test_build_discarded_after_a_new_snapshot(self):
+        def publish():
+            realtime_state.publish_trip_updates(
+                self.provider, 2, *trip_update_frames(("B", 1000))
+            )
+
+        self.assertEqual(self.get("A", during=publish), {"stop_id": "A", "build": 1})
+        key = realtime_state.response_key("next-trips", "A")
+        self.assertIsNone(self.redis.get(key))
+        self.assertEqual(self.get("A"), {"stop_id": "A", "build": 2})
+        self.assertEqual(self.get("A"), {"stop_id": "A", "build": 2})
+
+    def test_publish_trip_updates_evicts_the_changed_stops(self):
+        for stop_id in ["A", "B", "C"]:
+            self.get(stop_id)
+        realtime_state.publish_trip_updates(
+            self.provider, 1, *trip_update_frames(("A", 1000), ("B", 1100))
+        )
+        self.assertEqual(self.get("A")["build"], 4)
+        self.assertEqual(self.get("B")["build"], 5)
+        self.assertEqual(self.get("C")["build"], 3)
+
+        # Only the stop whose arrival changed
+        realtime_state.publish_trip_updates(
+            self.provider, 2, *trip_update_frames(("A", 1060), ("B", 1100))
+        )
+        self.assertEqual(self.get("A")["build"], 6)
+        self.assertEqual(self.get("B")["build"], 5)
+
+    def test_feed_promoted_evicts_all_the_stops(self):
+        for stop_id in ["A", "B"]:
+            self.get(stop_id)
+
+        def promote():
+            realtime_state.evict_schedule_responses(sender=None, feed=None)
+
+        # Built with the previous schedule, so it is not cached either
+        self.assertEqual(self.get("C", during=promote)["build"], 3)
+        self.assertEqual(self.get("A")["build"], 4)
+        self.assertEqual(self.get("B")["build"], 5)
+        self.assertEqual(self.get("C")["build"], 6)
+
+
+@override_settings(REALTIME_STATE_TTL=60, REALTIME_STATE_GRACE=5)
+class RealtimeStateTest(SimpleTestCase):
+    """Snapshots of the trip updates published in the realtime state."""
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        patch = mock.patch("feed.state.get_redis", return_value=self.redis)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.provider = mock.Mock(code="test")
+
+    def test_replaced_snapshot_expires_after_the_grace(self):
+        realtime_state.publish_trip_updates(
+            self.provider, 1, *trip_update_frames(("A", 1000), ("B", 1100))
+        )
+        realtime_state.publish_trip_updates(
+            self.provider, 2, *trip_update_frames(("A", 1060))
+        )
+        expirations = {
+            key: seconds
+            for key, seconds in self.redis.expirations.items()
+            if key.startswith("realtime:test:")
+        }
+        self.assertTrue(expirations)
+        for key, seconds in expirations.items():
+            self.assertEqual(seconds, 5 if key.startswith("realtime:test:1:") else 60)
+        self.assertIn("realtime:test:1:stop:B", expirations)
+
+    def test_stop_time_updates_without_stop_sequence(self):
+        trip_updates_df, stop_time_updates_df, index = trip_update_frames(
+            ("A", 1000), ("B", 1100)
+        )
+        stop_time_updates_df["stop_sequence"] = None
+        realtime_state.publish_trip_updates(
+            self.provider, 1, trip_updates_df, stop_time_updates_df, index
+        )
+        stop_time_updates = realtime_state.get_trip_stop_time_updates(
+            "trip-1", SERVICE_DATE.isoformat(), "05:00:00"
+        )
+        self.assertEqual(
+            sorted(update["stop_id"] for update in stop_time_updates), ["A", "B"]
+        )
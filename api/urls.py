@@ -20,6 +20,7 @@ router.register(r"stop-times", views.StopTimeViewSet)
 router.register(r"fare-attributes", views.FareAttributeViewSet)
 router.register(r"fare-rules", views.FareRuleViewSet)
 router.register(r"feed-info", views.FeedInfoViewSet)
+router.register(r"service-alerts", views.ServiceAlertViewSet)
 
 
 # Wire up our API using automatic URL routing.
@@ -27,8 +28,10 @@ router.register(r"feed-info", views.FeedInfoViewSet)
 urlpatterns = [
     path("", include(router.urls)),
     path("next-trips/", views.NextTripView.as_view(), name="next-trips"),
+    path("departures/", views.DepartureView.as_view(), name="departures"),
     path("next-stops/", views.NextStopView.as_view(), name="next-stops"),
     path("route-stops/", views.RouteStopView.as_view(), name="route-stops"),
+    path("active-alerts/", views.ActiveAlertView.as_view(), name="active-alerts"),
     path("api-auth/", include("rest_framework.urls", namespace="rest_framework")),
     path("docs/schema/", views.get_schema, name="schema"),
     path("docs/", SpectacularRedocView.as_view(url_name="schema"), name="api_docs"),
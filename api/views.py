@@ -1,6 +1,8 @@
 from django.conf import settings
 from django.http import FileResponse
-from feed.models import InfoService
+from feed import state as realtime_state
+from feed.departures import get_departure_board, get_stop_departures
+from feed.models import InfoService, ServiceAlert
 from gtfs.models import (
     GTFSProvider,
     Route,
@@ -15,11 +17,11 @@ from rest_framework.views import APIView
 from rest_framework.response import Response
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import status
-from shapely import geometry
 from datetime import datetime, timedelta
 import pytz
 from django.conf import settings
 
+from .cache import cached_response
 from .serializers import *
 
 # from .serializers import InfoServiceSerializer, GTFSProviderSerializer, RouteSerializer, TripSerializer
@@ -51,15 +53,24 @@ class GTFSProviderViewSet(viewsets.ModelViewSet):
 
 class NextTripView(APIView):
     def get(self, request):
+        # The next trips from now are the same for every client of a stop
+        stop_id = request.query_params.get("stop_id")
+        if stop_id and not request.query_params.get("timestamp"):
+            return cached_response(
+                "next-trips",
+                stop_id,
+                lambda: self.next_trips(request),
+                ttl=settings.NEXT_TRIPS_CACHE_TTL,
+            )
+        return self.next_trips(request)
 
-        timezone = pytz.timezone(settings.TIME_ZONE)
+    def next_trips(self, request):
 
         # Query parameters
         if request.query_params.get("stop_id"):
             stop_id = request.query_params.get("stop_id")
-            try:
-                Stop.objects.get(stop_id=stop_id)
-            except Stop.DoesNotExist:
+            current_feeds = get_current_feeds(Stop.objects.filter(stop_id=stop_id))
+            if not current_feeds:
                 return Response(
                     {
                         "error": f"No existe la parada especificada {stop_id} en la base de datos."
@@ -74,142 +85,114 @@ class NextTripView(APIView):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        if request.query_params.get("timestamp"):
-            timestamp = request.query_params.get("timestamp")
-            timestamp = datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S")
-            timestamp = timezone.localize(timestamp)
-        else:
-            timestamp = datetime.now()
-            timestamp = timezone.localize(timestamp)
+        timestamp = get_timestamp(request)
 
-        # Get the current GTFS feed
-        current_feed = Feed.objects.filter(is_current=True).latest("retrieved_at")
-        service_id = get_calendar(timestamp.date(), current_feed)
-        if service_id is None:
+        # Departures on the service day in the current GTFS feed of the stop
+        current_feed = current_feeds[stop_id]
+        board = get_departure_board(current_feed, timestamp.date())
+        if not board.services:
             return Response(
                 {"error": "No hay servicio disponible para la fecha especificada."},
                 status=status.HTTP_204_NO_CONTENT,
             )
 
-        next_arrivals = []
+        next_arrivals = get_next_arrivals(current_feed, board, [stop_id], timestamp)
 
-        # -----------------
-        # Trips in progress
-        # -----------------
+        data = {
+            "stop_id": stop_id,
+            "timestamp": timestamp,
+            "next_arrivals": next_arrivals[stop_id],
+        }
 
-        latest_feed_message = FeedMessage.objects.filter(
-            entity_type="trip_update"
-        ).latest("timestamp")
-        # TODO: check TTL (time to live)
-        stop_time_updates = StopTimeUpdate.objects.filter(
-            feed_message=latest_feed_message, stop_id=stop_id
-        )
-        print(f"stop_time_updates: {stop_time_updates}")
+        serializer = NextTripSerializer(data)
+        return Response(serializer.data)
 
-        trips_in_progress = []
 
-        # Build the response for trips in progress
-        for stop_time_update in stop_time_updates:
-            trip_update = TripUpdate.objects.get(
-                id=stop_time_update.trip_update.id,
-            )
-            trip = Trip.objects.filter(
-                trip_id=trip_update.trip_trip_id, feed=current_feed
-            ).first()
-            trips_in_progress.append(trip)
-            route = Route.objects.filter(
-                route_id=trip.route_id, feed=current_feed
-            ).first()
-            vehicle_position = VehiclePosition.objects.filter(
-                # TODO: ponder if making a new table for TripDescriptor is better
-                vehicle_trip_trip_id=trip_update.trip_trip_id,
-                vehicle_trip_start_date=trip_update.trip_start_date,
-                vehicle_trip_start_time=trip_update.trip_start_time,
-            ).first()
-            geo_shape = GeoShape.objects.filter(
-                shape_id=trip.shape_id, feed=current_feed
-            ).first()
-            geo_shape = geometry.LineString(geo_shape.geometry.coords)
-            location = vehicle_position.vehicle_position_point
-            location = geometry.Point(location.x, location.y)
-            position_in_shape = geo_shape.project(location) / geo_shape.length
- 
-            next_arrivals.append(
+class DepartureView(APIView):
+    def get(self, request):
+
+        # Query parameters
+        stop_ids = [
+            stop_id
+            for value in request.query_params.getlist("stop_id")
+            for stop_id in value.split(",")
+            if stop_id
+        ]
+        parent_station = request.query_params.get("parent_station")
+        if not stop_ids and not parent_station:
+            return Response(
                 {
-                    "trip_id": trip.trip_id,
-                    "route_id": route.route_id,
-                    "route_short_name": route.route_short_name,
-                    "route_long_name": route.route_long_name,
-                    "trip_headsign": trip.trip_headsign,
-                    "wheelchair_accessible": trip.wheelchair_accessible,
-                    "arrival_time": stop_time_update.arrival_time,
-                    "departure_time": stop_time_update.departure_time,
-                    "in_progress": True,
-                    "progression": {
-                        "position_in_shape": position_in_shape,
-                        "current_stop_sequence": vehicle_position.vehicle_current_stop_sequence,
-                        "current_status": vehicle_position.vehicle_current_status,
-                        "occupancy_status": vehicle_position.vehicle_occupancy_status,
-                    },
-                }
+                    "error": "Es necesario especificar una lista de stop_id o un parent_station como parámetro de la solicitud: /departures?stop_id=bUCR-0-01,bUCR-0-02, por ejemplo."
+                },
+                status=status.HTTP_400_BAD_REQUEST,
             )
 
-        print(trips_in_progress)
-
-        # ---------------
-        # Scheduled trips
-        # ---------------
-
-        stop_times = StopTime.objects.filter(
-            feed=current_feed,
-            stop_id=stop_id,
-            arrival_time__gte=timestamp.time(),
-            _trip__service_id=service_id,
-        ).order_by("arrival_time")
+        timestamp = get_timestamp(request)
 
-        # Build the response for scheduled trips
-        for stop_time in stop_times:
-            trip = Trip.objects.filter(
-                trip_id=stop_time.trip_id, feed=current_feed
-            ).first()
-            if trip in trips_in_progress:
-                continue
-            route = Route.objects.filter(
-                route_id=trip.route_id, feed=current_feed
-            ).first()
-
-            arrival_time = timezone.localize(
-                datetime.combine(timestamp.today(), stop_time.arrival_time)
-            )
-            departure_time = timezone.localize(
-                datetime.combine(timestamp.today(), stop_time.departure_time)
-            )
-
-            next_arrivals.append(
+        # Stops of the screen, each one from the current GTFS feed of its
+        # provider
+        if stop_ids:
+            stops = Stop.objects.filter(stop_id__in=stop_ids)
+        else:
+            stops = Stop.objects.filter(parent_station=parent_station)
+        current_feeds = get_current_feeds(stops)
+        found = set(current_feeds)
+        if stop_ids:
+            missing = [stop_id for stop_id in stop_ids if stop_id not in found]
+            if missing:
+                return Response(
+                    {
+                        "error": f"No existen las paradas especificadas {', '.join(missing)} en la base de datos."
+                    },
+                    status=status.HTTP_404_NOT_FOUND,
+                )
+            stop_ids = list(dict.fromkeys(stop_ids))
+        else:
+            if not found:
+                return Response(
+                    {
+                        "error": f"No existen paradas de la estación {parent_station} en la base de datos."
+                    },
+                    status=status.HTTP_404_NOT_FOUND,
+                )
+            stop_ids = sorted(found)
+        if len(stop_ids) > settings.DEPARTURES_MAX_STOPS:
+            return Response(
                 {
-                    "trip_id": trip.trip_id,
-                    "route_id": route.route_id,
-                    "route_short_name": route.route_short_name,
-                    "route_long_name": route.route_long_name,
-                    "trip_headsign": trip.trip_headsign,
-                    "wheelchair_accessible": trip.wheelchair_accessible,
-                    "arrival_time": arrival_time,
-                    "departure_time": departure_time,
-                    "in_progress": False,
-                    "progression": None,
-                }
+                    "error": f"Se pueden consultar como máximo {settings.DEPARTURES_MAX_STOPS} paradas por solicitud."
+                },
+                status=status.HTTP_400_BAD_REQUEST,
             )
 
-        # Sort the list by arrival time
-        next_arrivals.sort(key=lambda x: x["arrival_time"])
+        # Departures of the stops of each feed, usually only one
+        feed_stop_ids = {}
+        for stop_id in stop_ids:
+            feed_stop_ids.setdefault(current_feeds[stop_id], []).append(stop_id)
+        next_arrivals = {stop_id: [] for stop_id in stop_ids}
+        in_service = False
+        for current_feed, ids in feed_stop_ids.items():
+            board = get_departure_board(current_feed, timestamp.date())
+            if board.services:
+                in_service = True
+                next_arrivals.update(
+                    get_next_arrivals(current_feed, board, ids, timestamp)
+                )
+        if not in_service:
+            return Response(
+                {"error": "No hay servicio disponible para la fecha especificada."},
+                status=status.HTTP_204_NO_CONTENT,
+            )
 
         data = {
-            "stop_id": stop_id,
+            "parent_station": parent_station,
             "timestamp": timestamp,
-            "next_arrivals": next_arrivals,
+            "stops": [
+                {"stop_id": stop_id, "next_arrivals": next_arrivals[stop_id]}
+                for stop_id in stop_ids
+            ],
         }
 
-        serializer = NextTripSerializer(data)
+        serializer = DepartureSerializer(data)
         return Response(serializer.data)
 
 
@@ -229,39 +212,40 @@ class NextStopView(APIView):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
+        # The trips are published with a zero-padded start date and time
+        try:
+            start_date = realtime_state.format_date(start_date)
+            start_time = realtime_state.format_time(str_to_timedelta(start_time))
+        except ValueError:
+            return Response(
+                {
+                    "error": "El start_date debe tener el formato AAAA-MM-DD y el start_time el formato HH:MM:SS."
+                },
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
         next_stop_sequence = []
 
         # For trips in progress
-        latest_trip_update = FeedMessage.objects.filter(
-            entity_type="trip_update"
-        ).latest("timestamp")
-        trip_update = TripUpdate.objects.filter(
-            feed_message=latest_trip_update,
-            trip_trip_id=trip_id,
-            trip_start_date=start_date,
-            trip_start_time=start_time,
-        ).first()
-        stop_time_updates = StopTimeUpdate.objects.filter(
-            trip_update=trip_update
-        ).order_by("stop_sequence")
-
-        current_feed = Feed.objects.filter(is_current=True).latest("retrieved_at")
+        stop_time_updates = realtime_state.get_trip_stop_time_updates(
+            trip_id, start_date, start_time
+        )
 
         for stop_time_update in stop_time_updates:
-            print(f"La parada: {stop_time_update.stop_id}")
-            stop = Stop.objects.get(
-                stop_id=stop_time_update.stop_id,
-                feed=current_feed,
-            )
+            print(f"La parada: {stop_time_update['stop_id']}")
+            stop = Stop.objects.filter(
+                stop_id=stop_time_update["stop_id"],
+                feed__is_current=True,
+            ).latest("feed__retrieved_at")
             next_stop_sequence.append(
                 {
-                    "stop_sequence": stop_time_update.stop_sequence,
+                    "stop_sequence": stop_time_update["stop_sequence"],
                     "stop_id": stop.stop_id,
                     "stop_name": stop.stop_name,
                     "stop_lat": stop.stop_lat,
                     "stop_lon": stop.stop_lon,
-                    "arrival": stop_time_update.arrival_time,
-                    "departure": stop_time_update.departure_time,
+                    "arrival": parse_timestamp(stop_time_update["arrival_time"]),
+                    "departure": parse_timestamp(stop_time_update["departure_time"]),
                 }
             )
 
@@ -290,7 +274,7 @@ class RouteStopView(APIView):
             shape_id = request.query_params.get("shape_id")
             try:
                 route_stops = RouteStop.objects.filter(
-                    route_id=route_id, shape_id=shape_id
+                    feed__is_current=True, route_id=route_id, shape_id=shape_id
                 )
             except RouteStop.DoesNotExist:
                 return Response(
@@ -307,15 +291,14 @@ class RouteStopView(APIView):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        # Get the current GTFS feed
-        current_feed = Feed.objects.filter(is_current=True).latest("retrieved_at")
-
         # Construct the GeoJSON structure
         geojson = {"type": "FeatureCollection", "features": []}
 
         # Build the response for scheduled trips
         for route_stop in route_stops:
-            stop = Stop.objects.get(stop_id=route_stop.stop_id, feed=current_feed)
+            stop = Stop.objects.get(
+                stop_id=route_stop.stop_id, feed_id=route_stop.feed_id
+            )
 
             print(stop.shelter)
             feature = {
@@ -354,12 +337,34 @@ class RouteStopView(APIView):
             )
 
 
+class ActiveAlertView(APIView):
+    def get(self, request):
+
+        # Get query parameters, the alerts of one entity are requested
+        for kind in realtime_state.INFORMED_ENTITY_KINDS:
+            entity_id = request.query_params.get(f"{kind}_id")
+            if entity_id:
+                break
+        else:
+            return Response(
+                {
+                    "error": "Es necesario especificar el agency_id, route_id, trip_id o stop_id como parámetro de la solicitud: /active-alerts?stop_id=bUCR-0-01, por ejemplo."
+                },
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        # Index lookup of the alerts in the latest realtime state
+        alerts = realtime_state.get_active_alerts(kind, entity_id)
+
+        return Response(alerts)
+
+
 class AgencyViewSet(viewsets.ModelViewSet):
     """
     Agencias de transporte público.
     """
 
-    queryset = Agency.objects.all()
+    queryset = Agency.objects.filter(feed__is_current=True)
     serializer_class = AgencySerializer
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ["agency_id", "agency_name"]
@@ -371,7 +376,7 @@ class StopViewSet(viewsets.ModelViewSet):
     Paradas de transporte público.
     """
 
-    queryset = Stop.objects.all()
+    queryset = Stop.objects.filter(feed__is_current=True)
     serializer_class = StopSerializer
     filter_backends = [DjangoFilterBackend]
     filterset_fields = [
@@ -390,7 +395,7 @@ class GeoStopViewSet(viewsets.ModelViewSet):
     Paradas como GeoJSON.
     """
 
-    queryset = Stop.objects.all()
+    queryset = Stop.objects.filter(feed__is_current=True)
     serializer_class = GeoStopSerializer
     filter_backends = [DjangoFilterBackend]
     filterset_fields = [
@@ -408,7 +413,7 @@ class RouteViewSet(viewsets.ModelViewSet):
     Rutas de transporte público.
     """
 
-    queryset = Route.objects.all()
+    queryset = Route.objects.filter(feed__is_current=True)
     serializer_class = RouteSerializer
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ["route_type", "route_id"]
@@ -428,7 +433,7 @@ class CalendarViewSet(viewsets.ModelViewSet):
     Calendarios de transporte público.
     """
 
-    queryset = Calendar.objects.all()
+    queryset = Calendar.objects.filter(feed__is_current=True)
     serializer_class = CalendarSerializer
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ["service_id"]
@@ -440,7 +445,7 @@ class CalendarDateViewSet(viewsets.ModelViewSet):
     Fechas de calendario de transporte público.
     """
 
-    queryset = CalendarDate.objects.all()
+    queryset = CalendarDate.objects.filter(feed__is_current=True)
     serializer_class = CalendarDateSerializer
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ["service_id"]
@@ -452,7 +457,7 @@ class ShapeViewSet(viewsets.ModelViewSet):
     Formas de transporte público.
     """
 
-    queryset = Shape.objects.all()
+    queryset = Shape.objects.filter(feed__is_current=True)
     serializer_class = ShapeSerializer
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ["shape_id"]
@@ -464,7 +469,7 @@ class GeoShapeViewSet(viewsets.ModelViewSet):
     Formas geográficas de transporte público.
     """
 
-    queryset = GeoShape.objects.all()
+    queryset = GeoShape.objects.filter(feed__is_current=True)
     serializer_class = GeoShapeSerializer
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ["shape_id"]
@@ -476,7 +481,7 @@ class TripViewSet(viewsets.ModelViewSet):
     Viajes de transporte público.
     """
 
-    queryset = Trip.objects.all()
+    queryset = Trip.objects.filter(feed__is_current=True)
     serializer_class = TripSerializer
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ["shape_id", "direction_id", "trip_id", "route_id", "service_id"]
@@ -494,7 +499,7 @@ class StopTimeViewSet(viewsets.ModelViewSet):
     Horarios de paradas de transporte público.
     """
 
-    queryset = StopTime.objects.all()
+    queryset = StopTime.objects.filter(feed__is_current=True)
     serializer_class = StopTimeSerializer
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ["trip_id", "stop_id"]
@@ -506,7 +511,7 @@ class FeedInfoViewSet(viewsets.ModelViewSet):
     Información de alimentación de transporte público.
     """
 
-    queryset = FeedInfo.objects.all()
+    queryset = FeedInfo.objects.filter(feed__is_current=True)
     serializer_class = FeedInfoSerializer
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ["feed_publisher_name"]
@@ -544,15 +549,18 @@ class ServiceAlertViewSet(viewsets.ModelViewSet):
     Alertas de servicio de transporte público.
     """
 
-    queryset = Alert.objects.all()
+    queryset = ServiceAlert.objects.prefetch_related("informed_entities").distinct()
     serializer_class = ServiceAlertSerializer
     filter_backends = [DjangoFilterBackend]
     filterset_fields = [
+        "provider",
         "alert_id",
-        "route_id",
-        "trip_id",
-        "service_start_time",
-        "service_date",
+        "is_published",
+        "cause",
+        "effect",
+        "informed_entities__route_id",
+        "informed_entities__trip_id",
+        "informed_entities__stop_id",
     ]
     # permission_classes = [permissions.IsAuthenticated]
 
@@ -662,6 +670,168 @@ def get_schema(request):
     )
 
 
+def parse_timestamp(timestamp):
+    """Convert an ISO 8601 timestamp of the realtime state to a datetime."""
+    return datetime.fromisoformat(timestamp) if timestamp else None
+
+
+def get_current_feeds(stops):
+    """Current GTFS feed of each stop of a queryset, by stop ID. Every
+    provider has its own current feed, and the latest one wins for a stop ID
+    that several of them share."""
+    return {
+        stop.stop_id: stop.feed
+        for stop in stops.filter(feed__is_current=True)
+        .select_related("feed")
+        .order_by("feed__retrieved_at")
+    }
+
+
+def get_timestamp(request):
+    """Local time of the optional timestamp parameter of a request, or now."""
+    timezone = pytz.timezone(settings.TIME_ZONE)
+    if request.query_params.get("timestamp"):
+        timestamp = request.query_params.get("timestamp")
+        timestamp = datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S")
+    else:
+        timestamp = datetime.now()
+    return timezone.localize(timestamp)
+
+
+def get_next_arrivals(current_feed, board, stop_ids, timestamp):
+    """Next arrivals at each stop after a timestamp, by stop ID: the trips in
+    progress with their latest updates and the scheduled trips of the board.
+
+    The realtime state, trips and routes are read once for all the stops.
+    """
+    timezone = pytz.timezone(settings.TIME_ZONE)
+
+    # Latest realtime state, which expires if it is not refreshed
+    stops_trip_updates = realtime_state.get_stops_trip_updates(stop_ids)
+    trips_in_progress = {
+        stop_id: {stop_time_update["trip_id"] for stop_time_update in updates}
+        for stop_id, updates in stops_trip_updates.items()
+    }
+    stop_time_updates = [
+        (stop_id, stop_time_update)
+        for stop_id, updates in stops_trip_updates.items()
+        for stop_time_update in updates
+    ]
+
+    # Scheduled trips, without the ones in progress at each stop, with their
+    # trip and route already joined in the departure board
+    stop_departures = [
+        stop_departure
+        for stop_departure in get_stop_departures(board, stop_ids, timestamp.time())
+        if stop_departure.trip_id not in trips_in_progress[stop_departure.stop_id]
+    ]
+
+    # Trips and routes of the trips in progress, one query each
+    trips = {
+        trip.trip_id: trip
+        for trip in Trip.objects.filter(
+            feed=current_feed,
+            trip_id__in={
+                stop_time_update["trip_id"] for _, stop_time_update in stop_time_updates
+            },
+        )
+    }
+    routes = {
+        route.route_id: route
+        for route in Route.objects.filter(
+            feed=current_feed,
+            route_id__in={trip.route_id for trip in trips.values()},
+        )
+    }
+    vehicle_positions = realtime_state.get_vehicle_positions(
+        (
+            stop_time_update["trip_id"],
+            stop_time_update["start_date"],
+            stop_time_update["start_time"],
+        )
+        for _, stop_time_update in stop_time_updates
+    )
+
+    next_arrivals = {stop_id: [] for stop_id in stop_ids}
+
+    # -----------------
+    # Trips in progress
+    # -----------------
+
+    for stop_id, stop_time_update in stop_time_updates:
+        trip = trips.get(stop_time_update["trip_id"])
+        if trip is None:
+            continue
+        route = routes.get(trip.route_id)
+        vehicle_position = vehicle_positions.get(
+            realtime_state.trip_descriptor(
+                stop_time_update["trip_id"],
+                stop_time_update["start_date"],
+                stop_time_update["start_time"],
+            )
+        )
+        # Progression along the shape, computed when the position was ingested
+        progression = None
+        if (
+            vehicle_position is not None
+            and vehicle_position.get("position_in_shape") is not None
+        ):
+            progression = {
+                "position_in_shape": vehicle_position["position_in_shape"],
+                "current_stop_sequence": vehicle_position["current_stop_sequence"],
+                "current_status": vehicle_position["current_status"],
+                "occupancy_status": vehicle_position["occupancy_status"],
+            }
+
+        next_arrivals[stop_id].append(
+            {
+                "trip_id": trip.trip_id,
+                "route_id": trip.route_id,
+                "route_short_name": route and route.route_short_name,
+                "route_long_name": route and route.route_long_name,
+                "trip_headsign": trip.trip_headsign,
+                "wheelchair_accessible": trip.wheelchair_accessible,
+                "arrival_time": parse_timestamp(stop_time_update["arrival_time"]),
+                "departure_time": parse_timestamp(stop_time_update["departure_time"]),
+                "in_progress": True,
+                "progression": progression,
+            }
+        )
+
+    # ---------------
+    # Scheduled trips
+    # ---------------
+
+    for stop_departure in stop_departures:
+        arrival_time = timezone.localize(
+            datetime.combine(timestamp.date(), stop_departure.arrival_time)
+        )
+        departure_time = timezone.localize(
+            datetime.combine(timestamp.date(), stop_departure.departure_time)
+        )
+
+        next_arrivals[stop_departure.stop_id].append(
+            {
+                "trip_id": stop_departure.trip_id,
+                "route_id": stop_departure.route_id,
+                "route_short_name": stop_departure.route_short_name,
+                "route_long_name": stop_departure.route_long_name,
+                "trip_headsign": stop_departure.trip_headsign,
+                "wheelchair_accessible": stop_departure.wheelchair_accessible,
+                "arrival_time": arrival_time,
+                "departure_time": departure_time,
+                "in_progress": False,
+                "progression": None,
+            }
+        )
+
+    # Sort the lists by arrival time
+    for arrivals in next_arrivals.values():
+        arrivals.sort(key=lambda x: x["arrival_time"])
+
+    return next_arrivals
+
+
 def str_to_timedelta(time_str):
     hours, minutes, seconds = map(int, time_str.split(":"))
     duration = timedelta(hours=hours, minutes=minutes, seconds=seconds)
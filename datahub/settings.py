@@ -134,6 +134,107 @@ CELERY_RESULT_BACKEND = "django-db"
 CELERY_CACHE_BACKEND = "django-cache"
 CELERY_RESULTS_EXTENDED = True
 
+# GTFS Schedule import settings
+
+SCHEDULE_IMPORT_LOADER = config(
+    "SCHEDULE_IMPORT_LOADER", default="orm"
+)  # "orm" (bulk_create) or "copy" (PostgreSQL COPY)
+SCHEDULE_IMPORT_CHUNK_SIZE = config(
+    "SCHEDULE_IMPORT_CHUNK_SIZE", default=50000, cast=int
+)  # Rows read from each table at a time
+SCHEDULE_IMPORT_BATCH_SIZE = config(
+    "SCHEDULE_IMPORT_BATCH_SIZE", default=5000, cast=int
+)  # Rows per INSERT statement
+SCHEDULE_IMPORT_WORKERS = config(
+    "SCHEDULE_IMPORT_WORKERS", default=4, cast=int
+)  # Tables imported at the same time
+SCHEDULE_IMPORT_LOCK_TIMEOUT = config(
+    "SCHEDULE_IMPORT_LOCK_TIMEOUT", default=2 * 60 * 60, cast=int
+)  # Seconds before the lock of a provider's import expires
+DEPARTURE_BOARD_DAYS_AHEAD = config(
+    "DEPARTURE_BOARD_DAYS_AHEAD", default=2, cast=int
+)  # Service days of departures precomputed after today
+
+# GTFS Realtime polling settings
+
+REALTIME_FETCH_TIMEOUT = config(
+    "REALTIME_FETCH_TIMEOUT", default=10, cast=int
+)  # Seconds to wait for a provider
+REALTIME_FETCH_WORKERS = config(
+    "REALTIME_FETCH_WORKERS", default=8, cast=int
+)  # Providers fetched at the same time
+REALTIME_VEHICLE_DELTA_MODE = config(
+    "REALTIME_VEHICLE_DELTA_MODE", default=False, cast=bool
+)  # Save only the vehicle positions that changed
+REALTIME_VEHICLE_DELTA_DISTANCE = config(
+    "REALTIME_VEHICLE_DELTA_DISTANCE", default=20, cast=float
+)  # Meters a vehicle must move to be saved again
+REALTIME_VEHICLE_DELTA_HEARTBEAT = config(
+    "REALTIME_VEHICLE_DELTA_HEARTBEAT", default=300, cast=int
+)  # Seconds after which an unchanged vehicle is saved again
+REALTIME_PARTITION_DAYS_AHEAD = config(
+    "REALTIME_PARTITION_DAYS_AHEAD", default=7, cast=int
+)  # Daily partitions created in advance
+REALTIME_RETENTION_DAYS = config(
+    "REALTIME_RETENTION_DAYS", default=90, cast=int
+)  # Days of realtime data kept
+REALTIME_COMPACTION_TIERS = [
+    tuple(int(value) for value in tier.split(":"))
+    for tier in config("REALTIME_COMPACTION_TIERS", default="3:60,14:300", cast=Csv())
+]  # "days:seconds" tiers, vehicle positions older than days keep one point per seconds
+REALTIME_COMPACTION_WINDOW = config(
+    "REALTIME_COMPACTION_WINDOW", default=60 * 60, cast=int
+)  # Seconds of history compacted per transaction
+REALTIME_COMPACTION_MAX_WINDOWS = config(
+    "REALTIME_COMPACTION_MAX_WINDOWS", default=24, cast=int
+)  # Windows compacted per tier on each run
+REALTIME_STATE_TTL = config(
+    "REALTIME_STATE_TTL", default=10 * 60, cast=int
+)  # Seconds the latest published realtime state stays valid
+REALTIME_STATE_GRACE = config(
+    "REALTIME_STATE_GRACE", default=5, cast=int
+)  # Seconds the replaced realtime state stays for the requests reading it
+REALTIME_POLL_DEFAULT_INTERVAL = config(
+    "REALTIME_POLL_DEFAULT_INTERVAL", default=15, cast=int
+)  # Seconds between updates assumed until a feed's cadence is learned
+REALTIME_POLL_MIN_INTERVAL = config(
+    "REALTIME_POLL_MIN_INTERVAL", default=2, cast=int
+)  # Seconds between polls of a feed whose update is overdue
+REALTIME_POLL_MAX_INTERVAL = config(
+    "REALTIME_POLL_MAX_INTERVAL", default=60, cast=int
+)  # Longest wait between polls of a feed
+REALTIME_POLL_MARGIN = config(
+    "REALTIME_POLL_MARGIN", default=1, cast=float
+)  # Seconds after the expected update of a feed to poll it
+REALTIME_POLL_MAX_BACKOFF = config(
+    "REALTIME_POLL_MAX_BACKOFF", default=5 * 60, cast=int
+)  # Longest wait between polls of a failing feed
+REALTIME_POLL_HISTORY = config(
+    "REALTIME_POLL_HISTORY", default=10, cast=int
+)  # Snapshots used to learn the cadence of a feed
+REALTIME_POLL_LOCK_TIMEOUT = config(
+    "REALTIME_POLL_LOCK_TIMEOUT", default=2 * 60, cast=int
+)  # Seconds before the lock of a feed's poll expires
+REALTIME_ARCHIVE_MODE = config(
+    "REALTIME_ARCHIVE_MODE", default="off"
+)  # "off", "also" (archive and save rows) or "only" (archive instead of rows)
+REALTIME_ARCHIVE_DIR = config(
+    "REALTIME_ARCHIVE_DIR", default=str(BASE_DIR / "archive")
+)  # Directory of the raw snapshot segment files
+REALTIME_ARCHIVE_LEVEL = config(
+    "REALTIME_ARCHIVE_LEVEL", default=3, cast=int
+)  # zstd compression level of the archived snapshots
+
+NEXT_TRIPS_CACHE_TTL = config(
+    "NEXT_TRIPS_CACHE_TTL", default=30, cast=int
+)  # Seconds a stop's next trips are served from the cache at most
+DEPARTURES_MAX_STOPS = config(
+    "DEPARTURES_MAX_STOPS", default=50, cast=int
+)  # Stops of a departures request at most
+RESPONSE_CACHE_WAIT = config(
+    "RESPONSE_CACHE_WAIT", default=2, cast=float
+)  # Seconds a request waits for the same response being built by another
+
 # REST Framework settings
 
 REST_FRAMEWORK = {
@@ -181,3 +282,6 @@ STATICFILES_DIRS = [os.path.join(BASE_DIR, "static")]
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
+
+# Test runner that leaves out the benchmarks unless they are tagged
+TEST_RUNNER = "datahub.test_runner.TestRunner"
@@ -0,0 +1,14 @@
+from django.test.runner import DiscoverRunner
+
+# Tests left out unless they are asked for with --tag
+OPT_IN_TAGS = {"benchmark"}
+
+
+class TestRunner(DiscoverRunner):
+    """Test runner that leaves out the benchmarks, whose wall-clock
+    thresholds depend on the machine, unless they are asked for with
+    ``--tag benchmark``."""
+
+    def __init__(self, *args, tags=None, exclude_tags=None, **kwargs):
+        exclude_tags = set(exclude_tags or []) | (OPT_IN_TAGS - set(tags or []))
+        super().__init__(*args, tags=tags, exclude_tags=exclude_tags, **kwargs)
@@ -1,7 +1,20 @@
 from django.contrib import admin
-from .models import InfoProvider, InfoService
+from .models import (
+    InfoProvider,
+    InfoService,
+    FeedTable,
+    CompactionProgress,
+    ServiceAlert,
+    AlertInformedEntity,
+    DepartureBoard,
+)
 
 # Register your models here.
 
 admin.site.register(InfoProvider)
 admin.site.register(InfoService)
+admin.site.register(FeedTable)
+admin.site.register(CompactionProgress)
+admin.site.register(ServiceAlert)
+admin.site.register(AlertInformedEntity)
+admin.site.register(DepartureBoard)
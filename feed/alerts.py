@@ -0,0 +1,180 @@
+"""Ingestion of GTFS Realtime service alerts and their informed entities."""
+
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import AlertInformedEntity, ServiceAlert
+
+# Kinds of informed entity that alerts are indexed by
+INFORMED_ENTITY_KINDS = ["agency", "route", "trip", "stop"]
+
+
+def enum_name(message, field_name):
+    """Name of the enum value of a field, or None if it is not set."""
+    if not message.HasField(field_name):
+        return None
+    field = message.DESCRIPTOR.fields_by_name[field_name]
+    enum_value = field.enum_type.values_by_number.get(getattr(message, field_name))
+    return enum_value.name if enum_value is not None else None
+
+
+def translated_text(message, field_name):
+    """Text of a TranslatedString in the language of the site, in the one
+    without language or else in the first one."""
+    if not message.HasField(field_name):
+        return ""
+    translations = getattr(message, field_name).translation
+    language = settings.LANGUAGE_CODE.split("-")[0]
+    for translation in translations:
+        if translation.language.split("-")[0] == language:
+            return translation.text
+    for translation in translations:
+        if not translation.language:
+            return translation.text
+    return translations[0].text if translations else ""
+
+
+def decode_service_alerts(service_alerts):
+    """Decode the alerts of a FeedMessage into dicts of ServiceAlert fields,
+    with their active periods and informed entities."""
+    alerts = []
+    for entity in service_alerts.entity:
+        if not entity.HasField("alert"):
+            continue
+        alert = entity.alert
+        alerts.append(
+            {
+                "alert_id": entity.id,
+                "cause": enum_name(alert, "cause"),
+                "effect": enum_name(alert, "effect"),
+                "severity_level": enum_name(alert, "severity_level"),
+                "header_text": translated_text(alert, "header_text"),
+                "description_text": translated_text(alert, "description_text"),
+                "url": translated_text(alert, "url"),
+                "active_periods": [
+                    [
+                        period.start if period.HasField("start") else None,
+                        period.end if period.HasField("end") else None,
+                    ]
+                    for period in alert.active_period
+                ],
+                "informed_entities": [
+                    {
+                        "agency_id": selector.agency_id or None,
+                        "route_id": selector.route_id or None,
+                        "route_type": (
+                            selector.route_type
+                            if selector.HasField("route_type")
+                            else None
+                        ),
+                        "direction_id": (
+                            selector.direction_id
+                            if selector.HasField("direction_id")
+                            else None
+                        ),
+                        "trip_id": selector.trip.trip_id or None,
+                        "stop_id": selector.stop_id or None,
+                    }
+                    for selector in alert.informed_entity
+                ],
+            }
+        )
+    return alerts
+
+
+def is_active(active_periods, at):
+    """Whether an alert is active at a Unix time. An alert without active
+    periods is always active, and a period without start or end is open."""
+    if not active_periods:
+        return True
+    return any(
+        (start is None or start <= at) and (end is None or at < end)
+        for start, end in active_periods
+    )
+
+
+def active_bounds(active_periods):
+    """First start and last end of the active periods, as datetimes, None
+    when open."""
+    starts = [start for start, _ in active_periods]
+    ends = [end for _, end in active_periods]
+    active_from = None
+    if starts and None not in starts:
+        active_from = datetime.fromtimestamp(min(starts), tz=timezone.utc)
+    active_until = None
+    if ends and None not in ends:
+        active_until = datetime.fromtimestamp(max(ends), tz=timezone.utc)
+    return active_from, active_until
+
+
+def save_service_alerts(provider, feed_message, alerts):
+    """Upsert the alerts of a snapshot of a provider and replace their
+    informed entities. The alerts of the provider missing from the snapshot
+    are no longer published and are marked as inactive."""
+    # An alert repeated in the snapshot can only be upserted once, the last
+    # one is kept
+    alerts = list({alert["alert_id"]: alert for alert in alerts}.values())
+    objects = []
+    for alert in alerts:
+        active_from, active_until = active_bounds(alert["active_periods"])
+        objects.append(
+            ServiceAlert(
+                provider=provider,
+                alert_id=alert["alert_id"],
+                feed_message=feed_message,
+                cause=alert["cause"],
+                effect=alert["effect"],
+                severity_level=alert["severity_level"],
+                header_text=alert["header_text"],
+                description_text=alert["description_text"],
+                url=alert["url"],
+                active_periods=alert["active_periods"],
+                active_from=active_from,
+                active_until=active_until,
+                is_published=True,
+            )
+        )
+
+    with transaction.atomic():
+        # The IDs of the inserted and updated rows are set in the objects,
+        # since Django 5.0
+        ServiceAlert.objects.bulk_create(
+            objects,
+            update_conflicts=True,
+            unique_fields=["provider", "alert_id"],
+            update_fields=[
+                "feed_message",
+                "cause",
+                "effect",
+                "severity_level",
+                "header_text",
+                "description_text",
+                "url",
+                "active_periods",
+                "active_from",
+                "active_until",
+                "is_published",
+                "updated_at",
+            ],
+        )
+        ServiceAlert.objects.filter(provider=provider, is_published=True).exclude(
+            alert_id__in=[alert["alert_id"] for alert in alerts]
+        ).update(is_published=False)
+
+        AlertInformedEntity.objects.filter(alert__in=objects).delete()
+        AlertInformedEntity.objects.bulk_create(
+            [
+                AlertInformedEntity(alert=service_alert, **informed_entity)
+                for service_alert, alert in zip(objects, alerts)
+                for informed_entity in alert["informed_entities"]
+            ]
+        )
+
+
+def published_alerts(provider):
+    """Published alerts of a provider with their informed entities."""
+    return ServiceAlert.objects.filter(
+        provider=provider, is_published=True
+    ).prefetch_related("informed_entities")
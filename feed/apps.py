@@ -4,3 +4,13 @@ from django.apps import AppConfig
 class FeedConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "feed"
+
+    def ready(self):
+        from .departures import rebuild_departure_boards
+        from .progression import clear_trip_shapes
+        from .signals import feed_promoted
+        from .state import evict_schedule_responses
+
+        feed_promoted.connect(rebuild_departure_boards)
+        feed_promoted.connect(clear_trip_shapes)
+        feed_promoted.connect(evict_schedule_responses)
@@ -0,0 +1,158 @@
+"""Archive of the raw GTFS Realtime snapshots in compressed segment files.
+
+Each provider feed has one segment per UTC day of header timestamps, in
+``REALTIME_ARCHIVE_DIR/<provider>/<entity_type>/<YYYY-MM-DD>.zst``. Every
+snapshot is appended as its own zstd frame, so the segment is a valid zstd
+stream and any snapshot can be read alone. The ``.idx`` file next to it has
+one fixed size record per snapshot with its header timestamp and the offset
+and size of its frame, in the order they were appended.
+
+Snapshots are written before their index record, so a segment is always read
+up to its last indexed snapshot even if a write was interrupted.
+"""
+
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+import zstandard
+from django.conf import settings
+from google.transit import gtfs_realtime_pb2 as gtfs_rt
+
+# Index record: header timestamp, offset and size of the frame
+INDEX_DTYPE = np.dtype([("timestamp", "<i8"), ("offset", "<u8"), ("size", "<u4")])
+
+
+def segment_day(header_timestamp):
+    return datetime.fromtimestamp(header_timestamp, tz=timezone.utc).date()
+
+
+def segment_path(provider_code, entity_type, day):
+    """Path of the segment of a provider feed for a day, without suffix."""
+    return Path(settings.REALTIME_ARCHIVE_DIR) / provider_code / entity_type / str(day)
+
+
+def read_index(path):
+    """Index records of a segment, empty if it does not exist yet."""
+    index_path = path.with_suffix(".idx")
+    if not index_path.exists():
+        return np.empty(0, dtype=INDEX_DTYPE)
+    # Ignore a partially written last record
+    count = index_path.stat().st_size // INDEX_DTYPE.itemsize
+    return np.fromfile(index_path, dtype=INDEX_DTYPE, count=count)
+
+
+def archive_snapshot(provider_code, entity_type, header_timestamp, content):
+    """Append the raw bytes of a snapshot to its segment.
+
+    Returns False without writing if the segment already has a snapshot as
+    recent, as the snapshots of a feed are archived in order. The caller
+    must hold the lock of the feed, only one process writes each segment.
+    """
+    path = segment_path(provider_code, entity_type, segment_day(header_timestamp))
+    index = read_index(path)
+    if len(index) and index["timestamp"][-1] >= header_timestamp:
+        return False
+
+    frame = zstandard.ZstdCompressor(
+        level=settings.REALTIME_ARCHIVE_LEVEL, write_content_size=True
+    ).compress(content)
+    end = int(index["offset"][-1] + index["size"][-1]) if len(index) else 0
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path.with_suffix(".zst"), "ab") as segment:
+        # Drop what an interrupted write left after the last indexed snapshot
+        segment.truncate(end)
+        segment.write(frame)
+    record = np.array([(header_timestamp, end, len(frame))], dtype=INDEX_DTYPE)
+    with open(path.with_suffix(".idx"), "ab") as index_file:
+        index_file.truncate(len(index) * INDEX_DTYPE.itemsize)
+        index_file.write(record.tobytes())
+    return True
+
+
+def is_archived(provider_code, entity_type, header_timestamp):
+    """Whether a snapshot as recent is already in its segment."""
+    path = segment_path(provider_code, entity_type, segment_day(header_timestamp))
+    index = read_index(path)
+    return bool(len(index)) and index["timestamp"][-1] >= header_timestamp
+
+
+def discard_snapshots(provider_code, entity_type, since):
+    """Remove the archived snapshots of a provider feed with a header
+    timestamp from ``since`` on, deleting the segments left empty."""
+    for day in segment_days(provider_code, entity_type):
+        if day < segment_day(since):
+            continue
+        path = segment_path(provider_code, entity_type, day)
+        index = read_index(path)
+        kept = int(np.searchsorted(index["timestamp"], since, side="left"))
+        if kept == 0:
+            path.with_suffix(".idx").unlink()
+            path.with_suffix(".zst").unlink(missing_ok=True)
+            continue
+        end = int(index["offset"][kept - 1] + index["size"][kept - 1])
+        # The index first, so it never points past the end of the segment
+        with open(path.with_suffix(".idx"), "r+b") as index_file:
+            index_file.truncate(kept * INDEX_DTYPE.itemsize)
+        with open(path.with_suffix(".zst"), "r+b") as segment:
+            segment.truncate(end)
+
+
+def segment_days(provider_code, entity_type):
+    """Days of the segments of a provider feed, in order."""
+    directory = Path(settings.REALTIME_ARCHIVE_DIR) / provider_code / entity_type
+    if not directory.exists():
+        return []
+    return sorted(
+        datetime.strptime(path.stem, "%Y-%m-%d").date()
+        for path in directory.glob("*.idx")
+    )
+
+
+def iter_archive(provider_code, entity_type, start=None, end=None):
+    """Iterate over the archived snapshots of a provider feed with a header
+    timestamp from ``start`` to before ``end`` (Unix times, open if None).
+
+    Yields ``(header_timestamp, content)`` pairs in order, reading one frame
+    at a time, so it can replay any span of history in constant memory.
+    """
+    decompressor = zstandard.ZstdDecompressor()
+    for day in segment_days(provider_code, entity_type):
+        if start is not None and day < segment_day(start):
+            continue
+        if end is not None and day > segment_day(end):
+            break
+        path = segment_path(provider_code, entity_type, day)
+        index = read_index(path)
+        first = 0 if start is None else np.searchsorted(index["timestamp"], start)
+        last = (
+            len(index)
+            if end is None
+            else np.searchsorted(index["timestamp"], end, side="left")
+        )
+        if first >= last:
+            continue
+        with open(path.with_suffix(".zst"), "rb") as segment:
+            segment.seek(int(index["offset"][first]))
+            for record in index[first:last]:
+                frame = segment.read(int(record["size"]))
+                yield int(record["timestamp"]), decompressor.decompress(frame)
+
+
+def iter_feed_messages(provider_code, entity_type, start=None, end=None):
+    """Iterate over the archived snapshots of a provider feed as parsed
+    FeedMessage objects."""
+    for _, content in iter_archive(provider_code, entity_type, start, end):
+        feed_message = gtfs_rt.FeedMessage()
+        feed_message.ParseFromString(content)
+        yield feed_message
+
+
+def read_snapshot(provider_code, entity_type, header_timestamp):
+    """Raw bytes of the archived snapshot with a header timestamp, or None."""
+    for _, content in iter_archive(
+        provider_code, entity_type, header_timestamp, header_timestamp + 1
+    ):
+        return content
+    return None
@@ -0,0 +1,93 @@
+"""Downsampling of the vehicle positions history to coarser resolutions."""
+
+import logging
+from datetime import datetime, timedelta, timezone
+
+from django.apps import apps
+from django.db import connection, transaction
+from django.db.models import Min
+
+from .models import CompactionProgress
+
+# Vehicles are told apart as in the delta filter, by their vehicle ID or by
+# their entity ID when the feed does not give one
+VEHICLE_KEY = ["vehicle_vehicle_id", "entity_id"]
+# Positions of a vehicle in the same bucket of these columns are reduced to one
+COMPACTION_KEYS = [
+    "vehicle_trip_trip_id",
+    "vehicle_trip_route_id",
+]
+
+
+def compact_window(start, end, resolution):
+    """Keep only the last vehicle position of each vehicle, trip and route
+    in every ``resolution`` seconds between ``start`` and ``end``.
+
+    Returns the number of rows deleted.
+    """
+    VehiclePosition = apps.get_model("gtfs", "VehiclePosition")
+    quote = connection.ops.quote_name
+    table = quote(VehiclePosition._meta.db_table)
+    pk = quote(VehiclePosition._meta.pk.column)
+    vehicle = f"coalesce({', '.join(quote(key) for key in VEHICLE_KEY)})"
+    keys = ", ".join([vehicle] + [quote(key) for key in COMPACTION_KEYS])
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"DELETE FROM {table} WHERE {pk} IN ("
+            f"SELECT {pk} FROM ("
+            f"SELECT {pk}, row_number() OVER ("
+            f"PARTITION BY {keys}, "
+            "floor(extract(epoch FROM vehicle_timestamp) / %s) "
+            f"ORDER BY vehicle_timestamp DESC, {pk} DESC) AS position "
+            f"FROM {table} WHERE vehicle_timestamp >= %s AND vehicle_timestamp < %s"
+            ") AS ranked WHERE position > 1)",
+            [resolution, start, end],
+        )
+        return cursor.rowcount
+
+
+def compact_vehicle_positions(tiers, window, max_windows):
+    """Downsample the vehicle positions older than each tier of
+    ``(days, resolution)`` to one point every ``resolution`` seconds.
+
+    The history is processed in windows of ``window`` seconds, each in its
+    own transaction that also saves the progress of the tier, so the job can
+    be stopped at any time and continues where it left off. At most
+    ``max_windows`` windows are processed per tier on each run.
+    """
+    VehiclePosition = apps.get_model("gtfs", "VehiclePosition")
+    now = datetime.now(timezone.utc)
+
+    for days, resolution in tiers:
+        cutoff = now - timedelta(days=days)
+        progress = CompactionProgress.objects.filter(resolution=resolution).first()
+        if progress is None:
+            oldest = VehiclePosition.objects.aggregate(oldest=Min("vehicle_timestamp"))
+            if oldest["oldest"] is None:
+                continue
+            oldest = oldest["oldest"]
+            progress = CompactionProgress(
+                resolution=resolution,
+                compacted_until=oldest
+                - timedelta(seconds=oldest.timestamp() % resolution),
+            )
+
+        # Windows are aligned to the resolution so no bucket is split
+        start = progress.compacted_until
+        deleted = 0
+        for _ in range(max_windows):
+            end = min(start + timedelta(seconds=window), cutoff)
+            end -= timedelta(seconds=end.timestamp() % resolution)
+            if end <= start:
+                break
+            with transaction.atomic():
+                deleted += compact_window(start, end, resolution)
+                progress.compacted_until = end
+                progress.save()
+            start = end
+
+        logging.info(
+            f"Vehicle positions compacted to {resolution} s up to "
+            f"{progress.compacted_until}: {deleted} rows deleted"
+        )
@@ -0,0 +1,228 @@
+"""Departure boards: the scheduled stops of each service day, precomputed per
+feed and stop so the API reads them with one index range scan."""
+
+import logging
+import time
+from datetime import date, timedelta
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connection, transaction
+
+from .models import DepartureBoard, StopDeparture
+
+# Fields of StopDeparture copied from the stop times, trips and routes
+DEPARTURE_FIELDS = [
+    "stop_id",
+    "arrival_time",
+    "departure_time",
+    "stop_sequence",
+    "trip_id",
+    "route_id",
+    "route_short_name",
+    "route_long_name",
+    "trip_headsign",
+    "wheelchair_accessible",
+    "shape_id",
+]
+
+
+def active_services(feed, service_date):
+    """Service IDs of a feed that run on a date, from its calendar and its
+    added and removed dates."""
+    Calendar = apps.get_model("gtfs", "Calendar")
+    CalendarDate = apps.get_model("gtfs", "CalendarDate")
+    weekday = service_date.strftime("%A").lower()
+    services = set(
+        Calendar.objects.filter(
+            feed=feed,
+            start_date__lte=service_date,
+            end_date__gte=service_date,
+            **{weekday: True},
+        ).values_list("service_id", flat=True)
+    )
+    exceptions = CalendarDate.objects.filter(feed=feed, date=service_date)
+    for service_id, exception_type in exceptions.values_list(
+        "service_id", "exception_type"
+    ):
+        if exception_type == 1:  # Service added for the date
+            services.add(service_id)
+        else:
+            services.discard(service_id)
+    return sorted(services)
+
+
+def departures_select(feed, services, stop_ids=None, after=None):
+    """SQL and parameters of a query of the departures of a feed for some
+    services, joining the stop times with their trip and route, in the
+    order of the fields of ``DEPARTURE_FIELDS``. Optionally only at some
+    stops and from a time of the day, by arrival time."""
+    StopTime = apps.get_model("gtfs", "StopTime")
+    Trip = apps.get_model("gtfs", "Trip")
+    Route = apps.get_model("gtfs", "Route")
+
+    def column(model, field_name):
+        return connection.ops.quote_name(model._meta.get_field(field_name).column)
+
+    def table(model):
+        return connection.ops.quote_name(model._meta.db_table)
+
+    selected = {
+        "stop_id": f"st.{column(StopTime, 'stop_id')}",
+        "arrival_time": f"st.{column(StopTime, 'arrival_time')}",
+        "departure_time": f"st.{column(StopTime, 'departure_time')}",
+        "stop_sequence": f"st.{column(StopTime, 'stop_sequence')}",
+        "trip_id": f"t.{column(Trip, 'trip_id')}",
+        "route_id": f"t.{column(Trip, 'route_id')}",
+        "route_short_name": f"r.{column(Route, 'route_short_name')}",
+        "route_long_name": f"r.{column(Route, 'route_long_name')}",
+        "trip_headsign": f"t.{column(Trip, 'trip_headsign')}",
+        "wheelchair_accessible": f"t.{column(Trip, 'wheelchair_accessible')}",
+        "shape_id": f"t.{column(Trip, 'shape_id')}",
+    }
+    assert list(selected) == DEPARTURE_FIELDS
+    trip_join = (
+        f"t.{column(Trip, 'feed')} = st.{column(StopTime, 'feed')} "
+        f"AND t.{column(Trip, 'trip_id')} = st.{column(StopTime, 'trip_id')}"
+    )
+    route_join = (
+        f"r.{column(Route, 'feed')} = t.{column(Trip, 'feed')} "
+        f"AND r.{column(Route, 'route_id')} = t.{column(Trip, 'route_id')}"
+    )
+    sql = (
+        f"SELECT {', '.join(selected.values())} "
+        f"FROM {table(StopTime)} st "
+        f"JOIN {table(Trip)} t ON {trip_join} "
+        f"LEFT JOIN {table(Route)} r ON {route_join} "
+        f"WHERE st.{column(StopTime, 'feed')} = %s "
+        f"AND t.{column(Trip, 'service_id')} = ANY(%s)"
+    )
+    params = [feed.pk, list(services)]
+    if stop_ids is not None:
+        sql += f" AND st.{column(StopTime, 'stop_id')} = ANY(%s)"
+        params.append(list(stop_ids))
+    if after is not None:
+        sql += f" AND st.{column(StopTime, 'arrival_time')} >= %s"
+        params.append(after)
+    return sql, params
+
+
+def build_departure_board(feed, service_date):
+    """Rebuild the departures of a feed on a service day with a single
+    ``INSERT ... SELECT`` joining the stop times with their trip and route.
+
+    Returns the board.
+    """
+
+    def column(field_name):
+        return connection.ops.quote_name(
+            StopDeparture._meta.get_field(field_name).column
+        )
+
+    services = active_services(feed, service_date)
+    start = time.perf_counter()
+    with transaction.atomic():
+        board, _ = DepartureBoard.objects.update_or_create(
+            feed=feed, service_date=service_date, defaults={"services": services}
+        )
+        StopDeparture.objects.filter(board=board).delete()
+
+        select_sql, params = departures_select(feed, services)
+        columns = [column("board")] + [
+            column(field_name) for field_name in DEPARTURE_FIELDS
+        ]
+        table = connection.ops.quote_name(StopDeparture._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} "
+                f"({', '.join(columns)}) "
+                f"SELECT %s, departures.* FROM ({select_sql}) departures",
+                [board.pk] + params,
+            )
+            rows = cursor.rowcount
+
+    logging.info(
+        f"Departure board of {feed.pk} on {service_date} built: {rows} departures "
+        f"in {time.perf_counter() - start:.1f} s"
+    )
+    return board
+
+
+def board_window(days_ahead, today=None):
+    """Service days that have departure boards: from yesterday, whose trips
+    can run past midnight, to ``days_ahead`` days ahead."""
+    today = today or date.today()
+    first_day = today - timedelta(days=1)
+    return [first_day + timedelta(days=day) for day in range(days_ahead + 2)]
+
+
+def get_departure_board(feed, service_date):
+    """Departure board of a feed on a service day.
+
+    Days outside the boards that are kept, or not built yet, get a board
+    that is not saved, whose departures are queried from the stop times.
+    Nothing is written, so it is safe for the requests of the API.
+    """
+    if service_date in board_window(settings.DEPARTURE_BOARD_DAYS_AHEAD):
+        board = DepartureBoard.objects.filter(
+            feed=feed, service_date=service_date
+        ).first()
+        if board is not None:
+            return board
+        logging.warning(f"Departure board of {feed.pk} on {service_date} missing")
+    return DepartureBoard(
+        feed=feed,
+        service_date=service_date,
+        services=active_services(feed, service_date),
+    )
+
+
+def get_stop_departures(board, stop_ids, after):
+    """Departures of a board at some stops from a time of the day, by
+    arrival time. The departures of a board that is not saved are queried
+    with their trip and route, as unsaved ``StopDeparture`` objects."""
+    if board.pk is not None:
+        return list(
+            StopDeparture.objects.filter(
+                board=board, stop_id__in=stop_ids, arrival_time__gte=after
+            ).order_by("arrival_time")
+        )
+    if not board.services:
+        return []
+    sql, params = departures_select(board.feed, board.services, stop_ids, after)
+    with connection.cursor() as cursor:
+        cursor.execute(f"{sql} ORDER BY 2", params)
+        return [
+            StopDeparture(**dict(zip(DEPARTURE_FIELDS, row)))
+            for row in cursor.fetchall()
+        ]
+
+
+def roll_departure_boards(days_ahead, today=None):
+    """Build the departure boards of the current feeds from yesterday, whose
+    trips can run past midnight, to ``days_ahead`` days ahead, and delete the
+    boards of other days and of the feeds that are no longer current."""
+    Feed = apps.get_model("gtfs", "Feed")
+    service_dates = board_window(days_ahead, today)
+
+    for feed in Feed.objects.filter(is_current=True):
+        built = set(
+            DepartureBoard.objects.filter(
+                feed=feed, service_date__in=service_dates
+            ).values_list("service_date", flat=True)
+        )
+        for service_date in service_dates:
+            if service_date not in built:
+                build_departure_board(feed, service_date)
+
+    # The departures of the boards are deleted without loading them
+    (
+        DepartureBoard.objects.exclude(feed__is_current=True)
+        | DepartureBoard.objects.exclude(service_date__in=service_dates)
+    ).delete()
+
+
+def rebuild_departure_boards(sender, feed, **kwargs):
+    """Build the departure boards of a feed that became current, from
+    ``feed_promoted``."""
+    roll_departure_boards(settings.DEPARTURE_BOARD_DAYS_AHEAD)
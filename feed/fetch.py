@@ -0,0 +1,82 @@
+"""Concurrent HTTP fetching of GTFS Realtime feeds."""
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from .locks import get_redis
+
+
+@lru_cache(maxsize=None)
+def get_session():
+    """Return the HTTP session of this process, which keeps the connections
+    to each host alive between polls."""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=settings.REALTIME_FETCH_WORKERS,
+        pool_maxsize=settings.REALTIME_FETCH_WORKERS,
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def validators_key(url):
+    return f"validators:{url}"
+
+
+def fetch(url, timeout=None):
+    """Fetch a URL with the pooled session, raising on HTTP errors.
+
+    The request is conditional on the validators saved with
+    ``save_validators``, so the response is a 304 with no content when the
+    feed did not change since it was last saved.
+    """
+    headers = {}
+    validators = get_redis().hgetall(validators_key(url))
+    if b"etag" in validators:
+        headers["If-None-Match"] = validators[b"etag"].decode()
+    if b"last_modified" in validators:
+        headers["If-Modified-Since"] = validators[b"last_modified"].decode()
+
+    response = get_session().get(
+        url, headers=headers, timeout=timeout or settings.REALTIME_FETCH_TIMEOUT
+    )
+    response.raise_for_status()
+    return response
+
+
+def save_validators(url, response):
+    """Save the ETag and Last-Modified of a response once its content has been
+    stored, for the next request to the same URL to be conditional."""
+    validators = {}
+    if "ETag" in response.headers:
+        validators["etag"] = response.headers["ETag"]
+    if "Last-Modified" in response.headers:
+        validators["last_modified"] = response.headers["Last-Modified"]
+    if validators:
+        get_redis().hset(validators_key(url), mapping=validators)
+
+
+def fetch_all(urls, timeout=None):
+    """Fetch all the URLs of a dict at the same time.
+
+    Returns a dict with the same keys and the response of each URL, or the
+    ``requests.RequestException`` raised while fetching it.
+    """
+
+    def fetch_or_error(url):
+        try:
+            return fetch(url, timeout=timeout)
+        except requests.RequestException as e:
+            return e
+
+    if not urls:
+        return {}
+    workers = min(len(urls), settings.REALTIME_FETCH_WORKERS)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        responses = executor.map(fetch_or_error, urls.values())
+        return dict(zip(urls.keys(), responses))
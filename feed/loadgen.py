@@ -0,0 +1,188 @@
+"""Local stand-in of a GTFS Realtime provider, to benchmark the ingestion.
+
+``FeedServer`` serves the VehiclePositions and TripUpdates of a source over
+HTTP, with a new snapshot every ``update_interval`` seconds and support for
+conditional requests, like the feeds of the providers. The source is either
+``SyntheticFeed``, a fleet of vehicles moving around a point, or
+``RecordedFeed``, the snapshots kept in the realtime archive.
+"""
+
+import math
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from google.transit import gtfs_realtime_pb2 as gtfs_rt
+
+from .archive import iter_archive
+
+# Paths of the feeds served and their entity type
+FEED_PATHS = {
+    "/vehicle_positions.pb": "vehicle",
+    "/trip_updates.pb": "trip_update",
+}
+
+
+def feed_header(feed_message, header_timestamp):
+    feed_message.header.gtfs_realtime_version = "2.0"
+    feed_message.header.incrementality = gtfs_rt.FeedHeader.FULL_DATASET
+    feed_message.header.timestamp = header_timestamp
+
+
+class SyntheticFeed:
+    """Fleet of ``fleet_size`` vehicles driving in circles around a point,
+    each one on its own trip with ``stops_per_trip`` stop time updates."""
+
+    def __init__(
+        self,
+        fleet_size,
+        stops_per_trip=20,
+        latitude=9.9356,
+        longitude=-84.0508,
+        seconds_per_stop=120,
+    ):
+        self.fleet_size = fleet_size
+        self.stops_per_trip = stops_per_trip
+        self.latitude = latitude
+        self.longitude = longitude
+        self.seconds_per_stop = seconds_per_stop
+        self.start = datetime.now()
+
+    def trip(self, trip_descriptor, vehicle):
+        trip_descriptor.trip_id = f"bench-trip-{vehicle}"
+        trip_descriptor.route_id = f"bench-route-{vehicle % 50}"
+        trip_descriptor.start_date = self.start.strftime("%Y%m%d")
+        trip_descriptor.start_time = self.start.strftime("%H:%M:%S")
+
+    def stop_sequence(self, vehicle, header_timestamp):
+        elapsed = header_timestamp - self.start.timestamp() + vehicle
+        return int(elapsed // self.seconds_per_stop) % self.stops_per_trip + 1
+
+    def snapshot(self, entity_type, header_timestamp):
+        feed_message = gtfs_rt.FeedMessage()
+        feed_header(feed_message, header_timestamp)
+        for vehicle in range(self.fleet_size):
+            entity = feed_message.entity.add()
+            entity.id = f"bench-{vehicle}"
+            stop_sequence = self.stop_sequence(vehicle, header_timestamp)
+            if entity_type == "vehicle":
+                position = entity.vehicle
+                self.trip(position.trip, vehicle)
+                position.vehicle.id = f"bench-vehicle-{vehicle}"
+                angle = (header_timestamp / 600 + vehicle) % (2 * math.pi)
+                radius = 0.01 + 0.05 * vehicle / max(self.fleet_size, 1)
+                position.position.latitude = self.latitude + radius * math.sin(angle)
+                position.position.longitude = self.longitude + radius * math.cos(angle)
+                position.current_stop_sequence = stop_sequence
+                position.current_status = gtfs_rt.VehiclePosition.IN_TRANSIT_TO
+                position.timestamp = header_timestamp
+            else:
+                trip_update = entity.trip_update
+                self.trip(trip_update.trip, vehicle)
+                trip_update.vehicle.id = f"bench-vehicle-{vehicle}"
+                trip_update.timestamp = header_timestamp
+                for sequence in range(stop_sequence, self.stops_per_trip + 1):
+                    stop_time_update = trip_update.stop_time_update.add()
+                    stop_time_update.stop_sequence = sequence
+                    stop_time_update.stop_id = f"bench-stop-{sequence}"
+                    arrival = header_timestamp + (
+                        (sequence - stop_sequence + 1) * self.seconds_per_stop
+                    )
+                    stop_time_update.arrival.time = arrival
+                    stop_time_update.departure.time = arrival + 30
+        return feed_message.SerializeToString()
+
+
+class RecordedFeed:
+    """Snapshots of a provider from the realtime archive, served in order
+    with their header timestamp moved to the time they are served."""
+
+    def __init__(self, provider_code, start=None, end=None):
+        self.snapshots = {
+            entity_type: iter_archive(provider_code, entity_type, start, end)
+            for entity_type in FEED_PATHS.values()
+        }
+
+    def snapshot(self, entity_type, header_timestamp):
+        try:
+            _, content = next(self.snapshots[entity_type])
+        except StopIteration:
+            return None
+        feed_message = gtfs_rt.FeedMessage()
+        feed_message.ParseFromString(content)
+        feed_message.header.timestamp = header_timestamp
+        return feed_message.SerializeToString()
+
+
+class FeedServer(ThreadingHTTPServer):
+    """HTTP server of the snapshots of a source, run in a background thread.
+
+    The snapshot served changes every ``update_interval`` seconds, and the
+    requests with the ETag of the current one get a 304 response.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, source, update_interval, host="127.0.0.1", port=0):
+        super().__init__((host, port), FeedRequestHandler)
+        self.source = source
+        self.update_interval = update_interval
+        self.start = time.time()
+        self.snapshots = {}  # entity type -> (version, content)
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+    def url(self, entity_type):
+        path = next(path for path, feed in FEED_PATHS.items() if feed == entity_type)
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}{path}"
+
+    def current_snapshot(self, entity_type):
+        """Version and content of the snapshot being served, built when the
+        first request after an update arrives. The content is None when a
+        recorded source has no more snapshots."""
+        version = int((time.time() - self.start) // self.update_interval)
+        with self.lock:
+            if self.snapshots.get(entity_type, (None,))[0] != version:
+                header_timestamp = int(self.start + version * self.update_interval)
+                self.snapshots[entity_type] = (
+                    version,
+                    self.source.snapshot(entity_type, header_timestamp),
+                )
+            return self.snapshots[entity_type]
+
+
+class FeedRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        entity_type = FEED_PATHS.get(self.path)
+        if entity_type is None:
+            self.send_error(404)
+            return
+        version, content = self.server.current_snapshot(entity_type)
+        if content is None:
+            self.send_error(404, "No more recorded snapshots")
+            return
+        etag = f'"{entity_type}-{int(self.server.start)}-{version}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-protobuf")
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass  # Keep the benchmark output readable
@@ -0,0 +1,32 @@
+"""Locks shared by all Celery workers, stored in Redis."""
+
+from contextlib import contextmanager
+from functools import lru_cache
+
+import redis
+from django.conf import settings
+
+
+@lru_cache(maxsize=None)
+def get_redis():
+    """Return the Redis client of this process."""
+    return redis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT)
+
+
+@contextmanager
+def task_lock(name, timeout):
+    """Try to take the lock ``name`` without waiting for it.
+
+    Yields True if the lock was taken, and releases it on exit. The lock
+    expires after ``timeout`` seconds in case the worker dies holding it.
+    """
+    lock = get_redis().lock(f"lock:{name}", timeout=timeout, blocking=False)
+    acquired = lock.acquire()
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            try:
+                lock.release()
+            except redis.exceptions.LockError:
+                pass  # The lock expired and may belong to another worker now
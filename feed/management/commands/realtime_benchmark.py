@@ -0,0 +1,248 @@
+import statistics
+import time
+from datetime import datetime, timezone
+
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from google.transit import gtfs_realtime_pb2 as gtfs_rt
+
+from feed.archive import discard_snapshots
+from feed.fetch import fetch, validators_key
+from feed.loadgen import FeedServer, RecordedFeed, SyntheticFeed
+from feed.locks import get_redis
+from feed.polling import poll_key
+from feed.realtime import vehicle_states_key
+from feed.stages import collect_stages, stage
+from feed.state import CURRENT_KEY, DIGESTS_KEY
+from feed.tasks import REALTIME_FEEDS
+from gtfs.models import (
+    FeedMessage,
+    GTFSProvider,
+    StopTimeUpdate,
+    TripUpdate,
+    VehiclePosition,
+)
+
+# Tables written by the ingestion of each feed, counted by provider
+WRITTEN_TABLES = {
+    "FeedMessage": (FeedMessage, "provider"),
+    "VehiclePosition": (VehiclePosition, "feed_message__provider"),
+    "TripUpdate": (TripUpdate, "feed_message__provider"),
+    "StopTimeUpdate": (StopTimeUpdate, "feed_message__provider"),
+}
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the GTFS Realtime ingestion against a local stand-in of a "
+        "provider serving synthetic or recorded feeds"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--fleet-size",
+            type=int,
+            default=1000,
+            help="Vehicles in the synthetic feeds",
+        )
+        parser.add_argument(
+            "--stops-per-trip",
+            type=int,
+            default=20,
+            help="Stops of each trip in the synthetic feeds",
+        )
+        parser.add_argument(
+            "--replay",
+            metavar="PROVIDER_CODE",
+            help="Serve the archived snapshots of a provider instead",
+        )
+        parser.add_argument(
+            "--update-interval",
+            type=float,
+            default=15,
+            help="Seconds between the snapshots served",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=15,
+            help="Seconds between the polls of the feeds",
+        )
+        parser.add_argument(
+            "--duration",
+            type=float,
+            default=60,
+            help="Seconds to run the benchmark",
+        )
+        parser.add_argument(
+            "--feeds",
+            nargs="+",
+            choices=["vehicle", "trip_update"],
+            default=["vehicle", "trip_update"],
+            help="Feeds to ingest",
+        )
+        parser.add_argument(
+            "--provider-code",
+            default="benchmark",
+            help="Code of the provider that the benchmark data is saved with",
+        )
+        parser.add_argument(
+            "--keep",
+            action="store_true",
+            help="Keep the rows written by the benchmark",
+        )
+
+    def handle(self, *args, **options):
+        if options["replay"]:
+            source = RecordedFeed(options["replay"])
+        else:
+            source = SyntheticFeed(options["fleet_size"], options["stops_per_trip"])
+
+        provider = GTFSProvider.objects.filter(code=options["provider_code"]).first()
+        if provider is not None and provider.is_active:
+            raise CommandError(
+                f"{provider.code} is an active provider, use another --provider-code"
+            )
+
+        # Whole seconds, like the header timestamp of the first snapshot
+        started_at = datetime.now(tz=timezone.utc).replace(microsecond=0)
+        with FeedServer(source, options["update_interval"]) as server:
+            provider, created = GTFSProvider.objects.update_or_create(
+                code=options["provider_code"],
+                defaults={
+                    "name": "Benchmark",
+                    "timezone": settings.TIME_ZONE,
+                    "vehicle_positions_url": server.url("vehicle"),
+                    "trip_updates_url": server.url("trip_update"),
+                    "is_active": False,
+                },
+            )
+            rows_before = self.count_rows(provider)
+            self.stdout.write(
+                f"Serving feeds at {server.url('vehicle')} and "
+                f"{server.url('trip_update')}, polling for {options['duration']} s"
+            )
+            try:
+                timings, polls, snapshots, entities, overruns, elapsed = self.run(
+                    provider, options
+                )
+            finally:
+                rows_written = {
+                    table: rows - rows_before[table]
+                    for table, rows in self.count_rows(provider).items()
+                }
+                # The live API would merge the published state of the provider
+                self.clear_redis(provider)
+                if not options["keep"]:
+                    for entity_type in REALTIME_FEEDS:
+                        discard_snapshots(
+                            provider.code, entity_type, started_at.timestamp()
+                        )
+                    # Snapshots are served with header timestamps from now on
+                    FeedMessage.objects.filter(
+                        provider=provider, timestamp__gte=started_at
+                    ).delete()
+                    if created:
+                        provider.delete()
+
+        self.report(
+            timings, polls, snapshots, entities, overruns, elapsed, rows_written
+        )
+
+    def run(self, provider, options):
+        """Poll and ingest the feeds of the stand-in until the end of the
+        benchmark, timing each stage."""
+        polls = snapshots = entities = overruns = 0
+        header_timestamps = {}
+        start = time.perf_counter()
+        end = start + options["duration"]
+        with collect_stages() as timings:
+            while time.perf_counter() < end:
+                poll_start = time.perf_counter()
+                for entity_type in options["feeds"]:
+                    ingest, url_field = REALTIME_FEEDS[entity_type]
+                    try:
+                        with stage("fetch"):
+                            response = fetch(getattr(provider, url_field))
+                    except requests.HTTPError:
+                        raise CommandError("The recorded snapshots ran out")
+                    with stage(f"total {entity_type}"):
+                        header_timestamp = ingest(provider, response)
+                    polls += 1
+                    # Count only the snapshots that were new
+                    last_header_timestamp = header_timestamps.get(entity_type)
+                    if header_timestamp not in (None, last_header_timestamp):
+                        header_timestamps[entity_type] = header_timestamp
+                        snapshots += 1
+                        feed_message = gtfs_rt.FeedMessage()
+                        feed_message.ParseFromString(response.content)
+                        entities += len(feed_message.entity)
+                poll_time = time.perf_counter() - poll_start
+                if poll_time > options["poll_interval"]:
+                    overruns += 1
+                time.sleep(max(0, options["poll_interval"] - poll_time))
+        elapsed = time.perf_counter() - start
+        return timings, polls, snapshots, entities, overruns, elapsed
+
+    def clear_redis(self, provider):
+        """Delete the realtime state, polling state, validators and vehicle
+        states of the provider from Redis."""
+        redis = get_redis()
+        keys = [vehicle_states_key(provider)]
+        for entity_type, (_, url_field) in REALTIME_FEEDS.items():
+            redis.hdel(CURRENT_KEY.format(entity_type=entity_type), provider.code)
+            keys.append(
+                DIGESTS_KEY.format(entity_type=entity_type, provider_code=provider.code)
+            )
+            keys.append(poll_key(provider.code, entity_type))
+            url = getattr(provider, url_field)
+            if url:
+                keys.append(validators_key(url))
+        keys.extend(redis.scan_iter(match=f"realtime:{provider.code}:*"))
+        redis.delete(*keys)
+
+    def count_rows(self, provider):
+        return {
+            table: model.objects.filter(**{field: provider}).count()
+            for table, (model, field) in WRITTEN_TABLES.items()
+        }
+
+    def report(
+        self, timings, polls, snapshots, entities, overruns, elapsed, rows_written
+    ):
+        self.stdout.write(
+            f"\n{polls} polls, {snapshots} new snapshots, {entities} entities "
+            f"in {elapsed:.1f} s, {overruns} polls longer than the poll interval"
+        )
+        ingest_time = sum(
+            sum(values) for name, values in timings.items() if name.startswith("total")
+        )
+        if ingest_time:
+            self.stdout.write(
+                f"Throughput: {entities / ingest_time:.0f} entities/s, "
+                f"{snapshots / ingest_time:.2f} snapshots/s of ingest time"
+            )
+
+        self.stdout.write("\nStage latency (ms):")
+        self.stdout.write(
+            f"{'stage':<22}{'runs':>6}{'p50':>10}{'p95':>10}{'max':>10}{'mean':>10}"
+        )
+        for name, values in sorted(timings.items()):
+            self.stdout.write(
+                f"{name:<22}{len(values):>6}"
+                f"{percentile(values, 0.5) * 1000:>10.1f}"
+                f"{percentile(values, 0.95) * 1000:>10.1f}"
+                f"{max(values) * 1000:>10.1f}"
+                f"{statistics.mean(values) * 1000:>10.1f}"
+            )
+
+        self.stdout.write("\nRows written:")
+        for table, rows in rows_written.items():
+            self.stdout.write(f"{table:<22}{rows:>10}")
+        self.stdout.write(self.style.SUCCESS("\nBenchmark finished"))
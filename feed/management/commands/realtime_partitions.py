@@ -0,0 +1,41 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from feed.partitions import (
+    PARTITION_COLUMN,
+    REALTIME_PARTITIONS,
+    convert_tables,
+    maintain_partitions,
+)
+
+
+class Command(BaseCommand):
+    help = "Partition the GTFS Realtime tables by day and apply their retention"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--convert",
+            action="store_true",
+            help="Convert the realtime tables that are not partitioned yet",
+        )
+        parser.add_argument(
+            "--days-ahead",
+            type=int,
+            default=settings.REALTIME_PARTITION_DAYS_AHEAD,
+            help="Days of future partitions to create",
+        )
+        parser.add_argument(
+            "--retention-days",
+            type=int,
+            default=settings.REALTIME_RETENTION_DAYS,
+            help="Days of data to keep before dropping a partition",
+        )
+
+    def handle(self, *args, **options):
+        if options["convert"]:
+            convert_tables()
+            self.stdout.write(
+                f"{', '.join(REALTIME_PARTITIONS)} partitioned by {PARTITION_COLUMN}"
+            )
+        maintain_partitions(options["days_ahead"], options["retention_days"])
+        self.stdout.write(self.style.SUCCESS("Realtime partitions are up to date"))
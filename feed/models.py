@@ -34,3 +34,133 @@ class InfoService(models.Model):
 
     def __str__(self):
         return self.name
+
+
+class FeedTable(models.Model):
+    """Tables imported from each GTFS Schedule feed, with the hash of their
+    content to detect which ones changed in the next feed"""
+
+    feed = models.ForeignKey("gtfs.Feed", on_delete=models.CASCADE)
+    table_name = models.CharField(max_length=50)
+    content_hash = models.CharField(max_length=64)
+    rows = models.PositiveIntegerField(default=0)
+    carried_from = models.ForeignKey(
+        "gtfs.Feed",
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        related_name="+",
+    )
+
+    class Meta:
+        unique_together = ("feed", "table_name")
+
+    def __str__(self):
+        return f"{self.feed_id}: {self.table_name}"
+
+
+class CompactionProgress(models.Model):
+    """Point up to which the vehicle positions history has been downsampled
+    to each resolution"""
+
+    resolution = models.PositiveIntegerField(unique=True)  # Seconds per point
+    compacted_until = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.resolution} s: {self.compacted_until}"
+
+
+class ServiceAlert(models.Model):
+    """Latest version of each GTFS Realtime service alert of a provider"""
+
+    provider = models.ForeignKey("gtfs.GTFSProvider", on_delete=models.CASCADE)
+    alert_id = models.CharField(max_length=255)  # Entity ID in the feed
+    feed_message = models.ForeignKey(
+        "gtfs.FeedMessage", null=True, blank=True, on_delete=models.SET_NULL
+    )
+    cause = models.CharField(max_length=50, null=True, blank=True)
+    effect = models.CharField(max_length=50, null=True, blank=True)
+    severity_level = models.CharField(max_length=50, null=True, blank=True)
+    header_text = models.TextField(blank=True)
+    description_text = models.TextField(blank=True)
+    url = models.TextField(blank=True)
+    # [start, end] Unix times, None when open
+    active_periods = models.JSONField(default=list, blank=True)
+    active_from = models.DateTimeField(null=True, blank=True)
+    active_until = models.DateTimeField(null=True, blank=True)
+    is_published = models.BooleanField(default=True)  # Still in the feed
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("provider", "alert_id")
+
+    def __str__(self):
+        return f"{self.provider_id}: {self.alert_id}"
+
+
+class AlertInformedEntity(models.Model):
+    """Agency, route, trip or stop affected by a service alert, all the set
+    fields must match"""
+
+    alert = models.ForeignKey(
+        ServiceAlert, on_delete=models.CASCADE, related_name="informed_entities"
+    )
+    agency_id = models.CharField(max_length=255, null=True, blank=True)
+    route_id = models.CharField(max_length=255, null=True, blank=True)
+    route_type = models.PositiveIntegerField(null=True, blank=True)
+    direction_id = models.PositiveIntegerField(null=True, blank=True)
+    trip_id = models.CharField(max_length=255, null=True, blank=True)
+    stop_id = models.CharField(max_length=255, null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["agency_id"]),
+            models.Index(fields=["route_id"]),
+            models.Index(fields=["trip_id"]),
+            models.Index(fields=["stop_id"]),
+        ]
+
+    def __str__(self):
+        return f"{self.alert}"
+
+
+class DepartureBoard(models.Model):
+    """Service day of a GTFS Schedule feed whose departures are precomputed
+    in ``StopDeparture``"""
+
+    feed = models.ForeignKey("gtfs.Feed", on_delete=models.CASCADE)
+    service_date = models.DateField()
+    services = models.JSONField(default=list)  # Service IDs active that day
+    built_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("feed", "service_date")
+
+    def __str__(self):
+        return f"{self.feed_id}: {self.service_date}"
+
+
+class StopDeparture(models.Model):
+    """Scheduled stop of a trip on the service day of a departure board, with
+    its trip and route already joined"""
+
+    board = models.ForeignKey(DepartureBoard, on_delete=models.CASCADE)
+    stop_id = models.CharField(max_length=255)
+    arrival_time = models.TimeField(null=True, blank=True)
+    departure_time = models.TimeField(null=True, blank=True)
+    stop_sequence = models.PositiveIntegerField(null=True, blank=True)
+    trip_id = models.CharField(max_length=255)
+    route_id = models.CharField(max_length=255, null=True, blank=True)
+    route_short_name = models.CharField(max_length=255, null=True, blank=True)
+    route_long_name = models.CharField(max_length=255, null=True, blank=True)
+    trip_headsign = models.CharField(max_length=255, null=True, blank=True)
+    wheelchair_accessible = models.PositiveIntegerField(null=True, blank=True)
+    shape_id = models.CharField(max_length=255, null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["board", "stop_id", "arrival_time"]),
+        ]
+
+    def __str__(self):
+        return f"{self.board}: {self.stop_id} {self.arrival_time} {self.trip_id}"
@@ -0,0 +1,307 @@
+"""Range partitioning by day of the GTFS Realtime tables.
+
+Old data is removed by dropping whole partitions instead of deleting rows,
+which leaves no dead tuples to vacuum.
+
+All the tables are partitioned on the same column, ``saved_at``, which
+defaults to the start of the transaction. The ingest saves a FeedMessage and
+all its rows in one transaction, so they share the same value and always go
+to partitions of the same day, which are dropped together. The column is
+added by the conversion and unknown to the models, which leave it to its
+default.
+
+There is no default partition: the ingest creates the partitions of the day
+before saving, in case the scheduled maintenance did not run.
+"""
+
+import logging
+import re
+from datetime import datetime, time, timedelta, timezone
+
+from django.apps import apps
+from django.db import DatabaseError, connection, transaction
+
+# Realtime models of the gtfs app, partitioned in this order
+REALTIME_PARTITIONS = [
+    "FeedMessage",
+    "VehiclePosition",
+    "TripUpdate",
+    "StopTimeUpdate",
+]
+PARTITION_COLUMN = "saved_at"
+
+PARTITION_NAME = re.compile(r"_p(\d{8})$")
+
+# Days whose partitions this process already made sure exist
+ensured_days = set()
+
+
+def quote(name):
+    return connection.ops.quote_name(name)
+
+
+def day_start(day):
+    return datetime.combine(day, time(), tzinfo=timezone.utc)
+
+
+def is_partitioned(cursor, table):
+    cursor.execute(
+        "SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass",
+        [table],
+    )
+    return cursor.fetchone() is not None
+
+
+def get_partitions(cursor, table):
+    """Return the names and bound expressions of the partitions of a table."""
+    cursor.execute(
+        "SELECT child.relname, pg_get_expr(child.relpartbound, child.oid) "
+        "FROM pg_inherits "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE pg_inherits.inhparent = %s::regclass",
+        [table],
+    )
+    return dict(cursor.fetchall())
+
+
+def convert_tables():
+    """Partition all the realtime tables in one transaction, so their
+    legacy partitions end on the same day."""
+    with transaction.atomic():
+        for model_name in REALTIME_PARTITIONS:
+            convert_table(model_name)
+
+
+def convert_table(model_name):
+    """Turn a realtime table into a table partitioned by day on
+    ``saved_at``.
+
+    The existing table becomes the partition "<table>_legacy", with all its
+    rows saved at the time of the conversion, up to the end of that day. The
+    primary key must include the partition column, so it becomes (pk,
+    saved_at), and the foreign keys that reference the table are dropped
+    (partitions are dropped without cascading anyway; the ORM relations keep
+    working). An identity primary key becomes a column numbered by a
+    sequence of the new table, since partitions cannot have identity columns.
+    The other indexes are created again on the new table, and unique ones
+    include the partition column, as PostgreSQL requires.
+    """
+    model = apps.get_model("gtfs", model_name)
+    table = model._meta.db_table
+    legacy = f"{table}_legacy"
+    pk = model._meta.pk.column
+    column = PARTITION_COLUMN
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        if is_partitioned(cursor, table):
+            logging.info(f"{table} is already partitioned")
+            return
+
+        # Foreign keys that reference this table
+        cursor.execute(
+            "SELECT conrelid::regclass::text, conname FROM pg_constraint "
+            "WHERE contype = 'f' AND confrelid = %s::regclass",
+            [table],
+        )
+        for referencing_table, constraint in cursor.fetchall():
+            cursor.execute(
+                f"ALTER TABLE {referencing_table} DROP CONSTRAINT {quote(constraint)}"
+            )
+            logging.info(f"Dropped foreign key {constraint} of {referencing_table}")
+
+        # The existing rows are saved now, as far as the partitions are concerned
+        cursor.execute(
+            f"ALTER TABLE {quote(table)} ADD COLUMN {quote(column)} "
+            "timestamp with time zone NOT NULL DEFAULT now()"
+        )
+        cursor.execute("SELECT now()")
+        now = cursor.fetchone()[0]
+        legacy_end = day_start(now.astimezone(timezone.utc).date()) + timedelta(days=1)
+
+        # Indexes and unique constraints of the table, other than the primary key
+        cursor.execute(
+            "SELECT indexrelid, indisunique, indnkeyatts, amname, "
+            "pg_get_expr(indpred, indrelid) FROM pg_index "
+            "JOIN pg_class ON pg_class.oid = pg_index.indexrelid "
+            "JOIN pg_am ON pg_am.oid = pg_class.relam "
+            "WHERE indrelid = %s::regclass AND NOT indisprimary "
+            "AND NOT indisexclusion",
+            [table],
+        )
+        indexes = []
+        for index, unique, key_count, method, predicate in cursor.fetchall():
+            # Key columns or expressions, with their operator class if it is
+            # not the default one, like the "_like" indexes of Django
+            cursor.execute(
+                "SELECT pg_get_indexdef(indexrelid, key_number, true), "
+                "CASE WHEN opcdefault THEN '' ELSE ' ' || quote_ident(opcname) END "
+                "FROM pg_index, generate_series(1, %s) AS key_number, pg_opclass "
+                "WHERE indexrelid = %s AND pg_opclass.oid = indclass[key_number - 1] "
+                "ORDER BY key_number",
+                [key_count, index],
+            )
+            keys = [key + operator_class for key, operator_class in cursor.fetchall()]
+            if unique and column not in keys:
+                keys.append(quote(column))
+            indexes.append((unique, method, keys, predicate))
+
+        cursor.execute(f"ALTER TABLE {quote(table)} RENAME TO {quote(legacy)}")
+        cursor.execute(
+            f"CREATE TABLE {quote(table)} (LIKE {quote(legacy)} "
+            "INCLUDING DEFAULTS INCLUDING CONSTRAINTS) "
+            f"PARTITION BY RANGE ({quote(column)})"
+        )
+        cursor.execute(
+            f"ALTER TABLE {quote(table)} ADD PRIMARY KEY ({quote(pk)}, {quote(column)})"
+        )
+
+        # Keep numbering the primary key after the existing rows
+        cursor.execute(
+            "SELECT attidentity FROM pg_attribute "
+            "WHERE attrelid = %s::regclass AND attname = %s",
+            [legacy, pk],
+        )
+        if cursor.fetchone()[0]:
+            # A partition may not have an identity column, so the identity of
+            # the old table is replaced by a sequence of the new one
+            cursor.execute(
+                f"ALTER TABLE {quote(legacy)} ALTER COLUMN {quote(pk)} DROP IDENTITY"
+            )
+            sequence = quote(f"{table}_{pk}_seq")
+            cursor.execute(
+                f"CREATE SEQUENCE {sequence} OWNED BY {quote(table)}.{quote(pk)}"
+            )
+            cursor.execute(
+                f"SELECT setval(%s, coalesce(max({quote(pk)}), 0) + 1, false) "
+                f"FROM {quote(legacy)}",
+                [sequence],
+            )
+            cursor.execute(
+                f"ALTER TABLE {quote(table)} ALTER COLUMN {quote(pk)} "
+                "SET DEFAULT nextval(%s::regclass)",
+                [sequence],
+            )
+        else:
+            # Serial columns keep the sequence of the old table
+            cursor.execute("SELECT pg_get_serial_sequence(%s, %s)", [legacy, pk])
+            sequence = cursor.fetchone()[0]
+            if sequence:
+                cursor.execute(
+                    f"ALTER SEQUENCE {sequence} OWNED BY {quote(table)}.{quote(pk)}"
+                )
+
+        cursor.execute(
+            f"ALTER TABLE {quote(table)} ATTACH PARTITION {quote(legacy)} "
+            "FOR VALUES FROM (MINVALUE) TO (%s)",
+            [legacy_end],
+        )
+        # Indexes of the new table are created on every partition too
+        cursor.execute(f"CREATE INDEX ON {quote(table)} ({quote(column)})")
+        for unique, method, keys, predicate in indexes:
+            cursor.execute(
+                f"CREATE {'UNIQUE ' if unique else ''}INDEX ON {quote(table)} "
+                f"USING {method} ({', '.join(keys)})"
+                + (f" WHERE {predicate}" if predicate else "")
+            )
+
+    logging.info(f"{table} partitioned by {column}, old rows in {legacy}")
+
+
+def create_partitions(model_name, days_ahead, today=None):
+    """Create the daily partitions of a table from today up to ``days_ahead``
+    days in the future, after the legacy partition if there is one."""
+    table = apps.get_model("gtfs", model_name)._meta.db_table
+    today = today or datetime.now(timezone.utc).date()
+
+    with connection.cursor() as cursor:
+        if not is_partitioned(cursor, table):
+            return []
+        partitions = get_partitions(cursor, table)
+        first_day = today
+        legacy_bound = partitions.get(f"{table}_legacy")
+        if legacy_bound:
+            legacy_end = re.search(r"TO \('([^']+)'\)", legacy_bound)
+            if legacy_end:
+                legacy_end = datetime.fromisoformat(legacy_end.group(1))
+                first_day = max(first_day, legacy_end.astimezone(timezone.utc).date())
+
+        created = []
+        for offset in range((first_day - today).days, days_ahead + 1):
+            day = today + timedelta(days=offset)
+            partition = f"{table}_p{day:%Y%m%d}"
+            if partition in partitions:
+                continue
+            cursor.execute(
+                f"CREATE TABLE {quote(partition)} PARTITION OF {quote(table)} "
+                "FOR VALUES FROM (%s) TO (%s)",
+                [day_start(day), day_start(day + timedelta(days=1))],
+            )
+            created.append(partition)
+    return created
+
+
+def ensure_partitions(today=None):
+    """Create the partitions of today of all the partitioned realtime tables
+    if they are missing, before saving realtime rows.
+
+    Only the first call of each day queries the database. A partition created
+    by another process at the same time is logged and checked again on the
+    next call.
+    """
+    today = today or datetime.now(timezone.utc).date()
+    if today in ensured_days:
+        return
+    for model_name in REALTIME_PARTITIONS:
+        try:
+            with transaction.atomic():
+                for partition in create_partitions(model_name, 0, today):
+                    logging.warning(f"Partition {partition} created by the ingest")
+        except DatabaseError:
+            logging.exception(f"Partitions of {model_name} on {today} not created")
+            return
+    ensured_days.add(today)
+
+
+def drop_expired_partitions(model_name, retention_days):
+    """Drop the partitions of a table whose days are all older than
+    ``retention_days``, including the legacy partition once it expires."""
+    table = apps.get_model("gtfs", model_name)._meta.db_table
+    cutoff = datetime.now(timezone.utc).date() - timedelta(days=retention_days)
+
+    with connection.cursor() as cursor:
+        if not is_partitioned(cursor, table):
+            return []
+        dropped = []
+        for partition, bound in get_partitions(cursor, table).items():
+            if partition == f"{table}_legacy":
+                end = re.search(r"TO \('([^']+)'\)", bound)
+                expired = end and datetime.fromisoformat(end.group(1)).date() <= cutoff
+            else:
+                day = PARTITION_NAME.search(partition)
+                expired = (
+                    day
+                    and datetime.strptime(day.group(1), "%Y%m%d").date()
+                    + timedelta(days=1)
+                    <= cutoff
+                )
+            if expired:
+                cursor.execute(f"DROP TABLE {quote(partition)}")
+                dropped.append(partition)
+    return dropped
+
+
+def maintain_partitions(days_ahead, retention_days):
+    """Create the upcoming partitions and drop the expired ones of all the
+    partitioned realtime tables. A failure on one table is logged and does
+    not stop the others."""
+    for model_name in REALTIME_PARTITIONS:
+        try:
+            with transaction.atomic():
+                created = create_partitions(model_name, days_ahead)
+                dropped = drop_expired_partitions(model_name, retention_days)
+        except Exception:
+            logging.exception(f"Partition maintenance of {model_name} failed")
+            continue
+        logging.info(
+            f"{model_name}: {len(created)} partitions created, {len(dropped)} dropped"
+        )
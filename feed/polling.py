@@ -0,0 +1,111 @@
+"""Adaptive polling of the GTFS Realtime feeds of each provider.
+
+The state of each feed is kept in Redis: the header timestamp of its last
+snapshot, the recent intervals between snapshots and how late the snapshots
+are seen, the consecutive errors and the time of its next poll.
+"""
+
+import json
+import statistics
+import time
+
+from django.conf import settings
+from redis.exceptions import WatchError
+
+from .locks import get_redis
+
+
+def poll_key(provider_code, entity_type):
+    return f"poll:{entity_type}:{provider_code}"
+
+
+def claim_poll(provider_code, entity_type, now=None):
+    """Whether the next poll of a feed is due, in which case it is postponed
+    until the poll records its result, or the lock of the poll expires if the
+    worker dies before."""
+    now = time.time() if now is None else now
+    key = poll_key(provider_code, entity_type)
+    # Only one of the concurrent dispatchers gets the poll
+    with get_redis().pipeline() as pipeline:
+        try:
+            pipeline.watch(key)
+            next_poll_at = pipeline.hget(key, "next_poll_at")
+            if next_poll_at is not None and float(next_poll_at) > now:
+                return False
+            pipeline.multi()
+            pipeline.hset(
+                key, "next_poll_at", now + settings.REALTIME_POLL_LOCK_TIMEOUT
+            )
+            pipeline.execute()
+        except WatchError:
+            return False
+    return True
+
+
+def next_poll_time(state, now):
+    """Time of the next poll of a feed, just after its next expected update.
+
+    The update interval is the median of the recent intervals between header
+    timestamps, and the clocks of the provider and the server are matched with
+    the smallest recent delay between a header timestamp and the poll that
+    saw it. When the update is overdue the feed is polled again after the
+    minimum interval, and the next poll is never later than the maximum
+    interval.
+    """
+    if state["errors"]:
+        backoff = settings.REALTIME_POLL_MIN_INTERVAL * 2 ** state["errors"]
+        return now + min(backoff, settings.REALTIME_POLL_MAX_BACKOFF)
+
+    next_poll_at = now + settings.REALTIME_POLL_MIN_INTERVAL
+    if state["header_timestamp"] is not None and state["delays"]:
+        interval = (
+            statistics.median(state["intervals"])
+            if state["intervals"]
+            else settings.REALTIME_POLL_DEFAULT_INTERVAL
+        )
+        expected_at = (
+            state["header_timestamp"]
+            + interval
+            + min(state["delays"])
+            + settings.REALTIME_POLL_MARGIN
+        )
+        next_poll_at = max(next_poll_at, expected_at)
+    return min(next_poll_at, now + settings.REALTIME_POLL_MAX_INTERVAL)
+
+
+def record_poll(provider_code, entity_type, header_timestamp=None, error=False):
+    """Record the result of a poll of a feed: the header timestamp of the
+    snapshot fetched, None if the feed was not modified, or an error.
+
+    Returns the time of the next poll.
+    """
+    now = time.time()
+    key = poll_key(provider_code, entity_type)
+    redis = get_redis()
+    saved = redis.hget(key, "state")
+    state = (
+        json.loads(saved)
+        if saved
+        else {"header_timestamp": None, "intervals": [], "delays": [], "errors": 0}
+    )
+
+    if error:
+        state["errors"] += 1
+    else:
+        state["errors"] = 0
+        last_header_timestamp = state["header_timestamp"]
+        if header_timestamp is not None and header_timestamp != last_header_timestamp:
+            # A new snapshot, learn the cadence of the feed
+            history = settings.REALTIME_POLL_HISTORY
+            if (
+                last_header_timestamp is not None
+                and header_timestamp > last_header_timestamp
+            ):
+                interval = header_timestamp - last_header_timestamp
+                state["intervals"] = (state["intervals"] + [interval])[-history:]
+            state["delays"] = (state["delays"] + [now - header_timestamp])[-history:]
+            state["header_timestamp"] = header_timestamp
+
+    next_poll_at = next_poll_time(state, now)
+    redis.hset(key, mapping={"state": json.dumps(state), "next_poll_at": next_poll_at})
+    return next_poll_at
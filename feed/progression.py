@@ -0,0 +1,71 @@
+"""Progression of the vehicles along the shapes of their trips, computed for
+a whole snapshot at ingest so the API only reads a number."""
+
+import numpy as np
+import pandas as pd
+import shapely
+from django.apps import apps
+
+from .schedule import provider_feeds
+
+# Feed ID and shapes of the trips of the current feed of each provider, loaded
+# once per process and feed
+provider_shapes = {}
+
+
+def load_trip_shapes(feed_id):
+    """Shape of each trip of a feed as a shapely line, by trip ID."""
+    GeoShape = apps.get_model("gtfs", "GeoShape")
+    Trip = apps.get_model("gtfs", "Trip")
+    shape_ids, geometries = [], []
+    for shape_id, geometry in GeoShape.objects.filter(feed_id=feed_id).values_list(
+        "shape_id", "geometry"
+    ):
+        shape_ids.append(shape_id)
+        geometries.append(bytes(geometry.wkb))
+    lines = dict(zip(shape_ids, shapely.from_wkb(geometries)))
+    return {
+        trip_id: lines[shape_id]
+        for trip_id, shape_id in Trip.objects.filter(feed_id=feed_id).values_list(
+            "trip_id", "shape_id"
+        )
+        if shape_id in lines
+    }
+
+
+def trip_shapes(provider, feed_id):
+    """Shapes of the trips of the current feed of a provider, by trip ID,
+    kept for every provider whatever their number."""
+    cached = provider_shapes.get(provider.code)
+    if cached is None or cached[0] != feed_id:
+        cached = provider_shapes[provider.code] = (feed_id, load_trip_shapes(feed_id))
+    return cached[1]
+
+
+def clear_trip_shapes(sender, feed, **kwargs):
+    """Forget the shapes loaded for previous feeds, from ``feed_promoted``."""
+    provider_shapes.clear()
+
+
+def vehicle_progression(provider, vehicle_positions_df):
+    """Position of each vehicle along the shape of its trip in the current
+    feed of the provider, as a fraction of its length, in one vectorized
+    pass. NaN where the trip, its shape or the position is unknown."""
+    progression = pd.Series(np.nan, index=vehicle_positions_df.index)
+    trip_ids = vehicle_positions_df.get("vehicle_trip_trip_id")
+    if trip_ids is None or vehicle_positions_df.empty:
+        return progression
+    feed = provider_feeds(provider).filter(is_current=True).first()
+    if feed is None:
+        return progression
+
+    lines = trip_ids.map(trip_shapes(provider, feed.pk))
+    longitudes = vehicle_positions_df["vehicle_position_longitude"]
+    latitudes = vehicle_positions_df["vehicle_position_latitude"]
+    located = lines.notna() & longitudes.notna() & latitudes.notna()
+    if located.any():
+        points = shapely.points(longitudes[located], latitudes[located])
+        progression[located] = shapely.line_locate_point(
+            lines[located].to_numpy(), points, normalized=True
+        )
+    return progression
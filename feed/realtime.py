@@ -0,0 +1,340 @@
+"""Decoding of GTFS Realtime feed messages into columns."""
+
+import json
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from django.apps import apps
+from django.conf import settings
+from django.db.models.functions import Coalesce
+
+from .locks import get_redis
+
+
+def is_repeated(field):
+    """Whether a protobuf field is repeated, in old and new protobuf versions."""
+    if hasattr(field, "is_repeated"):
+        return field.is_repeated
+    return field.label == field.LABEL_REPEATED
+
+
+def flatten_message(message, prefix, columns, index, size):
+    """Write the fields set in a message into the column arrays, at position
+    ``index``, with the names that ``pd.json_normalize(sep="_")`` would give.
+
+    Enums are stored by name, like ``json_format.MessageToJson`` does, and
+    repeated fields and extensions are skipped.
+    """
+    for field, value in message.ListFields():
+        if field.is_extension or is_repeated(field):
+            continue
+        name = f"{prefix}_{field.name}" if prefix else field.name
+        if field.type == field.TYPE_MESSAGE:
+            flatten_message(value, name, columns, index, size)
+            continue
+        if field.type == field.TYPE_ENUM:
+            enum_value = field.enum_type.values_by_number.get(value)
+            value = enum_value.name if enum_value is not None else value
+        column = columns.get(name)
+        if column is None:
+            column = columns[name] = [None] * size
+        column[index] = value
+
+
+def decode_entities(message, entity_field):
+    """Decode the entities of a FeedMessage that have ``entity_field`` set in
+    a single pass, into a dict of column arrays of the same length."""
+    entities = [entity for entity in message.entity if entity.HasField(entity_field)]
+    size = len(entities)
+    columns = {"entity_id": [entity.id for entity in entities]}
+    for index, entity in enumerate(entities):
+        flatten_message(
+            getattr(entity, entity_field), entity_field, columns, index, size
+        )
+    return columns
+
+
+def decode_trip_updates(trip_updates):
+    """Decode the trip updates of a FeedMessage and all their stop time
+    updates in a single pass.
+
+    Returns two dicts of column arrays. The stop time updates have the column
+    "trip_update_index" with the position of their trip update.
+    """
+    trip_update_columns = decode_entities(trip_updates, "trip_update")
+    entities = [
+        entity for entity in trip_updates.entity if entity.HasField("trip_update")
+    ]
+    size = sum(len(entity.trip_update.stop_time_update) for entity in entities)
+    stop_time_update_columns = {"trip_update_index": [None] * size}
+    index = 0
+    for trip_update_index, entity in enumerate(entities):
+        for stop_time_update in entity.trip_update.stop_time_update:
+            stop_time_update_columns["trip_update_index"][index] = trip_update_index
+            flatten_message(stop_time_update, "", stop_time_update_columns, index, size)
+            index += 1
+    return trip_update_columns, stop_time_update_columns
+
+
+def get_column(df, name):
+    """Return a column of the DataFrame, or an empty one if it is missing."""
+    if name in df.columns:
+        return df[name]
+    return pd.Series(None, index=df.index, dtype="object")
+
+
+def vehicle_positions_frame(vehicle_positions, feed_message):
+    """Build the DataFrame of VehiclePosition rows of a FeedMessage."""
+    vehicle_positions_df = pd.DataFrame(decode_entities(vehicle_positions, "vehicle"))
+    if vehicle_positions_df.empty:
+        return vehicle_positions_df
+    vehicle_positions_df["feed_message"] = feed_message
+
+    # Fix entity timestamp
+    vehicle_positions_df["vehicle_timestamp"] = pd.to_datetime(
+        vehicle_positions_df["vehicle_timestamp"].astype("int64"), unit="s", utc=True
+    )
+    # Fix trip start date
+    vehicle_positions_df["vehicle_trip_start_date"] = pd.to_datetime(
+        get_column(vehicle_positions_df, "vehicle_trip_start_date"), format="%Y%m%d"
+    ).fillna(pd.Timestamp(datetime.now().date()))
+    # Fix trip start time
+    vehicle_positions_df["vehicle_trip_start_time"] = pd.to_timedelta(
+        get_column(vehicle_positions_df, "vehicle_trip_start_time")
+    ).fillna(pd.Timedelta(0))
+    # Fix trip direction
+    vehicle_positions_df["vehicle_trip_direction_id"] = get_column(
+        vehicle_positions_df, "vehicle_trip_direction_id"
+    ).fillna(-1)
+    # Fix current stop sequence
+    vehicle_positions_df["vehicle_current_stop_sequence"] = get_column(
+        vehicle_positions_df, "vehicle_current_stop_sequence"
+    ).fillna(-1)
+    # Create vehicle position point, with the shortest representation of the
+    # 32-bit coordinates
+    vehicle_positions_df["vehicle_position_point"] = (
+        "POINT ("
+        + vehicle_positions_df["vehicle_position_longitude"]
+        .astype("float32")
+        .astype(str)
+        + " "
+        + vehicle_positions_df["vehicle_position_latitude"]
+        .astype("float32")
+        .astype(str)
+        + ")"
+    )
+    return vehicle_positions_df
+
+
+# Columns of the trip updates DataFrame saved in each TripUpdate field
+TRIP_UPDATE_FIELDS = {
+    "entity_id": "entity_id",
+    "trip_update_trip_trip_id": "trip_trip_id",
+    "trip_update_trip_route_id": "trip_route_id",
+    "trip_update_trip_direction_id": "trip_direction_id",
+    "trip_update_trip_start_time": "trip_start_time",
+    "trip_update_trip_start_date": "trip_start_date",
+    "trip_update_trip_schedule_relationship": "trip_schedule_relationship",
+    "trip_update_vehicle_id": "vehicle_id",
+    "trip_update_vehicle_label": "vehicle_label",
+    "trip_update_timestamp": "timestamp",
+}
+
+
+def trip_updates_frames(trip_updates, feed_message):
+    """Build the DataFrames of TripUpdate and StopTimeUpdate rows of a
+    FeedMessage, with the columns named as the model fields.
+
+    The stop time updates keep the "trip_update_index" column with the row of
+    their trip update.
+    """
+    trip_update_columns, stop_time_update_columns = decode_trip_updates(trip_updates)
+    trip_updates_df = pd.DataFrame(trip_update_columns)
+    stop_time_updates_df = pd.DataFrame(stop_time_update_columns)
+    now = datetime.now()
+
+    # Fix entity timestamp
+    trip_updates_df["trip_update_timestamp"] = pd.to_datetime(
+        get_column(trip_updates_df, "trip_update_timestamp")
+        .fillna(int(now.timestamp()))
+        .astype("int64"),
+        unit="s",
+        utc=True,
+    )
+    # Fix trip start date
+    trip_updates_df["trip_update_trip_start_date"] = pd.to_datetime(
+        get_column(trip_updates_df, "trip_update_trip_start_date"), format="%Y%m%d"
+    ).fillna(pd.Timestamp(now.date()))
+    # Fix trip start time
+    trip_updates_df["trip_update_trip_start_time"] = pd.to_timedelta(
+        get_column(trip_updates_df, "trip_update_trip_start_time")
+    ).fillna(pd.Timedelta(0))
+    # Fix trip direction
+    trip_updates_df["trip_update_trip_direction_id"] = get_column(
+        trip_updates_df, "trip_update_trip_direction_id"
+    ).fillna(-1)
+
+    trip_updates_df = pd.DataFrame(
+        {
+            field: get_column(trip_updates_df, column)
+            for column, field in TRIP_UPDATE_FIELDS.items()
+        }
+    )
+    trip_updates_df["feed_message"] = feed_message
+
+    # Fix arrival and departure times
+    for event in ["arrival", "departure"]:
+        if f"{event}_time" in stop_time_updates_df.columns:
+            stop_time_updates_df[f"{event}_time"] = pd.to_datetime(
+                stop_time_updates_df[f"{event}_time"]
+                .fillna(int(now.timestamp()))
+                .astype("int64"),
+                unit="s",
+                utc=True,
+            )
+        # Fix uncertainty and delay
+        for column in [f"{event}_uncertainty", f"{event}_delay"]:
+            if column in stop_time_updates_df.columns:
+                stop_time_updates_df[column] = stop_time_updates_df[column].fillna(0)
+    stop_time_updates_df["feed_message"] = feed_message
+
+    return trip_updates_df, stop_time_updates_df
+
+
+# Fields of a vehicle whose change is saved in delta mode
+VEHICLE_STATE_COLUMNS = {
+    "vehicle_timestamp": "timestamp",
+    "vehicle_position_latitude": "latitude",
+    "vehicle_position_longitude": "longitude",
+    "vehicle_current_stop_sequence": "current_stop_sequence",
+    "vehicle_current_status": "current_status",
+    "vehicle_occupancy_status": "occupancy_status",
+}
+
+EARTH_RADIUS = 6371008.8  # Mean radius in meters
+
+
+def distance(latitude_1, longitude_1, latitude_2, longitude_2):
+    """Haversine distance in meters between arrays of coordinates in degrees."""
+    latitude_1, longitude_1, latitude_2, longitude_2 = (
+        np.radians(np.asarray(array, dtype="float64"))
+        for array in (latitude_1, longitude_1, latitude_2, longitude_2)
+    )
+    a = (
+        np.sin((latitude_2 - latitude_1) / 2) ** 2
+        + np.cos(latitude_1)
+        * np.cos(latitude_2)
+        * np.sin((longitude_2 - longitude_1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def vehicle_keys(vehicle_positions_df):
+    """Identify each vehicle by its ID, or by its entity ID if it has none."""
+    return (
+        get_column(vehicle_positions_df, "vehicle_vehicle_id")
+        .fillna(vehicle_positions_df["entity_id"])
+        .astype(str)
+    )
+
+
+def vehicle_states_key(provider):
+    return f"vehicle-states:{provider.code}"
+
+
+def vehicle_states_frame(vehicle_positions_df):
+    """Build the states of the vehicles to compare with the next snapshots,
+    indexed by vehicle."""
+    states = pd.DataFrame(
+        {
+            state: get_column(vehicle_positions_df, column)
+            for column, state in VEHICLE_STATE_COLUMNS.items()
+        }
+    )
+    states["timestamp"] = states["timestamp"].map(lambda t: int(t.timestamp()))
+    states.index = vehicle_keys(vehicle_positions_df)
+    return states
+
+
+def changed_vehicle_positions(provider, vehicle_positions_df, min_distance, heartbeat):
+    """Keep only the vehicle positions that changed since the last saved state
+    of each vehicle.
+
+    A vehicle is saved when it reports a new timestamp and it moved at least
+    ``min_distance`` meters, changed its stop sequence, status or occupancy,
+    or was last saved more than ``heartbeat`` seconds before. Vehicles seen
+    for the first time are always saved. So the latest row of each vehicle is
+    its latest state, and the state at any time is in its last row no older
+    than ``heartbeat`` seconds.
+    """
+    if vehicle_positions_df.empty:
+        return vehicle_positions_df
+    current = vehicle_states_frame(vehicle_positions_df)
+    saved = get_redis().hmget(vehicle_states_key(provider), list(current.index))
+    last = pd.DataFrame(
+        [json.loads(state) if state else {} for state in saved],
+        index=current.index,
+        columns=list(VEHICLE_STATE_COLUMNS.values()),
+    )
+
+    def differs(state):
+        return ~(
+            (current[state] == last[state])
+            | (current[state].isna() & last[state].isna())
+        )
+
+    is_new = last["timestamp"].isna()
+    has_new_timestamp = current["timestamp"] != last["timestamp"]
+    moved = (
+        distance(
+            last["latitude"],
+            last["longitude"],
+            current["latitude"],
+            current["longitude"],
+        )
+        >= min_distance
+    )
+    changed = (
+        moved
+        | differs("current_stop_sequence")
+        | differs("current_status")
+        | differs("occupancy_status")
+        | (current["timestamp"] - last["timestamp"] >= heartbeat)
+    )
+    keep = is_new | (has_new_timestamp & changed)
+    return vehicle_positions_df[keep.to_numpy()]
+
+
+def save_vehicle_states(provider, vehicle_positions_df):
+    """Save the state of the vehicle positions stored in the database."""
+    if vehicle_positions_df.empty:
+        return
+    states = vehicle_states_frame(vehicle_positions_df)
+    get_redis().hset(
+        vehicle_states_key(provider),
+        mapping={
+            key: json.dumps(state, default=str)
+            for key, state in zip(states.index, states.to_dict(orient="records"))
+        },
+    )
+
+
+def vehicle_positions_at(provider, at, heartbeat=None):
+    """Return the state of each vehicle of a provider at a given time: its
+    last row no older than ``heartbeat`` seconds, which also works for the
+    rows saved in delta mode. Use the current time for the latest state.
+    """
+    VehiclePosition = apps.get_model("gtfs", "VehiclePosition")
+    heartbeat = heartbeat or settings.REALTIME_VEHICLE_DELTA_HEARTBEAT
+    return (
+        VehiclePosition.objects.filter(
+            feed_message__provider=provider,
+            vehicle_timestamp__lte=at,
+            vehicle_timestamp__gt=at - timedelta(seconds=heartbeat),
+        )
+        # The same key as vehicle_keys, so vehicles without ID stay apart
+        .annotate(vehicle_key=Coalesce("vehicle_vehicle_id", "entity_id"))
+        .order_by("vehicle_key", "-vehicle_timestamp")
+        .distinct("vehicle_key")
+    )
@@ -0,0 +1,423 @@
+"""Import of GTFS Schedule tables into the database."""
+
+import hashlib
+import io
+import logging
+import mmap
+import re
+import tempfile
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
+import pandas as pd
+import requests
+from django.apps import apps
+from django.conf import settings
+from django.db import connection, connections, transaction
+from django.db.models.fields import AutoFieldMixin
+
+from .models import FeedTable
+from .signals import feed_promoted
+
+# Tables of a GTFS Schedule feed and their models in the gtfs app
+SCHEDULE_TABLES = {
+    "agency": "Agency",
+    "stops": "Stop",
+    "shapes": "Shape",
+    "calendar": "Calendar",
+    "calendar_dates": "CalendarDate",
+    "routes": "Route",
+    "trips": "Trip",
+    "stop_times": "StopTime",
+    "feed_info": "FeedInfo",
+}
+
+# Tables that must be loaded before each table
+SCHEDULE_DEPENDENCIES = {
+    "agency": [],
+    "stops": [],
+    "shapes": [],
+    "calendar": [],
+    "calendar_dates": [],
+    "routes": ["agency"],
+    "trips": ["routes", "calendar", "calendar_dates", "shapes"],
+    "stop_times": ["trips", "stops"],
+    "feed_info": [],
+}
+
+INTEGER_TYPES = {
+    "IntegerField",
+    "BigIntegerField",
+    "SmallIntegerField",
+    "PositiveIntegerField",
+    "PositiveBigIntegerField",
+    "PositiveSmallIntegerField",
+}
+
+FLOAT_TYPES = {"FloatField", "DecimalField"}
+
+DOWNLOAD_BLOCK_SIZE = 1024 * 1024  # Bytes written to disk at a time
+HASH_BLOCK_SIZE = 1024 * 1024  # Bytes decompressed at a time to hash a table
+
+
+def download_feed(schedule_url, timeout=60):
+    """Stream the zip file of a feed to an anonymous temporary file, so that
+    the compressed feed is never held in memory.
+
+    Returns the open temporary file, which is deleted when closed.
+    """
+    schedule_file = tempfile.TemporaryFile(suffix=".zip")
+    try:
+        with requests.get(schedule_url, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            for block in response.iter_content(chunk_size=DOWNLOAD_BLOCK_SIZE):
+                schedule_file.write(block)
+        schedule_file.flush()
+    except Exception:
+        schedule_file.close()
+        raise
+    return schedule_file
+
+
+def content_tag(schedule_file):
+    """Weak ETag of the content of a downloaded feed, for the servers that do
+    not send an ETag."""
+    digest = hashlib.blake2b(digest_size=8)
+    schedule_file.seek(0)
+    for block in iter(lambda: schedule_file.read(DOWNLOAD_BLOCK_SIZE), b""):
+        digest.update(block)
+    schedule_file.seek(0)
+    return f'W/"{digest.hexdigest()}"'
+
+
+class MappedFile(io.RawIOBase):
+    """Read-only, seekable file object over a memory map."""
+
+    def __init__(self, mapping):
+        self.mapping = mapping
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self.mapping.seek(offset, whence)
+        return self.mapping.tell()
+
+    def tell(self):
+        return self.mapping.tell()
+
+    def readinto(self, buffer):
+        data = self.mapping.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+
+@contextmanager
+def open_feed_zip(schedule_file):
+    """Open a downloaded feed as a zip file backed by a memory map of the file.
+
+    The members are decompressed lazily from the mapping as they are read, and
+    the pages of the mapping are managed by the OS page cache instead of the
+    Python heap.
+    """
+    with mmap.mmap(schedule_file.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+        with zipfile.ZipFile(MappedFile(mapping)) as schedule_zip:
+            yield schedule_zip
+
+
+def get_table_model(table_name):
+    """Return the model of the gtfs app where a schedule table is stored."""
+    return apps.get_model("gtfs", SCHEDULE_TABLES[table_name])
+
+
+def hash_table(schedule_zip, file):
+    """Return the SHA-256 hex digest of the decompressed content of a table."""
+    digest = hashlib.sha256()
+    with schedule_zip.open(file) as table:
+        while block := table.read(HASH_BLOCK_SIZE):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_table_chunks(schedule_zip, file, columns, chunk_size):
+    """Read a table of the feed as an iterator of DataFrames of at most
+    ``chunk_size`` rows, keeping only the given columns."""
+    return pd.read_csv(
+        schedule_zip.open(file),
+        dtype=str,
+        keep_default_na=False,
+        na_values="",
+        usecols=lambda column: column in columns,
+        chunksize=chunk_size,
+    )
+
+
+def orm_load(chunks, model, feed, batch_size):
+    """Save the rows with ``Model(**row)`` and ``bulk_create``."""
+    rows = 0
+    for chunk in chunks:
+        objects = [model(feed=feed, **row) for row in chunk.to_dict(orient="records")]
+        model.objects.bulk_create(objects, batch_size=batch_size)
+        rows += len(objects)
+    return rows
+
+
+def coerce_chunk(chunk, fields):
+    """Convert the GTFS text values of a chunk to the input formats of
+    PostgreSQL for the type of each column."""
+    for column in chunk.columns:
+        internal_type = fields[column].get_internal_type()
+        if internal_type == "DateField":
+            chunk[column] = pd.to_datetime(
+                chunk[column], format="%Y%m%d", errors="coerce"
+            ).dt.strftime("%Y-%m-%d")
+        elif internal_type == "BooleanField":
+            chunk[column] = chunk[column].str.strip().map({"1": "t", "0": "f"})
+        elif internal_type in INTEGER_TYPES:
+            chunk[column] = pd.to_numeric(chunk[column], errors="coerce").astype(
+                "Int64"
+            )
+        elif internal_type in FLOAT_TYPES:
+            chunk[column] = pd.to_numeric(chunk[column], errors="coerce")
+    return chunk
+
+
+def copy_load(chunks, model, feed, batch_size):
+    """Save the rows with ``COPY ... FROM STDIN``, one statement per chunk.
+
+    This skips the creation of model instances, so ``save()`` is not called
+    and fields not present in the file only get their Python defaults.
+    """
+    fields = {field.name: field for field in model._meta.concrete_fields}
+    feed_field = model._meta.get_field("feed")
+    defaults = {
+        field.name: field.get_default()
+        for field in fields.values()
+        if field.has_default() and not isinstance(field, AutoFieldMixin)
+    }
+
+    rows = 0
+    with transaction.atomic(), connection.cursor() as cursor:
+        for chunk in chunks:
+            chunk = coerce_chunk(chunk, fields)
+            for name, default in defaults.items():
+                if name not in chunk.columns:
+                    chunk[name] = default
+            columns = [fields[name].column for name in chunk.columns]
+            chunk[feed_field.column] = feed.pk
+            columns.append(feed_field.column)
+
+            buffer = io.StringIO()
+            chunk.to_csv(buffer, index=False, header=False)
+            buffer.seek(0)
+            cursor.copy_expert(
+                "COPY {} ({}) FROM STDIN WITH (FORMAT csv)".format(
+                    connection.ops.quote_name(model._meta.db_table),
+                    ", ".join(connection.ops.quote_name(c) for c in columns),
+                ),
+                buffer,
+            )
+            rows += len(chunk)
+    return rows
+
+
+SCHEDULE_LOADERS = {
+    "orm": orm_load,
+    "copy": copy_load,
+}
+
+
+def import_table(
+    schedule_zip, table_name, feed, loader=None, chunk_size=None, batch_size=None
+):
+    """Import a table of the feed in chunks, so that the memory used does not
+    depend on the size of the table.
+
+    The ``loader`` is one of ``SCHEDULE_LOADERS``: "orm" builds model
+    instances and "copy" streams the rows with PostgreSQL ``COPY``.
+
+    Returns the number of rows imported.
+    """
+    loader = loader or settings.SCHEDULE_IMPORT_LOADER
+    chunk_size = chunk_size or settings.SCHEDULE_IMPORT_CHUNK_SIZE
+    batch_size = batch_size or settings.SCHEDULE_IMPORT_BATCH_SIZE
+
+    if loader == "copy" and connection.vendor != "postgresql":
+        logging.warning("COPY is only available in PostgreSQL, using the ORM.")
+        loader = "orm"
+
+    file = f"{table_name}.txt"
+    model = get_table_model(table_name)
+    fields = {field.name for field in model._meta.concrete_fields} - {"feed"}
+
+    start = time.perf_counter()
+    chunks = read_table_chunks(schedule_zip, file, fields, chunk_size)
+    rows = SCHEDULE_LOADERS[loader](chunks, model, feed, batch_size)
+    elapsed = time.perf_counter() - start
+
+    logging.info(
+        f"{file} imported successfully with {loader}: {rows} rows in {elapsed:.1f} s "
+        f"({rows / max(elapsed, 1e-6):.0f} rows/s)"
+    )
+    return rows
+
+
+def carry_table(table_name, source_feed, feed):
+    """Copy the rows of an unchanged table from a previous feed with a single
+    ``INSERT ... SELECT`` in the database, without parsing the file again.
+
+    Only the columns that an import fills are copied: the relations to other
+    rows are left for the new feed to set, like in ``import_table``.
+
+    Returns the number of rows copied.
+    """
+    model = get_table_model(table_name)
+    feed_column = model._meta.get_field("feed").column
+    columns = [
+        connection.ops.quote_name(field.column)
+        for field in model._meta.concrete_fields
+        if not field.is_relation and not isinstance(field, AutoFieldMixin)
+    ]
+    table = connection.ops.quote_name(model._meta.db_table)
+    feed_column = connection.ops.quote_name(feed_column)
+
+    start = time.perf_counter()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {table} ({', '.join(columns)}, {feed_column}) "
+            f"SELECT {', '.join(columns)}, %s FROM {table} WHERE {feed_column} = %s",
+            [feed.pk, source_feed.pk],
+        )
+        rows = cursor.rowcount
+    elapsed = time.perf_counter() - start
+
+    logging.info(
+        f"{table_name}.txt unchanged, carried forward from {source_feed.pk}: "
+        f"{rows} rows in {elapsed:.1f} s"
+    )
+    return rows
+
+
+def import_feed_table(
+    schedule_zip, table_name, feed, last_feed, last_table, **import_kwargs
+):
+    """Import a table, or carry it forward from the last feed if its content
+    did not change, and record it in ``FeedTable``.
+
+    Runs in a worker thread, so it closes its own database connection.
+    """
+    try:
+        content_hash = hash_table(schedule_zip, f"{table_name}.txt")
+        if last_table and last_table.content_hash == content_hash:
+            carried_from = last_table.carried_from or last_feed
+            rows = carry_table(table_name, last_feed, feed)
+        else:
+            carried_from = None
+            rows = import_table(schedule_zip, table_name, feed, **import_kwargs)
+        return FeedTable.objects.create(
+            feed=feed,
+            table_name=table_name,
+            content_hash=content_hash,
+            rows=rows,
+            carried_from=carried_from,
+        )
+    finally:
+        connections.close_all()
+
+
+def import_feed(schedule_zip, feed, last_feed=None, workers=None, **import_kwargs):
+    """Import all the tables of a feed, loading at the same time the tables
+    that do not depend on each other.
+
+    A table starts as soon as the tables in ``SCHEDULE_DEPENDENCIES`` that are
+    present in the feed have finished, with at most ``workers`` tables at a
+    time. The keyword arguments are passed to ``import_table``.
+
+    Returns the ``FeedTable`` records by table name.
+    """
+    workers = workers or settings.SCHEDULE_IMPORT_WORKERS
+
+    files = set(schedule_zip.namelist())
+    tables = [table for table in SCHEDULE_TABLES if f"{table}.txt" in files]
+    pending = {
+        table: {parent for parent in SCHEDULE_DEPENDENCIES[table] if parent in tables}
+        for table in tables
+    }
+    last_tables = {}
+    if last_feed is not None:
+        last_tables = {
+            table.table_name: table
+            for table in FeedTable.objects.filter(feed=last_feed)
+        }
+
+    imported = {}
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            ready = [
+                table
+                for table, parents in pending.items()
+                if parents <= imported.keys()
+            ]
+            for table_name in ready:
+                del pending[table_name]
+                future = executor.submit(
+                    import_feed_table,
+                    schedule_zip,
+                    table_name,
+                    feed,
+                    last_feed,
+                    last_tables.get(table_name),
+                    **import_kwargs,
+                )
+                running[future] = table_name
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                table_name = running.pop(future)
+                imported[table_name] = future.result()
+    return imported
+
+
+def analyze_tables(table_names):
+    """Update the planner statistics of the schedule tables after an import,
+    so that the first queries on the new feed already get good plans."""
+    if connection.vendor != "postgresql":
+        return
+    with connection.cursor() as cursor:
+        for table_name in table_names:
+            table = get_table_model(table_name)._meta.db_table
+            cursor.execute(f"ANALYZE {connection.ops.quote_name(table)}")
+
+
+def provider_feeds(provider):
+    """Return the feeds of a provider, whose IDs are its code and the Unix
+    time of the feed, so a code that extends another one does not match."""
+    Feed = apps.get_model("gtfs", "Feed")
+    return Feed.objects.filter(feed_id__regex=rf"^{re.escape(provider.code)}-[0-9]+$")
+
+
+def promote_feed(feed, provider):
+    """Make a fully imported feed the current one of its provider.
+
+    The previous current feed of the provider is switched off in the same
+    transaction, so the API sees either the old feed or the new one, never
+    both or none. Promotions of the same provider wait for each other on the
+    lock of its row. The ``feed_promoted`` signal is sent after the commit to
+    invalidate anything cached for the previous feed.
+    """
+    Feed = apps.get_model("gtfs", "Feed")
+    GTFSProvider = apps.get_model("gtfs", "GTFSProvider")
+    with transaction.atomic():
+        # Evaluated so the lock is taken, even when no feed is current yet
+        list(GTFSProvider.objects.select_for_update().filter(pk=provider.pk))
+        current_feeds = provider_feeds(provider).filter(is_current=True)
+        current_feeds.exclude(pk=feed.pk).update(is_current=False)
+        feed.is_current = True
+        feed.save(update_fields=["is_current"])
+        transaction.on_commit(lambda: feed_promoted.send(sender=Feed, feed=feed))
+    logging.info(f"Feed {feed.pk} is now the current feed of {provider.code}")
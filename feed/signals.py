@@ -0,0 +1,4 @@
+from django.dispatch import Signal
+
+# Sent with the argument "feed" when a GTFS Schedule feed becomes the current one
+feed_promoted = Signal()
@@ -0,0 +1,33 @@
+"""Timing of the stages of the realtime ingestion, for benchmarks."""
+
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+collectors = []  # Timings being collected, stage -> list of seconds
+
+
+@contextmanager
+def stage(name):
+    """Time a stage of the ingestion if timings are being collected."""
+    if not collectors:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        for timings in collectors:
+            timings[name].append(elapsed)
+
+
+@contextmanager
+def collect_stages():
+    """Collect the timings of the stages run inside the block."""
+    timings = defaultdict(list)
+    collectors.append(timings)
+    try:
+        yield timings
+    finally:
+        collectors.remove(timings)
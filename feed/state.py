@@ -0,0 +1,351 @@
+"""Latest GTFS Realtime state of each provider, shared by all processes.
+
+The ingest tasks publish each new snapshot under its own version of keys in
+Redis and then point the provider to it, so the API always reads a complete
+snapshot with a few key reads. The replaced version expires a few seconds
+after the switch, once the requests still reading it are done.
+
+A digest of each hash is kept per provider, so each new snapshot tells which
+stops changed and only their cached API responses are evicted.
+"""
+
+import hashlib
+import json
+import time
+
+import pandas as pd
+from django.conf import settings
+
+from .alerts import INFORMED_ENTITY_KINDS, is_active
+from .locks import get_redis
+
+
+CURRENT_KEY = "realtime:{entity_type}:current"  # Hash of provider -> version
+DIGESTS_KEY = "realtime:{entity_type}:{provider_code}:digests"  # Hash of key -> digest
+RESPONSE_KEY = "response:{name}:{entity_id}"  # Cached data of an API response
+EVICTIONS_KEY = "responses:{name}:evictions"  # Counter of evictions of all of them
+
+
+def version_key(provider_code, version, *parts):
+    return ":".join(["realtime", provider_code, str(version), *parts])
+
+
+def trip_descriptor(trip_id, start_date, start_time):
+    """Key of a trip in the store, from its ID, start date and start time."""
+    return f"{trip_id}|{start_date}|{start_time}"
+
+
+def format_date(value):
+    return None if pd.isna(value) else pd.Timestamp(value).strftime("%Y-%m-%d")
+
+
+def format_time(value):
+    if pd.isna(value):
+        return None
+    seconds = int(pd.Timedelta(value).total_seconds())
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def format_timestamp(value):
+    return None if pd.isna(value) else pd.Timestamp(value).isoformat()
+
+
+def format_value(value):
+    if isinstance(value, float) and pd.isna(value):
+        return None
+    return value
+
+
+def digest(fields):
+    content = json.dumps(fields, sort_keys=True).encode()
+    return hashlib.blake2b(content, digest_size=8).hexdigest()
+
+
+def publish(provider, entity_type, version, hashes):
+    """Write the hashes of a snapshot and make it the current one of the
+    provider. ``hashes`` maps each key (as parts) to a dict of fields.
+
+    Returns the keys (as parts) whose fields changed since the previous
+    snapshot, including the ones that are gone.
+    """
+    redis = get_redis()
+    ttl = settings.REALTIME_STATE_TTL
+    digests = {}
+    pipeline = redis.pipeline(transaction=False)
+    for parts, fields in hashes.items():
+        if not fields:
+            continue
+        key = version_key(provider.code, version, *parts)
+        pipeline.hset(key, mapping=fields)
+        pipeline.expire(key, ttl)
+        digests[json.dumps(parts)] = digest(fields)
+    pipeline.execute()
+
+    # Switch to the new snapshot once all of it is written
+    current_key = CURRENT_KEY.format(entity_type=entity_type)
+    previous_version = redis.hget(current_key, provider.code)
+    redis.hset(current_key, provider.code, version)
+    redis.expire(current_key, ttl)
+
+    digests_key = DIGESTS_KEY.format(
+        entity_type=entity_type, provider_code=provider.code
+    )
+    previous = {
+        key.decode(): value.decode()
+        for key, value in redis.hgetall(digests_key).items()
+    }
+    pipeline = redis.pipeline()
+    pipeline.delete(digests_key)
+    if digests:
+        pipeline.hset(digests_key, mapping=digests)
+        pipeline.expire(digests_key, ttl)
+    pipeline.execute()
+
+    # The keys of the replaced snapshot are the ones in its digests
+    if previous_version is not None and previous_version.decode() != str(version):
+        pipeline = redis.pipeline(transaction=False)
+        for key in previous:
+            pipeline.expire(
+                version_key(provider.code, previous_version.decode(), *json.loads(key)),
+                settings.REALTIME_STATE_GRACE,
+            )
+        pipeline.execute()
+    return [
+        tuple(json.loads(key))
+        for key in digests.keys() | previous.keys()
+        if digests.get(key) != previous.get(key)
+    ]
+
+
+def publish_trip_updates(
+    provider, version, trip_updates_df, stop_time_updates_df, trip_update_index
+):
+    """Publish the stop time updates of a snapshot indexed by stop and by
+    trip descriptor."""
+    trips = trip_updates_df.iloc[list(trip_update_index)].reset_index(drop=True)
+    stop_time_updates_df = stop_time_updates_df.reset_index(drop=True)
+
+    hashes = {}
+    for trip, stop_time_update in zip(
+        trips.to_dict(orient="records"),
+        stop_time_updates_df.to_dict(orient="records"),
+    ):
+        descriptor = trip_descriptor(
+            trip["trip_trip_id"],
+            format_date(trip["trip_start_date"]),
+            format_time(trip["trip_start_time"]),
+        )
+        stop_sequence = format_value(stop_time_update.get("stop_sequence"))
+        stop_id = format_value(stop_time_update.get("stop_id"))
+        value = json.dumps(
+            {
+                "trip_id": trip["trip_trip_id"],
+                "route_id": format_value(trip["trip_route_id"]),
+                "start_date": format_date(trip["trip_start_date"]),
+                "start_time": format_time(trip["trip_start_time"]),
+                "vehicle_id": format_value(trip["vehicle_id"]),
+                "stop_sequence": stop_sequence,
+                "stop_id": stop_id,
+                "arrival_time": format_timestamp(stop_time_update.get("arrival_time")),
+                "departure_time": format_timestamp(
+                    stop_time_update.get("departure_time")
+                ),
+            }
+        )
+        if stop_id is not None:
+            hashes.setdefault(("stop", str(stop_id)), {})[descriptor] = value
+        # The stop sequence is optional when the stop ID is given
+        field = stop_sequence if stop_sequence is not None else stop_id
+        hashes.setdefault(("trip", descriptor), {})[str(field)] = value
+
+    changed = publish(provider, "trip_update", version, hashes)
+    evict_responses(
+        "next-trips", [parts[1] for parts in changed if parts[0] == "stop"]
+    )
+
+
+def publish_vehicle_positions(provider, version, vehicle_positions_df, progression):
+    """Publish the vehicle positions of a snapshot indexed by trip descriptor,
+    with their ``progression`` along the shape of their trip."""
+    fields = {}
+    for vehicle, position_in_shape in zip(
+        vehicle_positions_df.to_dict(orient="records"), progression.tolist()
+    ):
+        trip_id = format_value(vehicle.get("vehicle_trip_trip_id"))
+        if trip_id is None:
+            continue
+        descriptor = trip_descriptor(
+            trip_id,
+            format_date(vehicle["vehicle_trip_start_date"]),
+            format_time(vehicle["vehicle_trip_start_time"]),
+        )
+        fields[descriptor] = json.dumps(
+            {
+                "vehicle_id": format_value(vehicle.get("vehicle_vehicle_id")),
+                "latitude": format_value(vehicle.get("vehicle_position_latitude")),
+                "longitude": format_value(vehicle.get("vehicle_position_longitude")),
+                "timestamp": format_timestamp(vehicle.get("vehicle_timestamp")),
+                "current_stop_sequence": format_value(
+                    vehicle.get("vehicle_current_stop_sequence")
+                ),
+                "current_status": format_value(vehicle.get("vehicle_current_status")),
+                "occupancy_status": format_value(
+                    vehicle.get("vehicle_occupancy_status")
+                ),
+                "position_in_shape": format_value(position_in_shape),
+            }
+        )
+
+    publish(provider, "vehicle", version, {("vehicle",): fields})
+
+
+def publish_service_alerts(provider, version, service_alerts):
+    """Publish the alerts of a provider indexed by each informed agency,
+    route, trip and stop."""
+    hashes = {}
+    for service_alert in service_alerts:
+        informed_entities = [
+            {
+                "agency_id": informed_entity.agency_id,
+                "route_id": informed_entity.route_id,
+                "route_type": informed_entity.route_type,
+                "direction_id": informed_entity.direction_id,
+                "trip_id": informed_entity.trip_id,
+                "stop_id": informed_entity.stop_id,
+            }
+            for informed_entity in service_alert.informed_entities.all()
+        ]
+        value = json.dumps(
+            {
+                "alert_id": service_alert.alert_id,
+                "provider": provider.code,
+                "cause": service_alert.cause,
+                "effect": service_alert.effect,
+                "severity_level": service_alert.severity_level,
+                "header_text": service_alert.header_text,
+                "description_text": service_alert.description_text,
+                "url": service_alert.url,
+                "active_periods": service_alert.active_periods,
+                "informed_entities": informed_entities,
+            }
+        )
+        for informed_entity in informed_entities:
+            for kind in INFORMED_ENTITY_KINDS:
+                entity_id = informed_entity[f"{kind}_id"]
+                if entity_id is not None:
+                    hashes.setdefault(("alerts", kind, str(entity_id)), {})[
+                        service_alert.alert_id
+                    ] = value
+
+    publish(provider, "alert", version, hashes)
+
+
+def response_key(name, entity_id):
+    return RESPONSE_KEY.format(name=name, entity_id=entity_id)
+
+
+def evict_responses(name, entity_ids):
+    """Delete the cached responses ``name`` of some entities."""
+    keys = [response_key(name, entity_id) for entity_id in entity_ids]
+    if keys:
+        get_redis().delete(*keys)
+
+
+def evict_all_responses(name):
+    """Delete all the cached responses ``name``, and make the ones being
+    built be discarded too."""
+    redis = get_redis()
+    redis.incr(EVICTIONS_KEY.format(name=name))
+    keys = list(redis.scan_iter(match=response_key(name, "*")))
+    if keys:
+        redis.delete(*keys)
+
+
+def evict_schedule_responses(sender, feed, **kwargs):
+    """Evict the cached next trips, built with the schedule of the previous
+    feeds, from ``feed_promoted``."""
+    evict_all_responses("next-trips")
+
+
+def read_many_hashes(entity_type, keys):
+    """Read some hashes of the current snapshot of every provider, merged,
+    in one round trip. ``keys`` are given as parts and returned by key."""
+    redis = get_redis()
+    current = redis.hgetall(CURRENT_KEY.format(entity_type=entity_type))
+    pipeline = redis.pipeline(transaction=False)
+    for parts in keys:
+        for provider_code, version in current.items():
+            pipeline.hgetall(
+                version_key(provider_code.decode(), version.decode(), *parts)
+            )
+    results = iter(pipeline.execute())
+    merged = {}
+    for parts in keys:
+        merged[parts] = {}
+        for _ in current:
+            merged[parts].update(
+                (field.decode(), json.loads(value))
+                for field, value in next(results).items()
+            )
+    return merged
+
+
+def read_hashes(entity_type, *parts):
+    """Read a hash of the current snapshot of every provider, merged."""
+    return read_many_hashes(entity_type, [parts])[parts]
+
+
+def get_stop_trip_updates(stop_id):
+    """Return the latest stop time updates of all the trips at a stop."""
+    return list(read_hashes("trip_update", "stop", str(stop_id)).values())
+
+
+def get_stops_trip_updates(stop_ids):
+    """Return the latest stop time updates of all the trips at some stops,
+    by stop ID."""
+    keys = [("stop", str(stop_id)) for stop_id in stop_ids]
+    hashes = read_many_hashes("trip_update", keys)
+    return {parts[1]: list(fields.values()) for parts, fields in hashes.items()}
+
+
+def get_trip_stop_time_updates(trip_id, start_date, start_time):
+    """Return the latest stop time updates of a trip, by stop sequence."""
+    descriptor = trip_descriptor(trip_id, start_date, start_time)
+    stop_time_updates = read_hashes("trip_update", "trip", descriptor).values()
+    return sorted(stop_time_updates, key=lambda update: update["stop_sequence"] or 0)
+
+
+def get_vehicle_positions(trips):
+    """Return the latest positions of the vehicles serving the trips, given
+    as (trip_id, start_date, start_time), by trip descriptor."""
+    descriptors = [trip_descriptor(*trip) for trip in trips]
+    if not descriptors:
+        return {}
+    redis = get_redis()
+    current = redis.hgetall(CURRENT_KEY.format(entity_type="vehicle"))
+    pipeline = redis.pipeline(transaction=False)
+    for provider_code, version in current.items():
+        pipeline.hmget(
+            version_key(provider_code.decode(), version.decode(), "vehicle"),
+            descriptors,
+        )
+    positions = {}
+    for values in pipeline.execute():
+        for descriptor, value in zip(descriptors, values):
+            if value is not None:
+                positions.setdefault(descriptor, json.loads(value))
+    return positions
+
+
+def get_vehicle_position(trip_id, start_date, start_time):
+    """Return the latest position of the vehicle serving a trip, or None."""
+    trip = (trip_id, start_date, start_time)
+    return get_vehicle_positions([trip]).get(trip_descriptor(*trip))
+
+
+def get_active_alerts(kind, entity_id, at=None):
+    """Return the alerts that inform an agency, route, trip or stop and are
+    active at a Unix time, now by default."""
+    at = time.time() if at is None else at
+    alerts = read_hashes("alert", "alerts", kind, str(entity_id)).values()
+    return [alert for alert in alerts if is_active(alert["active_periods"], at)]
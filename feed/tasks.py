@@ -1,23 +1,73 @@
-from celery import shared_task
+from celery import group, shared_task
 
 import logging
-from datetime import datetime, timedelta
+import time
+from datetime import datetime
 import pytz
-import zipfile
-import io
-import json
-import pandas as pd
 import requests
 from google.transit import gtfs_realtime_pb2 as gtfs_rt
-from google.protobuf import json_format
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
 
 from gtfs.models import *
+from .alerts import decode_service_alerts, published_alerts, save_service_alerts
+from .archive import archive_snapshot, is_archived
+from .compaction import compact_vehicle_positions
+from .departures import roll_departure_boards
+from .fetch import fetch, fetch_all, save_validators
+from .locks import task_lock
+from .partitions import ensure_partitions, maintain_partitions
+from .polling import claim_poll, record_poll
+from .progression import vehicle_progression
+from .realtime import (
+    changed_vehicle_positions,
+    save_vehicle_states,
+    trip_updates_frames,
+    vehicle_positions_frame,
+)
+from .schedule import (
+    analyze_tables,
+    content_tag,
+    download_feed,
+    import_feed,
+    open_feed_zip,
+    promote_feed,
+    provider_feeds,
+)
+from .stages import stage
+from .state import (
+    publish_service_alerts,
+    publish_trip_updates,
+    publish_vehicle_positions,
+)
 
 
 @shared_task
-def get_schedule():
+def get_schedule(**import_kwargs):
+    """Refresh the GTFS Schedule of all the active providers.
+
+    Each provider is imported by its own task, so a slow or large feed does
+    not delay the others. The keyword arguments are passed to each task.
+    """
+    providers = (
+        GTFSProvider.objects.filter(is_active=True)
+        .exclude(schedule_url__isnull=True)
+        .exclude(schedule_url="")
+    )
+    group(
+        get_provider_schedule.s(provider.code, **import_kwargs)
+        for provider in providers
+    ).apply_async()
+
+    return f"Fetching Schedule of {len(providers)} providers"
+
+
+@shared_task
+def get_provider_schedule(
+    provider_code, loader=None, chunk_size=None, batch_size=None, workers=None
+):
 
     # Logging configuration
     logging.basicConfig(
@@ -27,163 +77,384 @@ def get_schedule():
     )
 
     # GTFS information
-    company = "MBTA"
-    schedule_url = "https://cdn.mbta.com/MBTA_GTFS.zip"
-
-    logging.info(
-        f"GTFS Schedule updating session\n{company}\n{datetime.now()}\nData source: {schedule_url}"
-    )
-
-    # Check if the feed has been updated
-    last_feed_tag = {"value": None}
-    try:
-        last_feed_tag["value"] = (
-            Feed.objects.all().order_by("-retrieved_at").first().http_etag
+    provider = GTFSProvider.objects.get(code=provider_code)
+    company = provider.code
+    schedule_url = provider.schedule_url
+
+    # Only one import of each provider at a time
+    with task_lock(
+        f"schedule-{company}", timeout=settings.SCHEDULE_IMPORT_LOCK_TIMEOUT
+    ) as acquired:
+        if not acquired:
+            logging.info(f"GTFS Schedule of {company} is already being updated")
+            return f"Schedule of {company} already being fetched"
+
+        logging.info(
+            f"GTFS Schedule updating session\n{company}\n{datetime.now()}\nData source: {schedule_url}"
         )
-    except:
-        logging.info("No records found in the table 'feeds'.")
 
-    # Get the feed's ETag to compare with the last one
-    schedule_check = requests.head(schedule_url)
-    feed_tag = schedule_check.headers["ETag"]
+        # Check if the feed of this provider has been updated
+        last_feed = (
+            provider_feeds(provider)
+            .filter(is_current=True)
+            .order_by("-retrieved_at")
+            .first()
+        )
+        if last_feed is None:
+            logging.info(f"No current feed of {company} in the table 'feeds'.")
+        last_feed_tag = last_feed.http_etag if last_feed else None
+
+        # Get the feed's ETag to compare with the last one
+        schedule_check = requests.head(schedule_url, timeout=30)
+        feed_tag = schedule_check.headers.get("ETag")
+        last_modified = schedule_check.headers.get("Last-Modified")
+        if last_modified:
+            last_modified = datetime.strptime(
+                last_modified, "%a, %d %b %Y %H:%M:%S %Z"
+            ).replace(tzinfo=pytz.UTC)
+
+        if feed_tag is not None:
+            modified = feed_tag != last_feed_tag
+        else:
+            # Without an ETag, the Last-Modified header tells if it changed
+            modified = not (
+                last_modified
+                and last_feed
+                and last_feed.http_last_modified == last_modified
+            )
+        if not modified:
+            logging.info(f"GTFS Schedule of {company} not modified")
+            return f"Schedule of {company} not modified"
 
-    if not feed_tag == last_feed_tag["value"]:
         logging.info(f"Importing new GTFS Schedule feed detected: {feed_tag}")
 
         # Request feed
-        schedule_response = requests.get(schedule_url)
-        schedule_zip = zipfile.ZipFile(io.BytesIO(schedule_response.content))
-
-        last_modified = schedule_check.headers["Last-Modified"]
-        last_modified = datetime.strptime(last_modified, "%a, %d %b %Y %H:%M:%S %Z")
-        last_modified = last_modified.replace(tzinfo=pytz.UTC)
+        start = time.perf_counter()
+        schedule_file = download_feed(schedule_url)
+        logging.info(f"Feed downloaded in {time.perf_counter() - start:.1f} s")
+
+        # Without an ETag, the content tells if it changed
+        if feed_tag is None:
+            feed_tag = content_tag(schedule_file)
+            if feed_tag == last_feed_tag:
+                schedule_file.close()
+                logging.info(f"GTFS Schedule of {company} has the same content")
+                return f"Schedule of {company} not modified"
+
+        if not last_modified:
+            last_modified = datetime.now(tz=pytz.UTC)
         feed_id = f"{company}-{int(last_modified.timestamp())}"
+        if Feed.objects.filter(feed_id=feed_id).exists():
+            # The feed changed without a new Last-Modified
+            feed_id = f"{company}-{int(time.time())}"
 
-        # Save feed record to database with the Feed model
+        # Save feed record to database with the Feed model, not yet visible to the API
         feed = Feed.objects.create(
             feed_id=feed_id,
             http_etag=feed_tag,
             http_last_modified=last_modified,
+            is_current=False,
         )
 
-        tables = {
-            "agency": "Agency",
-            "stops": "Stop",
-            "shapes": "Shape",
-            "calendar": "Calendar",
-            "calendar_dates": "CalendarDate",
-            "routes": "Route",
-            "trips": "Trip",
-            "stop_times": "StopTime",
-            "feed_info": "FeedInfo",
-        }  # They must be loaded in this order
-
-        # Import and save tables
-        for table_name in tables.keys():
-            file = f"{table_name}.txt"
-            if file in schedule_zip.namelist():
-                model = eval(f"{tables[table_name]}")
-                fields = [field.name for field in model._meta.fields]
-                table = pd.read_csv(
-                    schedule_zip.open(file),
-                    dtype=str,
-                    keep_default_na=False,
-                    na_values="",
+        # Import and save tables in the new feed
+        start = time.perf_counter()
+        try:
+            with schedule_file, open_feed_zip(schedule_file) as schedule_zip:
+                tables = import_feed(
+                    schedule_zip,
+                    feed,
+                    last_feed=last_feed,
+                    workers=workers,
+                    loader=loader,
+                    chunk_size=chunk_size,
+                    batch_size=batch_size,
                 )
-                table = table[[col for col in fields if col in table.columns]]
-                table["feed"] = feed
-                objects = [model(**row) for row in table.to_dict(orient="records")]
-                model.objects.bulk_create(objects)
-                logging.info(f"{file} imported successfully")
+            analyze_tables(tables.keys())
+        except Exception:
+            logging.exception(f"Import of feed {feed_id} failed, discarding it")
+            feed.delete()
+            raise
+        logging.info(f"Feed imported in {time.perf_counter() - start:.1f} s")
 
-    return "Fetching Schedule"
+        # Switch the API to the new feed
+        promote_feed(feed, provider)
 
+    return f"Fetching Schedule of {company}"
 
-@shared_task
-def get_vehicle_positions():
-    providers = GTFSProvider.objects.filter(is_active=True)
-    saved_data = False
-    for provider in providers:
-        vehicle_positions = gtfs_rt.FeedMessage()
-        try:
-            vehicle_positions_response = requests.get(provider.vehicle_positions_url)
-            print(f"Fetching vehicle positions from {provider.vehicle_positions_url}")
-        except:
-            print(
-                f"Error fetching vehicle positions from {provider.vehicle_positions_url}"
-            )
-            continue
-        vehicle_positions.ParseFromString(vehicle_positions_response.content)
 
-        # Save feed message to database
-        feed_message = FeedMessage(
-            feed_message_id=f"{provider.code}-vehicle-{vehicle_positions.header.timestamp}",
-            provider=provider,
-            entity_type="vehicle",
-            timestamp=datetime.fromtimestamp(
-                int(vehicle_positions.header.timestamp),
-                tz=pytz.timezone(provider.timezone),
-            ),
-            incrementality=vehicle_positions.header.incrementality,
-            gtfs_realtime_version=vehicle_positions.header.gtfs_realtime_version,
-        )
+def is_saved(provider, entity_type, feed_message_id, header_timestamp):
+    """Whether a snapshot was already saved, in the database or only in the
+    archive."""
+    if settings.REALTIME_ARCHIVE_MODE == "only":
+        return is_archived(provider.code, entity_type, header_timestamp)
+    return FeedMessage.objects.filter(feed_message_id=feed_message_id).exists()
 
-        feed_message.save()
 
-        vehicle_positions_json = json_format.MessageToJson(
-            vehicle_positions, preserving_proto_field_name=True
-        )
-        vehicle_positions_json = json.loads(vehicle_positions_json)
-        if "entity" not in vehicle_positions_json:
-            print("No vehicle positions found")
-            continue
-        vehicle_positions_df = pd.json_normalize(
-            vehicle_positions_json["entity"], sep="_"
-        )
-        vehicle_positions_df.rename(columns={"id": "entity_id"}, inplace=True)
-        vehicle_positions_df["feed_message"] = feed_message
-        # Drop unnecessary columns
-        try:
-            vehicle_positions_df.drop(
-                columns=["vehicle_multi_carriage_details"],
-                inplace=True,
+def archive_response(provider, entity_type, header_timestamp, response):
+    """Append the raw snapshot of a response to the archive, if enabled."""
+    if settings.REALTIME_ARCHIVE_MODE != "off":
+        archive_snapshot(provider.code, entity_type, header_timestamp, response.content)
+
+
+def ingest_vehicle_positions(provider, vehicle_positions_response):
+    """Save a fetched VehiclePositions snapshot of a provider.
+
+    Returns the header timestamp of the snapshot, or None if the feed was not
+    modified.
+    """
+    if vehicle_positions_response.status_code == 304:
+        print(f"Vehicle positions of {provider.code} not modified")
+        return None
+    vehicle_positions = gtfs_rt.FeedMessage()
+    print(f"Fetched vehicle positions from {provider.vehicle_positions_url}")
+    with stage("parse"):
+        vehicle_positions.ParseFromString(vehicle_positions_response.content)
+    header_timestamp = int(vehicle_positions.header.timestamp)
+
+    # Skip snapshots that were already saved
+    feed_message_id = f"{provider.code}-vehicle-{header_timestamp}"
+    if is_saved(provider, "vehicle", feed_message_id, header_timestamp):
+        print(f"Vehicle positions of {provider.code} already saved")
+        save_validators(provider.vehicle_positions_url, vehicle_positions_response)
+        return header_timestamp
+
+    # Save feed message to database
+    feed_message = FeedMessage(
+        feed_message_id=feed_message_id,
+        provider=provider,
+        entity_type="vehicle",
+        timestamp=datetime.fromtimestamp(
+            header_timestamp,
+            tz=pytz.timezone(provider.timezone),
+        ),
+        incrementality=vehicle_positions.header.incrementality,
+        gtfs_realtime_version=vehicle_positions.header.gtfs_realtime_version,
+    )
+
+    with stage("decode"):
+        vehicle_positions_df = vehicle_positions_frame(vehicle_positions, feed_message)
+        snapshot_df = vehicle_positions_df
+        if settings.REALTIME_VEHICLE_DELTA_MODE:
+            vehicle_positions_df = changed_vehicle_positions(
+                provider,
+                vehicle_positions_df,
+                min_distance=settings.REALTIME_VEHICLE_DELTA_DISTANCE,
+                heartbeat=settings.REALTIME_VEHICLE_DELTA_HEARTBEAT,
             )
-        except:
-            pass
-        # Fix entity timestamp
-        vehicle_positions_df["vehicle_timestamp"] = pd.to_datetime(
-            vehicle_positions_df["vehicle_timestamp"].astype(int), unit="s", utc=True
-        )
-        # Fix trip start date
-        vehicle_positions_df["vehicle_trip_start_date"] = pd.to_datetime(
-            vehicle_positions_df["vehicle_trip_start_date"], format="%Y%m%d"
-        )
-        vehicle_positions_df["vehicle_trip_start_date"].fillna(
-            datetime.now().date(), inplace=True
+
+    # Save to the archive and database
+    with stage("archive"):
+        archive_response(
+            provider, "vehicle", header_timestamp, vehicle_positions_response
         )
-        # Fix trip start time
-        vehicle_positions_df["vehicle_trip_start_time"] = pd.to_timedelta(
-            vehicle_positions_df["vehicle_trip_start_time"]
+    if settings.REALTIME_ARCHIVE_MODE != "only":
+        ensure_partitions()
+        with stage("database"), transaction.atomic():
+            feed_message.save()
+            objects = [
+                VehiclePosition(**row)
+                for row in vehicle_positions_df.to_dict(orient="records")
+            ]
+            VehiclePosition.objects.bulk_create(objects)
+    save_validators(provider.vehicle_positions_url, vehicle_positions_response)
+    if settings.REALTIME_VEHICLE_DELTA_MODE:
+        save_vehicle_states(provider, vehicle_positions_df)
+
+    # The API reads the whole latest snapshot, not only what was saved
+    with stage("progression"):
+        progression = vehicle_progression(provider, snapshot_df)
+    with stage("publish"):
+        publish_vehicle_positions(provider, header_timestamp, snapshot_df, progression)
+
+    if vehicle_positions_df.empty:
+        print("No vehicle positions found")
+    return header_timestamp
+
+
+def ingest_trip_updates(provider, trip_updates_response):
+    """Save a fetched TripUpdates snapshot of a provider.
+
+    Returns the header timestamp of the snapshot, or None if the feed was not
+    modified.
+    """
+    if trip_updates_response.status_code == 304:
+        print(f"Trip updates of {provider.code} not modified")
+        return None
+
+    # Parse FeedMessage object from Protobuf
+    trip_updates = gtfs_rt.FeedMessage()
+    with stage("parse"):
+        trip_updates.ParseFromString(trip_updates_response.content)
+    header_timestamp = int(trip_updates.header.timestamp)
+
+    # Skip snapshots that were already saved
+    feed_message_id = f"{provider.code}-trip_updates-{header_timestamp}"
+    if is_saved(provider, "trip_update", feed_message_id, header_timestamp):
+        print(f"Trip updates of {provider.code} already saved")
+        save_validators(provider.trip_updates_url, trip_updates_response)
+        return header_timestamp
+
+    # Build FeedMessage object
+    feed_message = FeedMessage(
+        feed_message_id=feed_message_id,
+        provider=provider,
+        entity_type="trip_update",
+        timestamp=datetime.fromtimestamp(
+            header_timestamp,
+            tz=pytz.timezone(provider.timezone),
+        ),
+        incrementality=trip_updates.header.incrementality,
+        gtfs_realtime_version=trip_updates.header.gtfs_realtime_version,
+    )
+
+    # Build TripUpdate and StopTimeUpdate DataFrames
+    with stage("decode"):
+        trip_updates_df, stop_time_updates_df = trip_updates_frames(
+            trip_updates, feed_message
         )
-        vehicle_positions_df["vehicle_trip_start_time"].fillna(
-            timedelta(hours=0, minutes=0, seconds=0), inplace=True
+        trip_update_index = stop_time_updates_df.pop("trip_update_index")
+
+    # Save to the archive, and the whole FeedMessage with one insert per table
+    with stage("archive"):
+        archive_response(
+            provider, "trip_update", header_timestamp, trip_updates_response
         )
-        # Fix trip direction
-        vehicle_positions_df["vehicle_trip_direction_id"].fillna(-1, inplace=True)
-        # Fix current stop sequence
-        vehicle_positions_df["vehicle_current_stop_sequence"].fillna(-1, inplace=True)
-        # Create vehicle position point
-        vehicle_positions_df["vehicle_position_point"] = vehicle_positions_df.apply(
-            lambda x: f"POINT ({x.vehicle_position_longitude} {x.vehicle_position_latitude})",
-            axis=1,
+    if settings.REALTIME_ARCHIVE_MODE != "only":
+        ensure_partitions()
+        with stage("database"), transaction.atomic():
+            feed_message.save()
+            trip_update_objects = [
+                TripUpdate(**row) for row in trip_updates_df.to_dict(orient="records")
+            ]
+            # The IDs are set in the objects by the insert
+            TripUpdate.objects.bulk_create(trip_update_objects)
+
+            StopTimeUpdate.objects.bulk_create(
+                [
+                    StopTimeUpdate(**row, trip_update=trip_update_objects[index])
+                    for row, index in zip(
+                        stop_time_updates_df.to_dict(orient="records"),
+                        trip_update_index,
+                    )
+                ]
+            )
+    save_validators(provider.trip_updates_url, trip_updates_response)
+
+    # Make the snapshot available to the API
+    with stage("publish"):
+        publish_trip_updates(
+            provider,
+            header_timestamp,
+            trip_updates_df,
+            stop_time_updates_df,
+            trip_update_index,
         )
-        # Save to database
-        objects = [
-            VehiclePosition(**row)
-            for row in vehicle_positions_df.to_dict(orient="records")
-        ]
-        VehiclePosition.objects.bulk_create(objects)
-        saved_data = saved_data or True
+    return header_timestamp
+
+
+def ingest_service_alerts(provider, service_alerts_response):
+    """Save a fetched Alerts snapshot of a provider and publish its index.
+
+    Returns the header timestamp of the snapshot, or None if the feed was not
+    modified.
+    """
+    header_timestamp = None
+    if service_alerts_response.status_code == 304:
+        print(f"Service alerts of {provider.code} not modified")
+    else:
+        # Parse FeedMessage object from Protobuf
+        service_alerts = gtfs_rt.FeedMessage()
+        service_alerts.ParseFromString(service_alerts_response.content)
+        header_timestamp = int(service_alerts.header.timestamp)
+
+        # Save the snapshot unless it was already saved
+        feed_message_id = f"{provider.code}-alerts-{header_timestamp}"
+        if FeedMessage.objects.filter(feed_message_id=feed_message_id).exists():
+            print(f"Service alerts of {provider.code} already saved")
+        else:
+            feed_message = FeedMessage(
+                feed_message_id=feed_message_id,
+                provider=provider,
+                entity_type="alert",
+                timestamp=datetime.fromtimestamp(
+                    header_timestamp,
+                    tz=pytz.timezone(provider.timezone),
+                ),
+                incrementality=service_alerts.header.incrementality,
+                gtfs_realtime_version=service_alerts.header.gtfs_realtime_version,
+            )
+            # The alerts are always saved, their index is built from the database
+            archive_response(
+                provider, "alert", header_timestamp, service_alerts_response
+            )
+            ensure_partitions()
+            with transaction.atomic():
+                feed_message.save()
+                save_service_alerts(
+                    provider, feed_message, decode_service_alerts(service_alerts)
+                )
+        save_validators(provider.service_alerts_url, service_alerts_response)
+
+    # Alerts stay valid until they are removed from the feed, so the index is
+    # published again even if the feed did not change
+    publish_service_alerts(provider, int(time.time()), published_alerts(provider))
+    return header_timestamp
+
+
+# Ingest function and provider URL field of each GTFS Realtime feed
+REALTIME_FEEDS = {
+    "vehicle": (ingest_vehicle_positions, "vehicle_positions_url"),
+    "trip_update": (ingest_trip_updates, "trip_updates_url"),
+    "alert": (ingest_service_alerts, "service_alerts_url"),
+}
+
+
+def poll_lock(provider, entity_type):
+    """Lock held while a feed of a provider is ingested, so two polls of the
+    same feed never overlap."""
+    return task_lock(
+        f"realtime-{entity_type}-{provider.code}",
+        timeout=settings.REALTIME_POLL_LOCK_TIMEOUT,
+    )
+
+
+def ingest_all(entity_type, providers):
+    """Fetch a feed of all the providers at the same time and ingest each one
+    that is not being polled already. Returns the number of new snapshots."""
+    ingest, url_field = REALTIME_FEEDS[entity_type]
+    responses = fetch_all(
+        {provider.code: getattr(provider, url_field) for provider in providers}
+    )
+
+    new_snapshots = 0
+    for provider in providers:
+        response = responses[provider.code]
+        if isinstance(response, Exception):
+            print(
+                f"Error fetching {entity_type} from {getattr(provider, url_field)}: {str(response)}"
+            )
+            continue
+        with poll_lock(provider, entity_type) as acquired:
+            if not acquired:
+                print(f"Feed {entity_type} of {provider.code} is already being polled")
+                continue
+            # A malformed feed does not stop the ingest of the other providers
+            try:
+                header_timestamp = ingest(provider, response)
+            except Exception:
+                logging.exception(f"Ingest of {entity_type} of {provider.code} failed")
+                continue
+            if header_timestamp is not None:
+                new_snapshots += 1
+    return new_snapshots
+
+
+@shared_task
+def get_vehicle_positions():
+    providers = GTFSProvider.objects.filter(is_active=True)
+
+    # Fetch all the providers at the same time
+    saved_data = ingest_all("vehicle", providers) > 0
 
     # Send status update to WebSocket
     message = {}
@@ -207,139 +478,87 @@ def get_vehicle_positions():
 @shared_task
 def get_trip_updates():
     providers = GTFSProvider.objects.filter(is_active=True)
-    for provider in providers:
+
+    # Fetch all the providers at the same time
+    ingest_all("trip_update", providers)
+
+    return "TripUpdates saved to database"
+
+
+@shared_task
+def get_service_alerts():
+    providers = (
+        GTFSProvider.objects.filter(is_active=True)
+        .exclude(service_alerts_url__isnull=True)
+        .exclude(service_alerts_url="")
+    )
+
+    # Fetch all the providers at the same time
+    ingest_all("alert", providers)
+
+    return "Alerts saved to database"
+
+
+@shared_task
+def poll_realtime():
+    """Send a poll of each realtime feed of the active providers that is due,
+    according to the cadence learned by ``poll_provider_realtime``.
+
+    Run it with Celery Beat every ``REALTIME_POLL_MIN_INTERVAL`` seconds
+    instead of the fixed interval tasks.
+    """
+    polls = 0
+    for provider in GTFSProvider.objects.filter(is_active=True):
+        for entity_type, (_, url_field) in REALTIME_FEEDS.items():
+            if not getattr(provider, url_field):
+                continue
+            if claim_poll(provider.code, entity_type):
+                poll_provider_realtime.delay(provider.code, entity_type)
+                polls += 1
+    return f"Polling {polls} realtime feeds"
+
+
+@shared_task
+def poll_provider_realtime(provider_code, entity_type):
+    """Fetch and ingest one realtime feed of a provider, and schedule its next
+    poll just after its next expected update."""
+    provider = GTFSProvider.objects.get(code=provider_code)
+    ingest, url_field = REALTIME_FEEDS[entity_type]
+
+    with poll_lock(provider, entity_type) as acquired:
+        if not acquired:
+            return f"Feed {entity_type} of {provider_code} is already being polled"
         try:
-            trip_updates_response = requests.get(provider.trip_updates_url, timeout=10)
-            trip_updates_response.raise_for_status()
-        except requests.RequestException as e:
-            print(
-                f"Error fetching trip updates from {provider.trip_updates_url}: {str(e)}"
-            )
-            continue
+            header_timestamp = ingest(provider, fetch(getattr(provider, url_field)))
+        except Exception:
+            logging.exception(f"Poll of {entity_type} of {provider_code} failed")
+            next_poll_at = record_poll(provider_code, entity_type, error=True)
+            return f"Feed {entity_type} of {provider_code} failed, retrying at {next_poll_at:.0f}"
+        next_poll_at = record_poll(provider_code, entity_type, header_timestamp)
 
-        # Parse FeedMessage object from Protobuf
-        trip_updates = gtfs_rt.FeedMessage()
-        trip_updates.ParseFromString(trip_updates_response.content)
+    return f"Polled {entity_type} of {provider_code}, next poll at {next_poll_at:.0f}"
 
-        # Build FeedMessage object
-        feed_message = FeedMessage(
-            feed_message_id=f"{provider.code}-trip_updates-{trip_updates.header.timestamp}",
-            provider=provider,
-            entity_type="trip_update",
-            timestamp=datetime.fromtimestamp(
-                int(trip_updates.header.timestamp),
-                tz=pytz.timezone(provider.timezone),
-            ),
-            incrementality=trip_updates.header.incrementality,
-            gtfs_realtime_version=trip_updates.header.gtfs_realtime_version,
-        )
-        # Save FeedMessage object
-        feed_message.save()
 
-        # Build TripUpdate DataFrame
-        trip_updates_json = json_format.MessageToJson(
-            trip_updates, preserving_proto_field_name=True
-        )
-        trip_updates_json = json.loads(trip_updates_json)
-        trip_updates_df = pd.json_normalize(trip_updates_json["entity"], sep="_")
-        trip_updates_df.rename(columns={"id": "entity_id"}, inplace=True)
-        trip_updates_df["feed_message"] = feed_message
-
-        # Fix entity timestamp
-        trip_updates_df["trip_update_timestamp"].fillna(
-            datetime.now().timestamp(), inplace=True
-        )
-        trip_updates_df["trip_update_timestamp"] = pd.to_datetime(
-            trip_updates_df["trip_update_timestamp"].astype(int), unit="s", utc=True
-        )
-        # Fix trip start date
-        trip_updates_df["trip_update_trip_start_date"] = pd.to_datetime(
-            trip_updates_df["trip_update_trip_start_date"], format="%Y%m%d"
-        )
-        trip_updates_df["trip_update_trip_start_date"].fillna(
-            datetime.now().date(), inplace=True
-        )
-        # Fix trip start time
-        trip_updates_df["trip_update_trip_start_time"] = pd.to_timedelta(
-            trip_updates_df["trip_update_trip_start_time"]
-        )
-        trip_updates_df["trip_update_trip_start_time"].fillna(
-            timedelta(hours=0, minutes=0, seconds=0), inplace=True
-        )
-        # Fix trip direction
-        trip_updates_df["trip_update_trip_direction_id"].fillna(-1, inplace=True)
-
-        for i, trip_update in trip_updates_df.iterrows():
-            this_trip_update = TripUpdate(
-                entity_id=trip_update["entity_id"],
-                feed_message=trip_update["feed_message"],
-                trip_trip_id=trip_update["trip_update_trip_trip_id"],
-                trip_route_id=trip_update["trip_update_trip_route_id"],
-                trip_direction_id=trip_update["trip_update_trip_direction_id"],
-                trip_start_time=trip_update["trip_update_trip_start_time"],
-                trip_start_date=trip_update["trip_update_trip_start_date"],
-                trip_schedule_relationship=trip_update[
-                    "trip_update_trip_schedule_relationship"
-                ],
-                vehicle_id=trip_update["trip_update_vehicle_id"],
-                vehicle_label=trip_update["trip_update_vehicle_label"],
-                # trip_update_vehicle_license_plate=trip_update["trip_update_vehicle_license_plate"],
-                # trip_update_vehicle_wheelchair_accessible=trip_update["trip_update_vehicle_wheelchair_accessible"],
-                timestamp=trip_update["trip_update_timestamp"],
-                # trip_update_delay=trip_update["trip_update_delay"],
-            )
-            # Save this TripUpdate object
-            this_trip_update.save()
-
-            # Build StopTimeUpdate DataFrame
-            stop_time_updates_json = str(trip_update["trip_update_stop_time_update"])
-            stop_time_updates_json = stop_time_updates_json.replace("'", '"')
-            stop_time_updates_json = json.loads(stop_time_updates_json)
-            stop_time_updates_df = pd.json_normalize(stop_time_updates_json, sep="_")
-            stop_time_updates_df["feed_message"] = feed_message
-            stop_time_updates_df["trip_update"] = this_trip_update
-
-            # Fix arrival time timestamp
-            if "arrival_time" in stop_time_updates_df.columns:
-                stop_time_updates_df["arrival_time"].fillna(
-                    datetime.now().timestamp(), inplace=True
-                )
-                stop_time_updates_df["arrival_time"] = pd.to_datetime(
-                    stop_time_updates_df["arrival_time"].astype(int), unit="s", utc=True
-                )
-            # Fix departure time timestamp
-            if "departure_time" in stop_time_updates_df.columns:
-                stop_time_updates_df["departure_time"].fillna(
-                    datetime.now().timestamp(), inplace=True
-                )
-                stop_time_updates_df["departure_time"] = pd.to_datetime(
-                    stop_time_updates_df["departure_time"].astype(int),
-                    unit="s",
-                    utc=True,
-                )
-            # Fix arrival uncertainty
-            if "arrival_uncertainty" in stop_time_updates_df.columns:
-                stop_time_updates_df["arrival_uncertainty"].fillna(0, inplace=True)
-            # Fix departure uncertainty
-            if "departure_uncertainty" in stop_time_updates_df.columns:
-                stop_time_updates_df["departure_uncertainty"].fillna(0, inplace=True)
-            # Fix arrival delay
-            if "arrival_delay" in stop_time_updates_df.columns:
-                stop_time_updates_df["arrival_delay"].fillna(0, inplace=True)
-            # Fix departure delay
-            if "departure_delay" in stop_time_updates_df.columns:
-                stop_time_updates_df["departure_delay"].fillna(0, inplace=True)
-
-            # Save to database
-            objects = [
-                StopTimeUpdate(**row)
-                for row in stop_time_updates_df.to_dict(orient="records")
-            ]
-            StopTimeUpdate.objects.bulk_create(objects)
+@shared_task
+def roll_schedule_departures():
+    roll_departure_boards(settings.DEPARTURE_BOARD_DAYS_AHEAD)
+    return "Departure boards updated"
 
-    return "TripUpdates saved to database"
+
+@shared_task
+def manage_realtime_partitions():
+    maintain_partitions(
+        days_ahead=settings.REALTIME_PARTITION_DAYS_AHEAD,
+        retention_days=settings.REALTIME_RETENTION_DAYS,
+    )
+    return "Realtime partitions updated"
 
 
 @shared_task
-def get_service_alerts():
-    return "Fetching Alerts"
+def compact_realtime_history():
+    compact_vehicle_positions(
+        tiers=settings.REALTIME_COMPACTION_TIERS,
+        window=settings.REALTIME_COMPACTION_WINDOW,
+        max_windows=settings.REALTIME_COMPACTION_MAX_WINDOWS,
+    )
+    return "Vehicle positions history compacted"
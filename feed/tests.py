@@ -1,3 +1,325 @@
-from django.test import TestCase
+from datetime import datetime, timedelta, timezone
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import pandas as pd
+from django.conf import settings
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase
+from google.transit import gtfs_realtime_pb2 as gtfs_rt
+
+from feed.compaction import compact_window
+from feed.loadgen import SyntheticFeed
+from feed.partitions import (
+    PARTITION_COLUMN,
+    REALTIME_PARTITIONS,
+    convert_tables,
+    create_partitions,
+    day_start,
+    drop_expired_partitions,
+    ensure_partitions,
+    get_partitions,
+)
+from feed.realtime import (
+    changed_vehicle_positions,
+    save_vehicle_states,
+    trip_updates_frames,
+    vehicle_positions_frame,
+)
+from gtfs.models import (
+    FeedMessage,
+    GTFSProvider,
+    StopTimeUpdate,
+    TripUpdate,
+    VehiclePosition,
+)
+
+MIN_DISTANCE = 20  # Meters
+HEARTBEAT = 60  # Seconds
+LATITUDE = 9.9356
+LONGITUDE = -84.0508
+METERS_PER_DEGREE = 111195  # Along a meridian
+
+PARTITIONED_TABLES = {
+    model._meta.object_name: model._meta.db_table
+    for model in [FeedMessage, VehiclePosition, TripUpdate, StopTimeUpdate]
+}
+
+
+class FakeRedis:
+    """The hash commands of Redis used by the vehicle states, in memory."""
+
+    def __init__(self):
+        self.hashes = {}
+
+    def hmget(self, key, fields):
+        values = self.hashes.get(key, {})
+        return [values.get(field) for field in fields]
+
+    def hset(self, key, mapping):
+        self.hashes.setdefault(key, {}).update(
+            (field, value.encode()) for field, value in mapping.items()
+        )
+
+
+def snapshot(*vehicles):
+    """Vehicle positions DataFrame of (entity ID, vehicle ID, Unix time,
+    meters north of the origin) tuples."""
+    return pd.DataFrame(
+        {
+            "entity_id": [vehicle[0] for vehicle in vehicles],
+            "vehicle_vehicle_id": [vehicle[1] for vehicle in vehicles],
+            "vehicle_timestamp": [
+                pd.Timestamp(vehicle[2], unit="s", tz="UTC") for vehicle in vehicles
+            ],
+            "vehicle_position_latitude": [
+                LATITUDE + vehicle[3] / METERS_PER_DEGREE for vehicle in vehicles
+            ],
+            "vehicle_position_longitude": [LONGITUDE] * len(vehicles),
+            "vehicle_current_stop_sequence": [3] * len(vehicles),
+            "vehicle_current_status": ["IN_TRANSIT_TO"] * len(vehicles),
+            "vehicle_occupancy_status": ["MANY_SEATS_AVAILABLE"] * len(vehicles),
+        }
+    )
+
+
+class ChangedVehiclePositionsTest(SimpleTestCase):
+    """Vehicle positions kept by the delta storage mode."""
+
+    def setUp(self):
+        patch = mock.patch("feed.realtime.get_redis", return_value=FakeRedis())
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.provider = mock.Mock(code="test")
+
+    def changed(self, vehicle_positions_df):
+        changed = changed_vehicle_positions(
+            self.provider, vehicle_positions_df, MIN_DISTANCE, HEARTBEAT
+        )
+        save_vehicle_states(self.provider, changed)
+        return list(changed["entity_id"])
+
+    def test_new_vehicles_are_kept(self):
+        self.assertEqual(
+            self.changed(snapshot(("a", "bus-1", 1000, 0), ("b", None, 1000, 0))),
+            ["a", "b"],
+        )
+
+    def test_movement_below_the_distance_is_dropped(self):
+        self.changed(snapshot(("a", "bus-1", 1000, 0)))
+        self.assertEqual(self.changed(snapshot(("a", "bus-1", 1010, 5))), [])
+
+    def test_movement_above_the_distance_is_kept(self):
+        self.changed(snapshot(("a", "bus-1", 1000, 0)))
+        self.assertEqual(self.changed(snapshot(("a", "bus-1", 1010, 50))), ["a"])
+
+    def test_same_timestamp_is_dropped(self):
+        self.changed(snapshot(("a", "bus-1", 1000, 0)))
+        self.assertEqual(self.changed(snapshot(("a", "bus-1", 1000, 50))), [])
+
+    def test_heartbeat_keeps_a_still_vehicle(self):
+        self.changed(snapshot(("a", "bus-1", 1000, 0)))
+        self.assertEqual(self.changed(snapshot(("a", "bus-1", 1030, 0))), [])
+        # Compared with the last saved state, not with the dropped one
+        self.assertEqual(
+            self.changed(snapshot(("a", "bus-1", 1000 + HEARTBEAT, 0))), ["a"]
+        )
+
+    def test_vehicles_without_id_are_told_apart_by_entity(self):
+        self.changed(snapshot(("a", None, 1000, 0), ("b", None, 1000, 0)))
+        self.assertEqual(
+            self.changed(snapshot(("a", None, 1010, 0), ("b", None, 1010, 50))),
+            ["b"],
+        )
+
+
+@skipUnless(connection.vendor == "postgresql", "Partitioning needs PostgreSQL")
+class RealtimePartitionsTest(TestCase):
+    """Conversion of the realtime tables to daily partitions, and creation
+    and retention of the partitions."""
+
+    def setUp(self):
+        self.provider = GTFSProvider.objects.create(
+            code="partitions",
+            name="Partitions",
+            timezone=settings.TIME_ZONE,
+            is_active=False,
+        )
+        self.source = SyntheticFeed(fleet_size=3, stops_per_trip=4)
+        self.header_timestamp = int(datetime.now(timezone.utc).timestamp())
+
+    def save_snapshots(self):
+        """Save a snapshot of each feed with its rows, like the ingest."""
+        self.header_timestamp += 1
+        for entity_type in ["vehicle", "trip_update"]:
+            message = gtfs_rt.FeedMessage()
+            message.ParseFromString(
+                self.source.snapshot(entity_type, self.header_timestamp)
+            )
+            feed_message = FeedMessage(
+                feed_message_id=(
+                    f"{self.provider.code}-{entity_type}-{self.header_timestamp}"
+                ),
+                provider=self.provider,
+                entity_type=entity_type,
+                timestamp=datetime.fromtimestamp(self.header_timestamp, timezone.utc),
+                incrementality=message.header.incrementality,
+                gtfs_realtime_version=message.header.gtfs_realtime_version,
+            )
+            with transaction.atomic():
+                feed_message.save()
+                if entity_type == "vehicle":
+                    rows = vehicle_positions_frame(message, feed_message)
+                    VehiclePosition.objects.bulk_create(
+                        VehiclePosition(**row) for row in rows.to_dict(orient="records")
+                    )
+                    continue
+                trip_updates_df, stop_time_updates_df = trip_updates_frames(
+                    message, feed_message
+                )
+                trip_update_index = stop_time_updates_df.pop("trip_update_index")
+                trip_updates = TripUpdate.objects.bulk_create(
+                    TripUpdate(**row)
+                    for row in trip_updates_df.to_dict(orient="records")
+                )
+                StopTimeUpdate.objects.bulk_create(
+                    StopTimeUpdate(**row, trip_update=trip_updates[index])
+                    for row, index in zip(
+                        stop_time_updates_df.to_dict(orient="records"),
+                        trip_update_index,
+                    )
+                )
+
+    def partitions(self):
+        """Partitions of each realtime table, without the table prefix."""
+        with connection.cursor() as cursor:
+            return {
+                model_name: sorted(
+                    partition.removeprefix(table)
+                    for partition in get_partitions(cursor, table)
+                )
+                for model_name, table in PARTITIONED_TABLES.items()
+            }
+
+    def partition_rows(self, suffix):
+        """Rows of each realtime table in its partition with a suffix."""
+        with connection.cursor() as cursor:
+            counts = []
+            for table in PARTITIONED_TABLES.values():
+                cursor.execute(f"SELECT count(*) FROM {table}{suffix}")
+                counts.append(cursor.fetchone()[0])
+            return counts
+
+    def count_rows(self):
+        return [
+            model.objects.count()
+            for model in [FeedMessage, VehiclePosition, TripUpdate, StopTimeUpdate]
+        ]
+
+    def test_convert_create_and_drop(self):
+        self.save_snapshots()
+        rows_before = self.count_rows()
+        # The foreign keys of the rows are checked before altering the tables
+        with connection.cursor() as cursor:
+            cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+
+        convert_tables()
+        self.assertEqual(self.count_rows(), rows_before)
+        # Converting again does nothing
+        convert_tables()
+
+        today = datetime.now(timezone.utc).date()
+        days = [today + timedelta(days=offset) for offset in (1, 2)]
+        for model_name in REALTIME_PARTITIONS:
+            create_partitions(model_name, days_ahead=2)
+        expected = ["_legacy"] + [f"_p{day:%Y%m%d}" for day in days]
+        self.assertEqual(
+            self.partitions(),
+            {model_name: expected for model_name in REALTIME_PARTITIONS},
+        )
+
+        # The indexes of the legacy tables are on the new tables too
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT indexdef FROM pg_indexes WHERE tablename = %s",
+                [PARTITIONED_TABLES["FeedMessage"]],
+            )
+            indexes = [indexdef for indexdef, in cursor.fetchall()]
+        self.assertTrue(any("(feed_message_id" in index for index in indexes))
+
+        # Rows saved on a later day get new IDs and go to its partition
+        saved_at = day_start(days[0]) + timedelta(hours=12)
+        with connection.cursor() as cursor:
+            for table in PARTITIONED_TABLES.values():
+                cursor.execute(
+                    f"ALTER TABLE {table} ALTER COLUMN {PARTITION_COLUMN} "
+                    "SET DEFAULT %s",
+                    [saved_at],
+                )
+        self.save_snapshots()
+        self.assertEqual(self.count_rows(), [2 * rows for rows in rows_before])
+        self.assertEqual(self.partition_rows("_legacy"), rows_before)
+        self.assertEqual(self.partition_rows(f"_p{days[0]:%Y%m%d}"), rows_before)
+
+        # The legacy partitions end today, so they expire together
+        for model_name in REALTIME_PARTITIONS:
+            self.assertEqual(
+                drop_expired_partitions(model_name, retention_days=-1),
+                [f"{PARTITIONED_TABLES[model_name]}_legacy"],
+            )
+        self.assertEqual(self.count_rows(), rows_before)
+        self.assertEqual(
+            self.partitions(),
+            {model_name: expected[1:] for model_name in REALTIME_PARTITIONS},
+        )
+
+        # The ingest creates the partitions of a day the maintenance missed
+        later = today + timedelta(days=5)
+        ensure_partitions(later)
+        for partitions in self.partitions().values():
+            self.assertIn(f"_p{later:%Y%m%d}", partitions)
+
+
+@skipUnless(connection.vendor == "postgresql", "Compaction needs PostgreSQL")
+class CompactWindowTest(TestCase):
+    """Vehicle positions reduced to one per vehicle in each bucket."""
+
+    def test_vehicles_without_id_are_told_apart_by_entity(self):
+        provider = GTFSProvider.objects.create(
+            code="compaction",
+            name="Compaction",
+            timezone=settings.TIME_ZONE,
+            is_active=False,
+        )
+        source = SyntheticFeed(fleet_size=3, stops_per_trip=4)
+        start = 1_700_000_040  # A whole minute
+        for second in range(2):
+            message = gtfs_rt.FeedMessage()
+            message.ParseFromString(source.snapshot("vehicle", start + second))
+            feed_message = FeedMessage.objects.create(
+                feed_message_id=f"{provider.code}-vehicle-{start + second}",
+                provider=provider,
+                entity_type="vehicle",
+                timestamp=datetime.fromtimestamp(start + second, timezone.utc),
+                incrementality=message.header.incrementality,
+                gtfs_realtime_version=message.header.gtfs_realtime_version,
+            )
+            rows = vehicle_positions_frame(message, feed_message)
+            # Vehicles without ID on the same trip, in the same minute
+            rows["vehicle_vehicle_id"] = None
+            rows["vehicle_trip_trip_id"] = "trip-1"
+            rows["vehicle_trip_route_id"] = "route-1"
+            rows["vehicle_timestamp"] = pd.Timestamp(start + second, unit="s", tz="UTC")
+            VehiclePosition.objects.bulk_create(
+                VehiclePosition(**row) for row in rows.to_dict(orient="records")
+            )
+
+        deleted = compact_window(
+            datetime.fromtimestamp(start, timezone.utc),
+            datetime.fromtimestamp(start + 60, timezone.utc),
+            60,
+        )
+        self.assertEqual(deleted, 3)
+        self.assertEqual(
+            sorted(VehiclePosition.objects.values_list("entity_id", flat=True)),
+            sorted(set(rows["entity_id"])),
+        )